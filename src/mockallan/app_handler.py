@@ -1,38 +1,93 @@
-from typing import Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from datetime import datetime
+import email.utils
+import gzip
 import json
+import threading
+import time
+import urllib.parse
 import jsonschema
-from .request import ContentType, HTTPRequest, HTTPResponse
+from .request import ContentType, HTTPRequest, HTTPResponse, StreamingResponse
 from .stub_config import (
 	StubConfig,
-	MissingProperty
+	MissingProperty,
+	TemplateError
 )
-from .history import History, RequestRecord
+from .history import ExpectationResult, History, RequestRecord
+from .jsonpath import JSONPathError
+from .validators import RegexError
+
+
+# Fields of the /request-body-list items
+_RECORD_FIELDS = ('sequence', 'date-time', 'request', 'response', 'path-params', 'generation')
+
+# Assertions of the /assert-batch items
+_BATCH_ASSERTIONS = ('assert-called', 'assert-called-once', 'assert-called-with', 'assert-called-once-with', 'request-count')
+
+# Records per page of a streamed /request-body-list
+_RECORD_PAGE_SIZE = 1000
+
+# Maximum seconds an assertion waits
+MAX_ASSERTION_TIMEOUT = 300.0
+
+# Seconds between the keep-alive comments of a /history/stream without records
+_STREAM_KEEP_ALIVE_INTERVAL = 15.0
+
+# Records queued for a /history/stream client before further ones are dropped
+_STREAM_MAX_QUEUED_RECORDS = 1024
 
 
 class AppHandler():
+	"""Serves the Stub Configuration API, the Assertion API and the test requests.
+
+	Args:
+		config (StubConfig):
+		history (History):	Defaults to a new History.
+		allow_waits (bool):	Whether assertions may wait for requests with the `timeout` query
+					parameter. Servers handling one request at a time must not allow it,
+					since the requests waited for could not be served meanwhile.
 
-	def __init__(self, config: StubConfig, history: Optional[History] = None):
+	"""
+	def __init__(self, config: StubConfig, history: Optional[History] = None, allow_waits: bool = True):
 
 		if history is None:
 			history = History()
 
 		self._config = config
+		self._allow_waits = allow_waits
 		self._api_endpoints = {
 			# Stub Configuration API
 			('GET', '/config'): self._get_config,
 			('PUT', '/config'): self._put_config,
+			('PATCH', '/config'): self._patch_config,
 			# Assertion API
 			('GET', '/assert-called'): self._assert_called,
 			('GET', '/assert-called-once'): self._assert_called_once,
 			('POST', '/assert-called-with'): self._assert_called_with,
 			('POST', '/assert-called-once-with'): self._assert_called_once_with,
+			('POST', '/assert-batch'): self._assert_batch,
 			('GET', '/request-body'): self._request_body,
 			('GET', '/request-body-list'): self._request_body_list,
-			('GET', '/request-count'): self._request_count
+			('GET', '/request-count'): self._request_count,
+			('POST', '/expectations'): self._post_expectation,
+			('DELETE', '/expectations'): self._delete_expectations,
+			('GET', '/expectations/verify'): self._verify_expectations,
+			('GET', '/history/stream'): self._history_stream,
+			('GET', '/validator-cache'): self._get_validator_cache
+		}
+
+		self._api_prefix_endpoints = {
+			('PUT', '/config/endpoints/'): self._put_config_endpoint,
+			('DELETE', '/config/endpoints/'): self._delete_config_endpoint
 		}
 
 		self._history = history
 
+		# GET /config responses of `_config_version` by content coding
+		self._config_lock = threading.Lock()
+		self._config_version: Optional[str] = None
+		self._config_responses: Dict[str, HTTPResponse] = {}
+
 
 	@property
 	def history(self) -> History:
@@ -40,7 +95,7 @@ class AppHandler():
 		return self._history
 
 
-	def handle_request(self, request: HTTPRequest) -> HTTPResponse:
+	def handle_request(self, request: HTTPRequest) -> Union[HTTPResponse, StreamingResponse]:
 
 		response = self._handle_api_request(request)
 		if response is None:
@@ -49,47 +104,184 @@ class AppHandler():
 		return response
 
 
+	def is_api_request(self, request: HTTPRequest) -> bool:
+		"""Returns True if `request` is a Stub Configuration/Assertion API request. """
+
+		return self._api_method(request) is not None
+
+
+	def is_long_poll(self, request: HTTPRequest) -> bool:
+		"""Returns True if `request` is an API request that may wait, i.e. it has a `timeout` query parameter or it is a history stream. """
+
+		if request.method.upper() == 'GET' and request.path == '/history/stream':
+			return True
+
+		return bool(request.query.get('timeout')) and self.is_api_request(request)
+
+
+	def _api_method(self, request: HTTPRequest) -> Optional[Callable[[HTTPRequest], HTTPResponse]]:
+
+		method = request.method.upper()
+		api_method = self._api_endpoints.get((method, request.path))
+		if api_method is None:
+			for (prefix_method, prefix), prefix_api_method in self._api_prefix_endpoints.items():
+				if method == prefix_method and request.path.startswith(prefix):
+					return prefix_api_method
+
+		return api_method
+
+
 	def _handle_api_request(self, request: HTTPRequest) -> Optional[HTTPResponse]:
 		"""Handles Stub Configuration/Assertion API request by the test client. """
 
-		endpoint = (request.method.upper(), request.path)
-		method = self._api_endpoints.get(endpoint)
+		method = self._api_method(request)
 		if method:
 			try:
 				return method(request)
 			except jsonschema.SchemaError as e:
 				# Raised by
-				# History.assert_called_with() or
-				# History.assert_called_once_with()
+				# History.assert_called_with(),
+				# History.assert_called_once_with(),
+				# History.match_counts() or
+				# History.add_expectation()
 				return self._create_json_schema_error_response(request, e)
+			except RegexError as e:
+				# Raised by the same methods for regex assertions
+				return self._create_regex_error_response(request, e)
+			except JSONPathError as e:
+				# Raised by the same methods for jsonpath assertions
+				return self._create_jsonpath_error_response(request, e)
 
 		return None
 
 
 	def _handle_test_request(self, request: HTTPRequest) -> HTTPResponse:
 
-		response = self._config.lookup(request)
+		snapshot = self._config.snapshot
+		response, index = self._config.lookup_indexed(request, snapshot)
 
-		self._history.append(request, response)
+		self._history.append(request, response, snapshot.generation, index)
 
 		return response
 
 
-	def _get_config(self, request: HTTPRequest) -> HTTPResponse:	# pylint: disable=unused-argument
+	def _get_config(self, request: HTTPRequest) -> HTTPResponse:
+		"""GET /config
 
-		return HTTPResponse(
-			200,
-			ContentType.APPLICATION_JSON,
-			self._config.dump_json()
-		)
+		Replies 304 if the configuration still matches the `If-None-Match` ETag, the `generation`
+		query parameter or the `If-Modified-Since` date. The ETag also changes when a response
+		sequence advances; the generation and the modification date do not.
+
+		The response is serialized, and gzip-compressed if accepted, once per configuration version.
+		ETags start with the configuration instance id, since generations restart on every run.
+
+		"""
+		snapshot = self._config.snapshot
+		version = f'{self._config.instance_id}-{snapshot.version}'
+		coding = 'gzip' if _accepts_gzip(request.headers.get('Accept-Encoding')) else 'identity'
+		etag = f'"{version}"' if coding == 'identity' else f'"{version}-{coding}"'
+		last_modified = int(snapshot.timestamp)
+
+		if_none_match = request.headers.get('If-None-Match')
+		if if_none_match is not None:
+			# Weak comparison. Every content coding of the same version matches
+			tags = {tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip() for tag in if_none_match.split(',')}
+			not_modified = bool(tags & {'*', f'"{version}"', f'"{version}-gzip"'})
+		else:
+			not_modified = not snapshot.cursors and _parse_http_date(request.headers.get('If-Modified-Since')) >= last_modified
+
+		generation = request.query.get('generation')
+		if generation:
+			not_modified = not_modified or generation[0] == str(snapshot.generation)
+
+		if not_modified:
+			return HTTPResponse(304, {'ETag': etag, 'Last-Modified': email.utils.formatdate(last_modified, usegmt=True)})
+
+		with self._config_lock:
+			if self._config_version != version:
+				self._config_version = version
+				self._config_responses = {}
+
+			response = self._config_responses.get(coding)
+			if response is None:
+				response = self._create_config_response(snapshot, coding, etag, last_modified)
+				response.compile()
+				self._config_responses[coding] = response
+
+		return response
+
+
+	def _create_config_response(self, snapshot, coding: str, etag: str, last_modified: int) -> HTTPResponse:
+
+		headers = dict(ContentType.APPLICATION_JSON)
+		headers['ETag'] = etag
+		headers['Last-Modified'] = email.utils.formatdate(last_modified, usegmt=True)
+		headers['Vary'] = 'Accept-Encoding'
+
+		body = json.dumps(self._config.dump_json(snapshot)).encode('utf-8')
+		if coding == 'gzip':
+			headers['Content-Encoding'] = 'gzip'
+			body = gzip.compress(body, compresslevel=6, mtime=0)
+
+		return HTTPResponse(200, headers, body)
 
 
 	def _put_config(self, request: HTTPRequest) -> HTTPResponse:
 
-		if isinstance(request.body, str):
+		return self._update_config(request, self._config.load_json)
+
+
+	def _patch_config(self, request: HTTPRequest) -> HTTPResponse:
+
+		return self._update_config(request, self._config.patch_json)
+
+
+	def _put_config_endpoint(self, request: HTTPRequest) -> HTTPResponse:
+		"""PUT /config/endpoints/{method}/{path} """
+
+		method, path = self._parse_config_endpoint_path(request.path)
+
+		return self._update_config(
+			request,
+			lambda endpoint_json: self._config.upsert_endpoint(method, path, endpoint_json)
+		)
+
+
+	def _delete_config_endpoint(self, request: HTTPRequest) -> HTTPResponse:
+		"""DELETE /config/endpoints/{method}/{path} """
+
+		method, path = self._parse_config_endpoint_path(request.path)
+		if not self._config.delete_endpoint(method, path):
+			return HTTPResponse(
+				404,
+				ContentType.APPLICATION_JSON_ERROR,
+				{
+					"status": 404,
+					"type": "endpoint-not-found-error",
+					"title": "Endpoint not found",
+					"detail": f"No endpoint is configured for {method} {path}."
+				}
+			)
+
+		return HTTPResponse(204)
+
+
+	@staticmethod
+	def _parse_config_endpoint_path(api_path: str) -> Tuple[str, str]:
+		"""Returns (method, path) of '/config/endpoints/{method}/{path}'. The path may be percent-encoded. """
+
+		method, _, path = api_path[len('/config/endpoints/'):].partition('/')
+
+		return method.upper(), '/' + urllib.parse.unquote(path)
+
+
+	def _update_config(self, request: HTTPRequest, update: Callable[[dict], None]) -> HTTPResponse:
+		"""Calls `update` with the JSON body of `request` and returns the API response. """
+
+		if isinstance(request.body, (str, bytes)):
 			try:
 				request.body = json.loads(request.body)
-			except json.JSONDecodeError as e:
+			except ValueError as e:
 				return HTTPResponse(
 					400,
 					ContentType.APPLICATION_JSON_ERROR,
@@ -102,7 +294,7 @@ class AppHandler():
 				)
 
 		try:
-			self._config.load_json(request.body)
+			update(request.body)
 		except MissingProperty as e:
 			return HTTPResponse(
 				400,
@@ -125,6 +317,28 @@ class AppHandler():
 					"detail": f"{e.__class__.__name__}: {e}."
 				}
 			)
+		except TemplateError as e:
+			return HTTPResponse(
+				400,
+				ContentType.APPLICATION_JSON_ERROR,
+				{
+					"status": 400,
+					"type": "path-template-error",
+					"title": "Invalid path template",
+					"detail": f"{e}."
+				}
+			)
+		except ValueError as e:
+			return HTTPResponse(
+				400,
+				ContentType.APPLICATION_JSON_ERROR,
+				{
+					"status": 400,
+					"type": "invalid-property-error",
+					"title": "Invalid property value",
+					"detail": f"{e}."
+				}
+			)
 
 		return HTTPResponse(204)
 
@@ -135,15 +349,19 @@ class AppHandler():
 			method_called = request.query['method'][0]
 			path_called = request.query['path'][0]
 			endpoint_called = (method_called, path_called)
+			timeout = _parse_timeout(request.query, self._allow_waits)
 		except KeyError as e:
 			response = self._create_missing_query_param_response(e)
+		except ValueError as e:
+			response = self._create_invalid_query_param_response(e)
 		else:
-			request_count = self._history.request_count(endpoint_called)
+			request_count = self._history.wait_request_count(endpoint_called, 1, timeout)
+			evicted = self._history.evicted_count(endpoint_called) > 0
 
 			if request_count > 0:
-				response = self._create_assertion_success_response(request, endpoint_called, request_count)
+				response = self._create_assertion_success_response(request, endpoint_called, request_count, evicted)
 			else:
-				response = self._create_assertion_error_response(request, endpoint_called, 1, request_count)
+				response = self._create_assertion_error_response(request, endpoint_called, 1, request_count, evicted)
 
 		return response
 
@@ -154,15 +372,19 @@ class AppHandler():
 			method_called = request.query['method'][0]
 			path_called = request.query['path'][0]
 			endpoint_called = (method_called, path_called)
+			timeout = _parse_timeout(request.query, self._allow_waits)
 		except KeyError as e:
 			response = self._create_missing_query_param_response(e)
+		except ValueError as e:
+			response = self._create_invalid_query_param_response(e)
 		else:
-			request_count = self._history.request_count(endpoint_called)
+			request_count = self._history.wait_request_count(endpoint_called, 1, timeout)
+			evicted = self._history.evicted_count(endpoint_called) > 0
 
 			if request_count == 1:
-				response = self._create_assertion_success_response(request, endpoint_called, request_count)
+				response = self._create_assertion_success_response(request, endpoint_called, request_count, evicted)
 			else:
-				response = self._create_assertion_error_response(request, endpoint_called, 1, request_count)
+				response = self._create_assertion_error_response(request, endpoint_called, 1, request_count, evicted)
 
 		return response
 
@@ -173,15 +395,20 @@ class AppHandler():
 			method_called = request.query['method'][0]
 			path_called = request.query['path'][0]
 			endpoint_called = (method_called, path_called)
+			timeout = _parse_timeout(request.query, self._allow_waits)
 		except KeyError as e:
 			response = self._create_missing_query_param_response(e)
+		except ValueError as e:
+			response = self._create_invalid_query_param_response(e)
 		else:
+			started = time.perf_counter()
 			try:
-				self._history.assert_called_with(endpoint_called, request)
+				self._history.assert_called_with(endpoint_called, request, timeout)
 			except AssertionError as e:
 				response = self._create_assertion_error_response(request, endpoint_called, 1, 0)
 			else:
 				response = self._create_assertion_success_response(request, endpoint_called, 1)
+			response.body['duration_ms'] = _elapsed_ms(started)
 
 		return response
 
@@ -192,19 +419,287 @@ class AppHandler():
 			method_called = request.query['method'][0]
 			path_called = request.query['path'][0]
 			endpoint_called = (method_called, path_called)
+			timeout = _parse_timeout(request.query, self._allow_waits)
 		except KeyError as e:
 			response = self._create_missing_query_param_response(e)
+		except ValueError as e:
+			response = self._create_invalid_query_param_response(e)
 		else:
+			started = time.perf_counter()
 			try:
-				self._history.assert_called_once_with(endpoint_called, request)
+				self._history.assert_called_once_with(endpoint_called, request, timeout)
 			except AssertionError as e:
 				response = self._create_assertion_error_response(request, endpoint_called, 1, 0)
 			else:
 				response = self._create_assertion_success_response(request, endpoint_called, 1)
+			response.body['duration_ms'] = _elapsed_ms(started)
 
 		return response
 
 
+	def _assert_batch(self, request: HTTPRequest) -> HTTPResponse:
+		"""POST /assert-batch
+
+		Evaluates a JSON array of assertions, or an object with the array as `assertions` and a
+		`fail_fast` flag. Each assertion is an object with the `assertion` name, e.g.
+		"assert-called-once-with", the `method` and `path` of the endpoint, and the `headers` and
+		`body` of the assert request, or the expected `count` of a "request-count" assertion. The
+		body assertions of an endpoint are validated in one pass over its records. With
+		`fail_fast`, the assertions after the first failure are skipped.
+
+		Returns:
+			HTTPResponse	A 200 response with the result of every assertion, if all succeeded.
+					A 409 response with the result of every assertion, if any failed.
+					A 400 response if the assertions are invalid.
+
+		"""
+		try:
+			assertions, fail_fast = self._parse_assert_batch(request.body)
+		except ValueError as e:
+			return HTTPResponse(
+				400,
+				ContentType.APPLICATION_JSON_ERROR,
+				{
+					"status": 400,
+					"type": "invalid-assertion-batch",
+					"title": "Invalid assertion batch",
+					"detail": f"{e}"
+				}
+			)
+
+		started = time.perf_counter()
+		# Indexes of the body assertions by endpoint, validated together when the first is reached
+		endpoint_body_assertions: Dict[Tuple[str, str], List[int]] = {}
+		for index, assertion in enumerate(assertions):
+			if assertion['assertion'] in ('assert-called-with', 'assert-called-once-with'):
+				endpoint_body_assertions.setdefault(assertion['endpoint'], []).append(index)
+		match_counts: Dict[int, int] = {}
+
+		results = []
+		failed_count = 0
+		for index, assertion in enumerate(assertions):
+			endpoint = assertion['endpoint']
+			result = {"assertion": assertion['assertion'], "method": endpoint[0], "path": endpoint[1]}
+			results.append(result)
+			if fail_fast and failed_count:
+				result['skipped'] = True
+				continue
+
+			if assertion['assertion'] in ('assert-called-with', 'assert-called-once-with'):
+				if index not in match_counts:
+					indexes = endpoint_body_assertions[endpoint]
+					validation_requests = [
+						HTTPRequest('POST', request.path, headers=assertions[i]['headers'], body=assertions[i]['body'])
+						for i in indexes
+					]
+					# Once-assertions are decided by 2 matches
+					match_counts.update(zip(indexes, self._history.match_counts(endpoint, validation_requests, 2)))
+				if assertion['assertion'] == 'assert-called-with':
+					result['passed'] = match_counts[index] > 0
+				else:
+					result['passed'] = match_counts[index] == 1
+				result['detail'] = (
+					f"{endpoint[0]} {endpoint[1]} "
+					f"{('not called', 'called once', 'called more than once')[match_counts[index]]} with the body."
+				)
+			else:
+				request_count = self._history.request_count(endpoint)
+				if assertion['assertion'] == 'assert-called':
+					result['passed'] = request_count > 0
+				elif assertion['assertion'] == 'assert-called-once':
+					result['passed'] = request_count == 1
+				else:
+					result['passed'] = assertion.get('count') in (None, request_count)
+				result['detail'] = f"{endpoint[0]} {endpoint[1]} called {request_count} times."
+				result['request_count'] = request_count
+				result['evicted'] = self._history.evicted_count(endpoint) > 0
+
+			if not result['passed']:
+				failed_count += 1
+
+		status_code = 409 if failed_count else 200
+		body = {
+			"status": status_code,
+			"type": "assertion-error" if failed_count else "assertion-success",
+			"title": f"Assertion request {request.method} {request.path} {'failed' if failed_count else 'succeeded'}",
+			"detail": f"{failed_count} of {len(assertions)} assertions failed.",
+			"duration_ms": _elapsed_ms(started),
+			"results": results
+		}
+
+		return HTTPResponse(
+			status_code,
+			ContentType.APPLICATION_JSON_ERROR if failed_count else ContentType.APPLICATION_JSON,
+			body
+		)
+
+
+	@staticmethod
+	def _parse_assert_batch(body: Union[dict, list, str, bytes]) -> Tuple[List[dict], bool]:
+		"""Returns the assertions of a /assert-batch body, with their `endpoint`, and the `fail_fast` flag.
+
+		Raises:
+			ValueError	If the body is not a valid batch.
+
+		"""
+		if isinstance(body, (str, bytes)):
+			try:
+				body = json.loads(body)
+			except ValueError as e:
+				raise ValueError(f'The body is not valid JSON: {e}.') from e
+
+		fail_fast = False
+		if isinstance(body, dict):
+			fail_fast = body.get('fail_fast', False)
+			body = body.get('assertions')
+			if not isinstance(fail_fast, bool):
+				raise ValueError('`fail_fast` must be a boolean.')
+		if not isinstance(body, list):
+			raise ValueError('The body must be an array of assertions or an object with the array as `assertions`.')
+
+		assertions = []
+		for index, item in enumerate(body):
+			if not isinstance(item, dict):
+				raise ValueError(f'Assertion {index} must be an object.')
+			if item.get('assertion') not in _BATCH_ASSERTIONS:
+				raise ValueError(f"Assertion {index} must have an `assertion` of {', '.join(_BATCH_ASSERTIONS)}.")
+			if not isinstance(item.get('method'), str) or not isinstance(item.get('path'), str):
+				raise ValueError(f'Assertion {index} must have a `method` and a `path`.')
+			if not isinstance(item.get('headers', {}), dict):
+				raise ValueError(f'The `headers` of assertion {index} must be an object.')
+			count = item.get('count')
+			if count is not None and (not isinstance(count, int) or isinstance(count, bool) or count < 0):
+				raise ValueError(f'The `count` of assertion {index} must be an integer not less than 0.')
+			assertions.append({
+				**item,
+				'endpoint': (item['method'].upper(), item['path']),
+				'headers': item.get('headers', {}),
+				'body': item.get('body', '')
+			})
+
+		return assertions, fail_fast
+
+
+	def _post_expectation(self, request: HTTPRequest) -> HTTPResponse:
+		"""POST /expectations
+
+		Expects the endpoint of the `method` and `path` query parameters to be called `count` times,
+		or from `min` (1 by default) to `max` times, with requests valid for the body of this
+		request. The validator is selected as in POST /assert-called-with. With an empty body every
+		request of the endpoint is counted. Only requests made from now on are counted.
+
+		Returns:
+			HTTPResponse	A 201 response with the expectation id.
+					A 400 response if a query parameter is invalid.
+
+		"""
+		try:
+			endpoint = (request.query['method'][0].upper(), request.query['path'][0])
+			count = _parse_int_query_param(request.query, 'count', 0)
+			min_count = _parse_int_query_param(request.query, 'min', 0)
+			max_count = _parse_int_query_param(request.query, 'max', 0)
+		except KeyError as e:
+			return self._create_missing_query_param_response(e)
+		except ValueError as e:
+			return self._create_invalid_query_param_response(e)
+
+		if count is not None:
+			if min_count is not None or max_count is not None:
+				return self._create_invalid_query_param_response(
+					ValueError('Query parameter `count` must not be combined with `min` or `max`.')
+				)
+			min_count = max_count = count
+		elif min_count is None:
+			min_count = 1 if max_count is None else min(1, max_count)
+		if max_count is not None and max_count < min_count:
+			return self._create_invalid_query_param_response(
+				ValueError(f"Query parameter `max` must not be less than `min` {min_count} but it is '{max_count}'.")
+			)
+
+		expectation_id = self._history.add_expectation(endpoint, request, min_count, max_count)
+
+		return HTTPResponse(
+			201,
+			ContentType.APPLICATION_JSON,
+			{
+				"status": 201,
+				"id": expectation_id,
+				"method": endpoint[0],
+				"path": endpoint[1],
+				"min": min_count,
+				"max": max_count
+			}
+		)
+
+
+	def _delete_expectations(self, request: HTTPRequest) -> HTTPResponse:	# pylint: disable=unused-argument
+		"""DELETE /expectations """
+
+		self._history.clear_expectations()
+
+		return HTTPResponse(204)
+
+
+	def _verify_expectations(self, request: HTTPRequest) -> HTTPResponse:
+		"""GET /expectations/verify
+
+		With a `timeout`, waits until every expectation is called at least its `min` times.
+
+		Returns:
+			HTTPResponse	A 200 response with the count of every expectation, if all are met.
+					A 409 response with the count of every expectation, if any is not met.
+					A 400 response if a query parameter is invalid.
+
+		"""
+		try:
+			timeout = _parse_timeout(request.query, self._allow_waits)
+		except ValueError as e:
+			return self._create_invalid_query_param_response(e)
+
+		results = self._history.verify_expectations(timeout)
+		failed_count = sum(1 for result in results if not result.satisfied)
+
+		status_code = 409 if failed_count else 200
+		body = {
+			"status": status_code,
+			"type": "assertion-error" if failed_count else "assertion-success",
+			"title": f"Assertion request {request.method} {request.path} {'failed' if failed_count else 'succeeded'}",
+			"detail": f"{len(results) - failed_count} of {len(results)} expectations met.",
+			"expectations": [self._create_expectation_result_json(result) for result in results]
+		}
+
+		return HTTPResponse(
+			status_code,
+			ContentType.APPLICATION_JSON_ERROR if failed_count else ContentType.APPLICATION_JSON,
+			body
+		)
+
+
+	@staticmethod
+	def _create_expectation_result_json(result: ExpectationResult) -> dict:
+
+		return {
+			"id": result.expectation_id,
+			"method": result.method,
+			"path": result.path,
+			"min": result.min_count,
+			"max": result.max_count,
+			"count": result.count,
+			"satisfied": result.satisfied
+		}
+
+
+	def _get_validator_cache(self, request: HTTPRequest) -> HTTPResponse:	# pylint: disable=unused-argument
+		"""GET /validator-cache
+
+		Returns:
+			HTTPResponse	A 200 response with the statistics of the cache of the JSON and XML
+				schema validators compiled for the assertions.
+
+		"""
+		return HTTPResponse(200, ContentType.APPLICATION_JSON, {"status": 200, **self._history.validator_cache_stats()})
+
+
 	def _request_body(self, request: HTTPRequest) -> HTTPResponse:
 		"""
 
@@ -231,42 +726,260 @@ class AppHandler():
 		return HTTPResponse(status_code, headers, body)
 
 
-	def _request_body_list(self, request: HTTPRequest) -> HTTPResponse:
-		"""
+	def _request_body_list(self, request: HTTPRequest) -> Union[HTTPResponse, StreamingResponse]:
+		"""GET /request-body-list
+
+		The `method`, `path`, `status`, `since` and `until` query parameters select the records,
+		`limit` and `cursor` paginate them and `fields` selects the fields of the items.
 
 		Returns:
 			HTTPResponse	A 200 response with the Content-Type application/json and
-				a list of request records in the body.
+				a list of request records in the body, followed by the `next_cursor` if
+				`limit` records were listed.
+					A 400 response if a query parameter is invalid.
+			StreamingResponse	A 200 response with the Content-Type application/x-ndjson
+				streaming one request record per line, if accepted by the client.
 
 		"""
-		def create_request_record(request_record: RequestRecord) -> dict:
-
-			# E.g. 2023-10-02T21:48:16Z
-			timestamp_str = request_record.timestamp.isoformat(sep='T', timespec='seconds') + 'Z'
-
-			return {
-				"date-time": timestamp_str,
-				"request": (
-					f'{request_record.request.method} {request_record.request.path} '
-					f'{request_record.request.body}'
-				),
-				"response": (
-					f'{request_record.response.status_code} {request_record.response.body}'
-				)
-			}
+		try:
+			conditions, cursor, limit, fields = self._parse_request_body_list_query(request.query)
+		except ValueError as e:
+			return self._create_invalid_query_param_response(e)
+
+		if 'application/x-ndjson' in (request.headers.get('Accept') or ''):
+			return StreamingResponse(
+				200,
+				dict(ContentType.APPLICATION_X_NDJSON),
+				self._stream_request_records(conditions, cursor, limit, fields)
+			)
 
-		request_records = self._history.request_body_list()
+		request_records = self._history.find_records(**conditions, after_sequence=cursor, limit=limit)
 
-		status_code = 200
-		headers = ContentType.APPLICATION_JSON
 		records_json = {
-			"items": [create_request_record(request_record) for request_record in request_records]
+			"items": [self._create_request_record_json(request_record, fields) for request_record in request_records]
 		}
+		if limit is not None and len(request_records) == limit:
+			records_json['next_cursor'] = str(request_records[-1].sequence)
+
+		return HTTPResponse(200, ContentType.APPLICATION_JSON, records_json)
 
-		return HTTPResponse(status_code, headers, records_json)
+
+	def _stream_request_records(
+			self,
+			conditions: dict,
+			cursor: Optional[int],
+			limit: Optional[int],
+			fields: Optional[List[str]]) -> Iterator[bytes]:
+		"""Yields the request records as JSON lines, one page at a time.
+
+		Records appended after the stream starts are not listed, so that the stream ends while
+		requests keep coming.
+
+		"""
+		before_sequence = self._history.request_count()
+		remaining = limit
+		while remaining is None or remaining > 0:
+			page_size = _RECORD_PAGE_SIZE if remaining is None else min(_RECORD_PAGE_SIZE, remaining)
+			request_records = self._history.find_records(
+				**conditions,
+				after_sequence=cursor,
+				before_sequence=before_sequence,
+				limit=page_size
+			)
+			if not request_records:
+				return
+
+			yield ''.join(
+				json.dumps(self._create_request_record_json(request_record, fields)) + '\n'
+				for request_record in request_records
+			).encode('utf-8')
+
+			if len(request_records) < page_size:
+				return
+			cursor = request_records[-1].sequence
+			if remaining is not None:
+				remaining -= len(request_records)
+
+
+	@staticmethod
+	def _parse_request_body_list_query(query: dict) -> Tuple[dict, Optional[int], Optional[int], Optional[List[str]]]:
+		"""Returns (History.find_records() conditions, cursor, limit, fields) of the query.
+
+		Raises:
+			ValueError	If a query parameter is invalid.
+
+		"""
+		def param(name: str) -> Optional[str]:
+
+			values = query.get(name)
+			return values[0] if values else None
+
+		conditions = {
+			'method': param('method'),
+			'path': param('path'),
+			'status_code': _parse_int_query_param(query, 'status', 100),
+			'since': _parse_date_time('since', param('since')),
+			'until': _parse_date_time('until', param('until'))
+		}
+
+		return (
+			conditions,
+			_parse_int_query_param(query, 'cursor', 0),
+			_parse_int_query_param(query, 'limit', 1),
+			_parse_fields(query)
+		)
+
+
+	def _history_stream(self, request: HTTPRequest) -> Union[HTTPResponse, StreamingResponse]:
+		"""GET /history/stream
+
+		Streams the records as they are appended, as Server-Sent Events. The `method`, `path` and
+		`status` query parameters select the records and `fields` selects the fields of the events.
+		With a `cursor` query parameter or a `Last-Event-ID` header, the records kept after that
+		sequence are streamed first.
+
+		Returns:
+			StreamingResponse	A 200 response with the Content-Type text/event-stream.
+			HTTPResponse	A 400 response if a query parameter is invalid or the server
+				handles one request at a time.
+
+		"""
+		if not self._allow_waits:
+			return HTTPResponse(
+				400,
+				ContentType.APPLICATION_JSON_ERROR,
+				{
+					"status": 400,
+					"type": "unsupported-request",
+					"title": "Unsupported request",
+					"detail": "History streams are not supported by servers handling one request at a time."
+				}
+			)
+
+		try:
+			status_code = _parse_int_query_param(request.query, 'status', 100)
+			cursor = _parse_int_query_param(request.query, 'cursor', 0)
+			fields = _parse_fields(request.query)
+		except ValueError as e:
+			return self._create_invalid_query_param_response(e)
+
+		last_event_id = request.headers.get('Last-Event-ID')
+		if cursor is None and last_event_id and last_event_id.isdigit():
+			cursor = int(last_event_id)
+
+		method = request.query.get('method')
+		path = request.query.get('path')
+
+		return StreamingResponse(
+			200,
+			{**ContentType.TEXT_EVENT_STREAM, 'Cache-Control': 'no-cache'},
+			self._stream_history_events(
+				method[0] if method else None,
+				path[0] if path else None,
+				status_code,
+				cursor,
+				fields
+			)
+		)
+
+
+	def _stream_history_events(
+			self,
+			method: Optional[str],
+			path: Optional[str],
+			status_code: Optional[int],
+			cursor: Optional[int],
+			fields: Optional[List[str]]) -> Iterator[bytes]:
+		"""Yields `record` events as records are appended, after the records kept following `cursor`.
+
+		A `dropped` event tells how many records were dropped because the client read too slowly.
+		A comment is sent after `_STREAM_KEEP_ALIVE_INTERVAL` seconds without records, so that
+		the stream ends soon after the client disconnects.
+
+		"""
+		subscription_id = self._history.subscribe(method, path, status_code, _STREAM_MAX_QUEUED_RECORDS)
+		try:
+			last_sequence = -1
+			if cursor is not None:
+				# Records appended since subscribing are queued too and skipped by sequence
+				last_sequence = cursor
+				before_sequence = self._history.request_count()
+				while True:
+					request_records = self._history.find_records(
+						method,
+						path,
+						status_code,
+						after_sequence=last_sequence,
+						before_sequence=before_sequence,
+						limit=_RECORD_PAGE_SIZE
+					)
+					if not request_records:
+						break
+					yield self._encode_record_events(request_records, fields)
+					last_sequence = request_records[-1].sequence
+
+			while True:
+				request_records, dropped_count = self._history.next_records(subscription_id, _STREAM_KEEP_ALIVE_INTERVAL)
+				request_records = [record for record in request_records if record.sequence > last_sequence]
+				events = self._encode_record_events(request_records, fields)
+				if request_records:
+					last_sequence = request_records[-1].sequence
+				if dropped_count:
+					dropped_json = {"dropped": dropped_count, "cursor": str(last_sequence)}
+					events += f'event: dropped\ndata: {json.dumps(dropped_json)}\n\n'.encode('utf-8')
+
+				yield events or b': keep-alive\n\n'
+		finally:
+			self._history.unsubscribe(subscription_id)
+
+
+	def _encode_record_events(self, request_records: List[RequestRecord], fields: Optional[List[str]]) -> bytes:
+
+		return ''.join(
+			f'id: {request_record.sequence}\nevent: record\n'
+			f'data: {json.dumps(self._create_request_record_json(request_record, fields))}\n\n'
+			for request_record in request_records
+		).encode('utf-8')
+
+
+	@staticmethod
+	def _create_request_record_json(request_record: RequestRecord, fields: Optional[List[str]] = None) -> dict:
+		"""Returns the JSON of a record. Without `fields`, path-params and generation are listed if set. """
+
+		record_json = {}
+		if fields is None or 'sequence' in fields:
+			record_json['sequence'] = request_record.sequence
+		if fields is None or 'date-time' in fields:
+			# E.g. 2023-10-02T21:48:16Z
+			record_json['date-time'] = request_record.timestamp.isoformat(sep='T', timespec='seconds') + 'Z'
+		if fields is None or 'request' in fields:
+			record_json['request'] = (
+				f'{request_record.request.method} {request_record.request.path} '
+				f'{_body_text(request_record.request.body)}'
+			)
+		if fields is None or 'response' in fields:
+			record_json['response'] = f'{request_record.response.status_code} {_body_text(request_record.response.body)}'
+		if (request_record.request.path_params if fields is None else 'path-params' in fields):
+			record_json['path-params'] = request_record.request.path_params
+		if (request_record.generation is not None if fields is None else 'generation' in fields):
+			record_json['generation'] = request_record.generation
+
+		return record_json
 
 
 	def _request_count(self, request: HTTPRequest) -> HTTPResponse:	# pylint: disable=unused-argument
+		"""GET /request-count
+
+		With a `timeout`, waits until the count is at least `min` (1 by default).
+
+		"""
+		try:
+			timeout = _parse_timeout(request.query, self._allow_waits)
+			minimum = _parse_int_query_param(request.query, 'min', 0)
+		except ValueError as e:
+			return self._create_invalid_query_param_response(e)
+		if minimum is None:
+			minimum = 1
 
 		method = request.query.get('method')
 		path = request.query.get('path')
@@ -276,8 +989,9 @@ class AppHandler():
 				method_called = method[0]
 				path_called = path[0]
 				endpoint_called = (method_called, path_called)
-				count = self._history.request_count(endpoint_called)
-				response = self._create_call_count_response(count, endpoint_called)
+				count = self._history.wait_request_count(endpoint_called, minimum, timeout)
+				evicted = self._history.evicted_count(endpoint_called) > 0
+				response = self._create_call_count_response(count, evicted, endpoint_called)
 			else:
 				response = self._create_missing_query_param_response(KeyError('path'))
 		else:
@@ -285,18 +999,23 @@ class AppHandler():
 				response = self._create_missing_query_param_response(KeyError('method'))
 			else:
 				# Total call count
-				count = self._history.request_count()
-				response = self._create_call_count_response(count)
+				count = self._history.wait_request_count(None, minimum, timeout)
+				evicted = self._history.evicted_count() > 0
+				response = self._create_call_count_response(count, evicted)
 
 		return response
 
 
 	@staticmethod
-	def _create_call_count_response(count: int, endpoint: Optional[Tuple[str, str]] = None) -> HTTPResponse:
+	def _create_call_count_response(
+			count: int,
+			evicted: bool,
+			endpoint: Optional[Tuple[str, str]] = None) -> HTTPResponse:
 
 		body = {
 			"status": 200,
-			"request_count": count
+			"request_count": count,
+			"evicted": evicted
 		}
 		if endpoint:
 			body['method'] = endpoint[0]
@@ -326,11 +1045,42 @@ class AppHandler():
 		return HTTPResponse(status_code, headers, body)
 
 
+	@staticmethod
+	def _create_regex_error_response(assert_request: HTTPRequest, e: RegexError) -> HTTPResponse:
+
+		status_code = 400
+		headers = ContentType.APPLICATION_JSON_ERROR
+		body = {
+			"status": status_code,
+			"type": "regex-error",
+			"title": f"Regex assertion request {assert_request.method} {assert_request.path} failed",
+			"detail": f"{e.__class__.__name__}: {e}"
+		}
+
+		return HTTPResponse(status_code, headers, body)
+
+
+	@staticmethod
+	def _create_jsonpath_error_response(assert_request: HTTPRequest, e: JSONPathError) -> HTTPResponse:
+
+		status_code = 400
+		headers = ContentType.APPLICATION_JSON_ERROR
+		body = {
+			"status": status_code,
+			"type": "jsonpath-error",
+			"title": f"JSONPath assertion request {assert_request.method} {assert_request.path} failed",
+			"detail": f"{e.__class__.__name__}: {e}"
+		}
+
+		return HTTPResponse(status_code, headers, body)
+
+
 	@staticmethod
 	def _create_assertion_success_response(
 			assert_request: HTTPRequest,
 			endpoint_called: Tuple[str, str],
-			request_count: int) -> HTTPResponse:
+			request_count: int,
+			evicted: Optional[bool] = None) -> HTTPResponse:
 
 		status_code = 200
 		headers = {'Content-Type': 'application/json'}
@@ -340,6 +1090,8 @@ class AppHandler():
 			"title": f"Assertion request {assert_request.method} {assert_request.path} succeeded",
 			"detail": f"{endpoint_called[0]} {endpoint_called[1]} called {request_count} times."
 		}
+		if evicted is not None:
+			body['evicted'] = evicted
 
 		return HTTPResponse(status_code, headers, body)
 
@@ -348,7 +1100,8 @@ class AppHandler():
 			assert_request: HTTPRequest,
 			endpoint_called: Tuple[str, str],
 			expected_call_count: int,
-			request_count: int) -> HTTPResponse:
+			request_count: int,
+			evicted: Optional[bool] = None) -> HTTPResponse:
 
 		status_code = 409
 		headers = {'Content-Type': 'application/json+error'}
@@ -358,10 +1111,27 @@ class AppHandler():
 			"title": f"Assertion request {assert_request.method} {assert_request.path} failed",
 			"detail": f"Expected {endpoint_called[0]} {endpoint_called[1]} to be called {expected_call_count} times. Called {request_count} times."
 		}
+		if evicted is not None:
+			body['evicted'] = evicted
 
 		return HTTPResponse(status_code, headers, body)
 
 
+	@staticmethod
+	def _create_invalid_query_param_response(value_error: ValueError) -> HTTPResponse:
+
+		return HTTPResponse(
+			400,
+			headers={'Content-Type': 'application/json+error'},
+			body={
+				"status": 400,
+				"type": "invalid-query-param",
+				"title": "Invalid query parameter",
+				"detail": f"{value_error}"
+			}
+		)
+
+
 	@staticmethod
 	def _create_missing_query_param_response(key_error: KeyError) -> HTTPResponse:
 
@@ -375,3 +1145,136 @@ class AppHandler():
 				"detail": f"Query parameter `{key_error}` not found."
 			}
 		)
+
+
+def _accepts_gzip(accept_encoding: Optional[str]) -> bool:
+	"""Returns True if the Accept-Encoding header value accepts the gzip content coding. """
+
+	if not accept_encoding:
+		return False
+
+	for item in accept_encoding.split(','):
+		coding, _, params = item.partition(';')
+		if coding.strip().lower() in ('gzip', 'x-gzip'):
+			name, _, value = params.partition('=')
+			if name.strip() != 'q':
+				return True
+			try:
+				return float(value) > 0
+			except ValueError:
+				return False
+
+	return False
+
+
+def _body_text(body: Union[dict, str, bytes]) -> str:
+	"""Returns a body as text for the history API. Bodies which are not UTF-8 text are summarized by their size. """
+
+	if isinstance(body, bytes):
+		try:
+			return body.decode('utf-8')
+		except UnicodeDecodeError:
+			return f'<{len(body)} bytes>'
+
+	return f'{body}'
+
+
+def _elapsed_ms(started: float) -> float:
+	"""Returns the milliseconds elapsed since the `time.perf_counter()` value `started`. """
+
+	return round((time.perf_counter() - started) * 1000, 3)
+
+
+def _parse_int_query_param(query: dict, name: str, minimum: int) -> Optional[int]:
+	"""Returns the integer value of a query parameter or None if it is missing.
+
+	Raises:
+		ValueError	If the value is not an integer or is less than `minimum`.
+
+	"""
+	values = query.get(name)
+	if not values:
+		return None
+
+	try:
+		number = int(values[0])
+	except ValueError:
+		number = minimum - 1
+	if number < minimum:
+		raise ValueError(f"Query parameter `{name}` must be an integer not less than {minimum} but it is '{values[0]}'.")
+
+	return number
+
+
+def _parse_fields(query: dict) -> Optional[List[str]]:
+	"""Returns the record fields listed by the `fields` query parameter or None if it is missing.
+
+	Raises:
+		ValueError	If a field is unknown.
+
+	"""
+	if 'fields' not in query:
+		return None
+
+	fields = [field.strip() for value in query['fields'] for field in value.split(',') if field.strip()]
+	for field in fields:
+		if field not in _RECORD_FIELDS:
+			raise ValueError(f"Query parameter `fields` must list fields of {', '.join(_RECORD_FIELDS)} but it lists '{field}'.")
+
+	return fields
+
+
+def _parse_timeout(query: dict, allow_waits: bool = True) -> float:
+	"""Returns the seconds of the `timeout` query parameter or 0 if it is missing.
+
+	Raises:
+		ValueError	If the value is not a number of seconds between 0 and MAX_ASSERTION_TIMEOUT,
+				or is not 0 and `allow_waits` is False.
+
+	"""
+	values = query.get('timeout')
+	if not values:
+		return 0.0
+
+	try:
+		timeout = float(values[0])
+	except ValueError:
+		timeout = -1.0
+	# Also rejects nan
+	if not 0 <= timeout <= MAX_ASSERTION_TIMEOUT:
+		raise ValueError(
+			f"Query parameter `timeout` must be a number of seconds between 0 and {MAX_ASSERTION_TIMEOUT:g} but it is '{values[0]}'."
+		)
+	if timeout and not allow_waits:
+		raise ValueError('Query parameter `timeout` is not supported by servers handling one request at a time.')
+
+	return timeout
+
+
+def _parse_date_time(name: str, value: Optional[str]) -> Optional[datetime]:
+	"""Returns the datetime of an ISO 8601 query parameter value, e.g. 2023-10-02T21:48:16Z.
+
+	Raises:
+		ValueError	If the value is invalid.
+
+	"""
+	if value is None:
+		return None
+
+	# datetime.fromisoformat() accepts the Z suffix as of python 3.11
+	iso_value = value[:-1] + '+00:00' if value.endswith(('Z', 'z')) else value
+	try:
+		return datetime.fromisoformat(iso_value)
+	except ValueError as e:
+		raise ValueError(f"Query parameter `{name}` must be an ISO 8601 date-time but it is '{value}'.") from e
+
+
+def _parse_http_date(value: Optional[str]) -> float:
+	"""Returns the timestamp of an HTTP date or -1 if it is missing or invalid. """
+
+	if not value:
+		return -1
+	try:
+		return email.utils.parsedate_to_datetime(value).timestamp()
+	except (TypeError, ValueError):
+		return -1
@@ -0,0 +1,436 @@
+from typing import Optional, Tuple, Deque, Union
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+import asyncio
+import http.client
+import io
+import logging
+import threading
+import urllib.parse
+from .request import (
+	HTTPRequest,
+	HTTPResponse,
+	StreamingResponse,
+	ContentType,
+	LAST_CHUNK,
+	encode_chunk,
+	http_date
+)
+from .app_handler import AppHandler
+
+
+DEFAULT_IDLE_TIMEOUT = 60.0
+DEFAULT_MAX_LONG_POLLS = 64
+
+_MAX_HEADER_BYTES = 65536
+MAX_BODY_BYTES = 64 * 1024 * 1024
+_MAX_PENDING_REQUESTS = 64
+_BODY_METHODS = ('PUT', 'POST', 'PATCH')
+
+
+class BadRequest(Exception):
+	def __init__(self, status_code: int, message: str):
+		super().__init__(message)
+		self.status_code = status_code
+
+
+class HTTPProtocol(asyncio.Protocol):
+	"""HTTP/1.1 connection served by the asyncio engine.
+
+	Parses the requests received on the connection and passes them to `AppHandler.handle_request()`.
+	Supports keep-alive, pipelining and closes the connection after `idle_timeout` seconds without
+	activity.
+
+	Test requests are answered inline, unless `inline_test_requests` is False. API requests run in
+	the event loop's executor so that long assertions don't block the other connections. API
+	requests that may wait for requests, i.e. with a `timeout`, and history streams run in the
+	`long_poll_executor` instead, so that waiting assertions never hold the threads of the other API
+	requests. Pipelined requests are answered in order. Streaming responses are produced in the
+	executor of their request, one chunk at a time, and wait for the transport's write buffer to drain.
+
+	"""
+	def __init__(
+			self,
+			app_handler: AppHandler,
+			server_version: str,
+			idle_timeout: float,
+			long_poll_executor: Optional[Executor] = None,
+			inline_test_requests: bool = True):
+
+		self._app_handler = app_handler
+		self._long_poll_executor = long_poll_executor
+		self._inline_test_requests = inline_test_requests
+		self._server_version = server_version
+		self._idle_timeout = idle_timeout
+		self._loop = asyncio.get_running_loop()
+		self._transport: Optional[asyncio.Transport] = None
+		self._buffer = bytearray()
+		self._pending: Deque[Tuple[HTTPRequest, bool]] = deque()
+		self._task: Optional[asyncio.Task] = None
+		self._idle_handle: Optional[asyncio.TimerHandle] = None
+		self._closing = False
+		self._reading_paused = False
+		self._writable = asyncio.Event()
+		self._writable.set()
+
+
+	def connection_made(self, transport: asyncio.Transport):
+
+		self._transport = transport
+		self._reset_idle_timer()
+
+
+	def connection_lost(self, exc: Optional[Exception]):
+
+		self._closing = True
+		if self._idle_handle:
+			self._idle_handle.cancel()
+		if self._task:
+			self._task.cancel()
+		self._writable.set()
+
+
+	def pause_writing(self):
+
+		self._writable.clear()
+
+
+	def resume_writing(self):
+
+		self._writable.set()
+
+
+	def data_received(self, data: bytes):
+
+		if self._closing:
+			return
+
+		self._buffer += data
+		self._reset_idle_timer()
+
+		while not self._closing:
+			try:
+				parsed = self._parse_request()
+			except BadRequest as e:
+				self._pending.append((e, False))
+				self._closing = True
+				break
+
+			if parsed is None:
+				break
+
+			self._pending.append(parsed)
+
+		if len(self._pending) > _MAX_PENDING_REQUESTS and not self._reading_paused:
+			self._transport.pause_reading()
+			self._reading_paused = True
+
+		self._process_pending()
+
+
+	def _parse_request(self) -> Optional[Tuple[HTTPRequest, bool]]:
+		"""Parses the next request of the buffer.
+
+		Returns:
+			(HTTPRequest, keep_alive) or None if the buffer does not hold a complete request yet.
+
+		Raises:
+			BadRequest
+
+		"""
+		header_end = self._buffer.find(b'\r\n\r\n')
+		if header_end < 0:
+			if len(self._buffer) > _MAX_HEADER_BYTES:
+				raise BadRequest(431, 'Request header fields too large')
+			return None
+
+		request_line_end = self._buffer.find(b'\r\n')
+		request_line = bytes(self._buffer[:request_line_end]).decode('latin-1')
+		try:
+			method, target, version = request_line.split(' ')
+		except ValueError as e:
+			raise BadRequest(400, f'Bad request line {request_line!r}') from e
+
+		if version not in ('HTTP/1.1', 'HTTP/1.0'):
+			raise BadRequest(505, f'{version} not supported')
+
+		headers = http.client.parse_headers(io.BytesIO(bytes(self._buffer[request_line_end + 2:header_end + 4])))
+
+		body_start = header_end + 4
+		if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+			chunked = self._parse_chunked_body(body_start)
+			if chunked is None:
+				return None
+			body, body_end = chunked
+		else:
+			try:
+				content_length = int(headers.get('Content-Length', 0))
+			except ValueError as e:
+				raise BadRequest(400, 'Bad Content-Length') from e
+			if content_length < 0:
+				raise BadRequest(400, 'Bad Content-Length')
+			if content_length > MAX_BODY_BYTES:
+				raise BadRequest(413, 'Content too large')
+
+			body_end = body_start + content_length
+			if len(self._buffer) < body_end:
+				return None
+			body = bytes(self._buffer[body_start:body_end])
+
+		del self._buffer[:body_end]
+
+		connection = headers.get('Connection', '').lower()
+		if version == 'HTTP/1.1':
+			keep_alive = connection != 'close'
+		else:
+			keep_alive = connection == 'keep-alive'
+
+		parse_result = urllib.parse.urlparse(target)
+		query = urllib.parse.parse_qs(parse_result.query)
+
+		try:
+			# DELETE requests may have a body too
+			if method in _BODY_METHODS or method == 'DELETE' and body:
+				if not body and 'Content-Length' not in headers:
+					raise BadRequest(400, f'{method} without body')
+				request = HTTPRequest(method, parse_result.path, query, headers, body)
+			else:
+				request = HTTPRequest(method, parse_result.path, query, headers)
+		except TypeError as e:
+			raise BadRequest(501, f'Unsupported method ({method!r})') from e
+
+		return request, keep_alive
+
+
+	def _parse_chunked_body(self, start: int) -> Optional[Tuple[bytes, int]]:
+
+		body = bytearray()
+		position = start
+		while True:
+			size_end = self._buffer.find(b'\r\n', position)
+			if size_end < 0:
+				return None
+			try:
+				size = int(bytes(self._buffer[position:size_end]).split(b';')[0], 16)
+			except ValueError as e:
+				raise BadRequest(400, 'Bad chunk size') from e
+
+			if size == 0:
+				# The last chunk is followed by an optional trailer section and an empty line
+				if len(self._buffer) < size_end + 4:
+					return None
+				if self._buffer[size_end + 2:size_end + 4] == b'\r\n':
+					return bytes(body), size_end + 4
+				trailer_end = self._buffer.find(b'\r\n\r\n', size_end + 2)
+				if trailer_end < 0:
+					return None
+				return bytes(body), trailer_end + 4
+
+			if len(body) + size > MAX_BODY_BYTES:
+				raise BadRequest(413, 'Content too large')
+			chunk_start = size_end + 2
+			chunk_end = chunk_start + size
+			if len(self._buffer) < chunk_end + 2:
+				return None
+			body += self._buffer[chunk_start:chunk_end]
+			position = chunk_end + 2
+
+
+	def _process_pending(self):
+
+		while self._pending and self._task is None and not self._transport.is_closing():
+			request, keep_alive = self._pending.popleft()
+			if isinstance(request, BadRequest):
+				self._write_response(self._create_error_response(request.status_code, str(request)), False)
+			elif not self._inline_test_requests or self._app_handler.is_api_request(request):
+				self._task = self._loop.create_task(self._handle_request_in_executor(request, keep_alive))
+			else:
+				self._write_response(self._handle_request(request), keep_alive)
+
+		if self._reading_paused and len(self._pending) <= _MAX_PENDING_REQUESTS // 2:
+			self._transport.resume_reading()
+			self._reading_paused = False
+
+
+	async def _handle_request_in_executor(self, request: HTTPRequest, keep_alive: bool):
+
+		executor = self._long_poll_executor if self._app_handler.is_long_poll(request) else None
+		response = await self._loop.run_in_executor(executor, self._handle_request, request)
+		if isinstance(response, StreamingResponse):
+			keep_alive = await self._write_streaming_response(response, keep_alive, executor)
+			# Not reached if the connection is lost while a chunk is produced. The chunks are then
+			# closed once they are collected.
+			response.close()
+			self._task = None
+			self._end_response(keep_alive)
+		else:
+			self._task = None
+			self._write_response(response, keep_alive)
+		self._reset_idle_timer()
+		self._process_pending()
+
+
+	async def _write_streaming_response(
+			self,
+			response: StreamingResponse,
+			keep_alive: bool,
+			executor: Optional[Executor] = None) -> bool:
+		"""Writes the head and the chunks of `response` as they are produced in `executor`.
+
+		Returns:
+			keep_alive (bool)	False if producing a chunk failed and the connection must be closed
+				without the last chunk.
+
+		"""
+		extra_headers = f'Server: {self._server_version}\r\nDate: {http_date()}\r\n'
+		if not keep_alive:
+			extra_headers += 'Connection: close\r\n'
+		self._transport.write(response.head(extra_headers.encode('latin-1')))
+
+		while True:
+			try:
+				chunk = await self._loop.run_in_executor(executor, next, response.chunks, None)
+			except Exception as e:	# pylint: disable=broad-except
+				logging.exception('`%s` was raised while streaming the response', e.__class__.__name__)
+				return False
+			if chunk is None:
+				if not self._transport.is_closing():
+					self._transport.write(LAST_CHUNK)
+				return keep_alive
+			if chunk and not self._transport.is_closing():
+				self._transport.write(encode_chunk(chunk))
+				await self._writable.wait()
+
+
+	def _handle_request(self, request: HTTPRequest) -> Union[HTTPResponse, StreamingResponse]:
+
+		try:
+			return self._app_handler.handle_request(request)
+		except Exception as e:	# pylint: disable=broad-except
+			logging.exception('`%s` was raised while handling %s %s', e.__class__.__name__, request.method, request.path)
+			return self._create_error_response(500, f'{e.__class__.__name__}: {e}')
+
+
+	def _write_response(self, response: HTTPResponse, keep_alive: bool):
+
+		if self._transport.is_closing():
+			return
+
+		extra_headers = f'Server: {self._server_version}\r\nDate: {http_date()}\r\n'
+		if not keep_alive:
+			extra_headers += 'Connection: close\r\n'
+
+		self._transport.writelines(response.compile().buffers(extra_headers.encode('latin-1')))
+		self._end_response(keep_alive)
+
+
+	def _end_response(self, keep_alive: bool):
+
+		if self._transport.is_closing():
+			return
+
+		if not keep_alive:
+			self._closing = True
+			self._pending.clear()
+			self._transport.close()
+
+
+	def _reset_idle_timer(self):
+
+		if self._idle_handle:
+			self._idle_handle.cancel()
+		self._idle_handle = self._loop.call_later(self._idle_timeout, self._on_idle_timeout)
+
+
+	def _on_idle_timeout(self):
+
+		if self._task is not None or self._pending:
+			self._reset_idle_timer()
+		else:
+			self._closing = True
+			self._transport.close()
+
+
+	@staticmethod
+	def _create_error_response(status_code: int, message: str) -> HTTPResponse:
+
+		return HTTPResponse(
+			status_code,
+			ContentType.APPLICATION_JSON_ERROR,
+			{
+				"status": status_code,
+				"type": "bad-request" if status_code < 500 else "server-error",
+				"message": message
+			}
+		)
+
+
+class AsyncioHTTPServer():
+	"""HTTP server running an asyncio event loop. Same interface as `http.server.HTTPServer`.
+
+	Args:
+		max_long_polls (int):	Maximum number of API requests waiting with a `timeout` and history
+					streams at a time. Further ones wait for one of them to finish.
+		inline_test_requests (bool):	Whether test requests are answered on the event loop.
+					Must be False if answering them blocks, e.g. on IPC.
+
+	"""
+
+	def __init__(
+			self,
+			server_address,
+			app_handler: AppHandler,
+			server_version: str,
+			idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+			backlog: int = 1024,
+			reuse_port: bool = False,
+			max_long_polls: int = DEFAULT_MAX_LONG_POLLS,
+			inline_test_requests: bool = True):
+
+		self._loop = asyncio.new_event_loop()
+		self._long_poll_executor = ThreadPoolExecutor(max_long_polls, thread_name_prefix='mockallan-long-poll')
+		self._stopped = threading.Event()
+		self._stopped.set()
+		host, port = server_address
+		self._server = self._loop.run_until_complete(
+			self._loop.create_server(
+				lambda: HTTPProtocol(
+					app_handler,
+					server_version,
+					idle_timeout,
+					self._long_poll_executor,
+					inline_test_requests
+				),
+				host,
+				port,
+				backlog=backlog,
+				reuse_port=reuse_port or None
+			)
+		)
+		self.server_address = self._server.sockets[0].getsockname()[:2]
+
+
+	def serve_forever(self, poll_interval=0.5):	# pylint: disable=unused-argument
+
+		self._stopped.clear()
+		asyncio.set_event_loop(self._loop)
+		try:
+			self._loop.run_forever()
+		finally:
+			self._stopped.set()
+
+
+	def shutdown(self):
+		"""Stops the serve_forever() loop and waits until it exits. Must be called from another thread. """
+
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._stopped.wait()
+
+
+	def server_close(self):
+
+		self._server.close()
+		self._loop.run_until_complete(self._server.wait_closed())
+		self._loop.close()
+		# Waiting assertions end at their timeout
+		self._long_poll_executor.shutdown(wait=False)
@@ -1,50 +1,466 @@
-from typing import Tuple, List, Union, Optional
-from collections import defaultdict
-from dataclasses import dataclass
+from typing import Any, Deque, Dict, Tuple, List, Union, Optional
+from array import array
+from collections import Counter, deque
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+import dataclasses
+import errno
+import logging
+import os
+import threading
+import time
 from .request import HTTPRequest, HTTPResponse
+from .history_storage import (
+	HistoryStorage,
+	MemoryStorage,
+	DiskStorage,
+	RecordFilter,
+	RequestRecord,
+	to_datetime,
+	to_timestamp_ns
+)
 from .validators import (
 	Validator,
 	IsEqualValidator,
+	JSONPathValidator,
 	JSONSchemaValidator,
 	XMLSchemaValidator,
-	RegexValidator
+	RegexValidator,
+	RegexMatcher,
+	RegexTimeoutError,
+	ValidatorCache,
+	ParsedBodyCache,
+	ValidationPool,
+	BODY_JSON,
+	body_digest,
+	count_regex_matches,
+	parse_body
 )
+from .jsonpath import compile_path
+from .predicates import canonical
 
 
-@dataclass
-class RequestRecord:
-	timestamp: datetime
-	request: HTTPRequest
-	response: HTTPResponse
+# Records queued per subscription by default
+DEFAULT_MAX_QUEUED_RECORDS = 1024
 
+# Schema assertions over at least this many records are validated by a ValidationPool
+_PARALLEL_VALIDATION_MIN_RECORDS = 10000
 
-class History:
+# Index entries of the records appended without field indexes: (JSONPath expressions, (expression, canonical value) keys)
+_NO_FIELD_KEYS: Tuple[Tuple[str, ...], Tuple[Tuple[str, str], ...]] = ((), ())
+
+# The evicted body digests are dropped once this many lead the array, and they are at least half of it
+_DIGEST_COMPACTION_THRESHOLD = 4096
+
+
+class _Subscription():
+	"""Records appended matching the subscription filter, queued until read by `History.next_records()`.
+
+	Once `max_queued` records are queued further ones are dropped and counted.
+
+	"""
+	def __init__(self, method: Optional[str], path: Optional[str], status_code: Optional[int], max_queued: int):
+
+		self.method = method
+		self.path = path
+		self.status_code = status_code
+		self.max_queued = max_queued
+		self.records: Deque[RequestRecord] = deque()
+		self.dropped_count = 0
+
+
+	def matches(self, request: HTTPRequest, response: HTTPResponse) -> bool:
+
+		return (
+			(self.method is None or self.method == request.method.upper())
+			and (self.path is None or self.path == request.path)
+			and (self.status_code is None or self.status_code == response.status_code)
+		)
+
+
+@dataclasses.dataclass(frozen=True)
+class ExpectationResult:
+	"""Number of requests matching an expectation registered with `History.add_expectation()`. """
+
+	expectation_id: int
+	method: str
+	path: str
+	min_count: int
+	max_count: Optional[int]
+	count: int
+
+	@property
+	def satisfied(self) -> bool:
+
+		return self.count >= self.min_count and (self.max_count is None or self.count <= self.max_count)
+
+
+class _Expectation():
+	"""Requests of an endpoint expected to be valid, counted as they are appended.
+
+	Without a validator every request of the endpoint is counted.
 
-	def __init__(self, requests_responses: Optional[List[Tuple[HTTPRequest, HTTPResponse]]] = None):
+	"""
+	def __init__(
+			self,
+			expectation_id: int,
+			endpoint: Tuple[str, str],
+			validator: Optional[Validator],
+			min_count: int,
+			max_count: Optional[int]):
 
-		self._request_records = []
-		self._endpoint_record_mapping = defaultdict(list)
+		self.expectation_id = expectation_id
+		self.endpoint = endpoint
+		self.validator = validator
+		self.min_count = min_count
+		self.max_count = max_count
+		self.count = 0
+
+
+	def result(self) -> ExpectationResult:
+
+		return ExpectationResult(
+			self.expectation_id,
+			self.endpoint[0],
+			self.endpoint[1],
+			self.min_count,
+			self.max_count,
+			self.count
+		)
+
+
+class History:
+	"""Request history. Safe to use from many threads at a time.
+
+	A view over a `HistoryStorage`, which keeps the records in a compact form. Records are copied
+	out of the storage holding the lock and materialized after releasing it. Assertions take a copy of the endpoint records and validate it without
+	holding the lock. Assertions given a timeout wait on a condition notified by `append()` until
+	they hold or the timeout elapses.
+
+	Records are numbered by a sequence starting at 0, so that the sequence of the next record is
+	the request count. Record timestamps never decrease, even if the clock is set back.
+
+	The history may be bounded. Once a bound is exceeded the oldest records are evicted, along with
+	their entries in the per-endpoint indexes. Request counts include the evicted records.
+
+	Schema assertions over many records are validated in chunks by a pool of processes, which
+	stops once the assertion is decided. Regexes are searched in a child process killed once
+	their time limit elapses.
+
+	Equality assertions are answered from an index counting the records kept by endpoint and body
+	digest, so that they don't scan the records. Likewise, the body fields listed in the `index`
+	of a stub endpoint are counted by endpoint, JSONPath expression and value, so that jsonpath
+	assertions on a single field don't scan the records.
+
+	Expectations registered up front are checked as each request is appended, against the
+	expectations of its endpoint only, so that verifying them doesn't read the records.
+
+	Subscriptions receive the records as they are appended, so that followers of the history read
+	each record once. Each subscription queues a bounded number of records; a subscriber reading
+	too slowly has the further ones dropped and is told how many.
+
+	Args:
+		requests_responses (list):	Initial (request, response) tuples.
+		max_records (int):		Maximum number of records kept.
+		max_bytes (int):		Maximum estimated size of the records kept.
+		ttl (float):			Seconds a record is kept.
+		directory (str):		If set, the records spill to a `DiskStorage` log in this directory.
+		storage (HistoryStorage):	Defaults to a new `MemoryStorage` or `DiskStorage`.
+		validation_processes (int):	Processes validating schema assertions over many records.
+						Defaults to the number of CPUs; 1 validates in the
+						asserting thread.
+
+	"""
+	def __init__(
+			self,
+			requests_responses: Optional[List[Tuple[HTTPRequest, HTTPResponse]]] = None,
+			max_records: Optional[int] = None,
+			max_bytes: Optional[int] = None,
+			ttl: Optional[float] = None,
+			directory: Optional[str] = None,
+			storage: Optional[HistoryStorage] = None,
+			validation_processes: Optional[int] = None):
+
+		History.check_options(max_records, max_bytes, ttl)
+
+		self._max_records = max_records
+		self._max_bytes = max_bytes
+		self._ttl_ns = None if ttl is None else int(ttl * 1e9)
+
+		self._lock = threading.Lock()
+		# Notified on every append
+		self._appended = threading.Condition(self._lock)
+		if storage is None:
+			storage = MemoryStorage() if directory is None else DiskStorage(directory)
+		self._storage = storage
+		self._last_timestamp_ns = 0
+		self._request_count = 0
+		self._endpoint_request_counts: Counter = Counter()
+		self._evicted_count = 0
+		self._endpoint_evicted_counts: Counter = Counter()
+		# Body digests of the records kept, from index `_body_digests_head`, and record counts by endpoint and body digest
+		self._body_digests = array('Q')
+		self._body_digests_head = 0
+		self._body_digest_counts: Counter = Counter()
+		# Field index keys of the records kept, oldest first, and record counts by endpoint and expression
+		# and by endpoint, expression and canonical value
+		self._record_field_keys: Deque[Tuple[Tuple[str, ...], Tuple[Tuple[str, str], ...]]] = deque()
+		self._indexed_counts: Counter = Counter()
+		self._field_counts: Counter = Counter()
+		self._subscriptions: Dict[int, _Subscription] = {}
+		self._next_subscription_id = 0
+		# Expectations by endpoint are replaced, never modified, so that `append()` reads them without the lock
+		self._endpoint_expectations: Dict[Tuple[str, str], Tuple[_Expectation, ...]] = {}
+		self._expectations: Dict[int, _Expectation] = {}
+		self._next_expectation_id = 0
+		self._validator_cache = ValidatorCache()
+		self._parsed_bodies = ParsedBodyCache()
+		self._validation_pool = ValidationPool(validation_processes)
+		self._regex_matcher = RegexMatcher()
 		if requests_responses:
 			for request_response in requests_responses:
 				self.append(request_response[0], request_response[1])
 
 
-	def append(self, request: HTTPRequest, response: HTTPResponse):
+	@staticmethod
+	def check_options(
+			max_records: Optional[int] = None,
+			max_bytes: Optional[int] = None,
+			ttl: Optional[float] = None,
+			directory: Optional[str] = None):
+		"""Checks the History arguments without instantiating it.
 
-		record = RequestRecord(datetime.utcnow(), request, response)
+		Raises:
+			ValueError	If a bound is not greater than 0.
+			OSError		If `directory` can't be created or written.
+
+		"""
+		for name, value in (('max_records', max_records), ('max_bytes', max_bytes), ('ttl', ttl)):
+			if value is not None and value <= 0:
+				raise ValueError(f"'{name}' must be greater than 0 but it is {value}")
+
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+			if not os.access(directory, os.W_OK | os.X_OK):
+				raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), directory)
+
+
+	def append(
+			self,
+			request: HTTPRequest,
+			response: HTTPResponse,
+			generation: Optional[int] = None,
+			index: Tuple[str, ...] = ()):
+		"""Records a request and its response.
+
+		Args:
+			request (HTTPRequest):
+			response (HTTPResponse):
+			generation (int):	Generation of the stub configuration that served the request.
+			index (tuple):		Canonical JSONPath expressions of the body fields to index.
+
+		"""
 		endpoint = (request.method, request.path)
+		digest = body_digest(request.body)
+		field_keys = (index, self._field_keys(request.body, index)) if index else _NO_FIELD_KEYS
+		# Requests appended while an expectation is added may not be counted
+		expectations = self._endpoint_expectations.get(endpoint)
+		matched_expectations = self._match_expectations(expectations, request, digest) if expectations else []
+
+		with self._lock:
+			timestamp_ns = self._last_timestamp_ns = max(time.time_ns(), self._last_timestamp_ns)
+			sequence = self._storage.append(timestamp_ns, request, response, generation)
+			self._request_count += 1
+			self._endpoint_request_counts[endpoint] += 1
+			self._body_digests.append(digest)
+			self._body_digest_counts[(endpoint, digest)] += 1
+			self._record_field_keys.append(field_keys)
+			for expression in index:
+				self._indexed_counts[(endpoint, expression)] += 1
+			for key in field_keys[1]:
+				self._field_counts[(endpoint, *key)] += 1
+			for expectation in matched_expectations:
+				expectation.count += 1
+			self._evict(timestamp_ns)
+			if self._subscriptions:
+				self._publish(RequestRecord(to_datetime(timestamp_ns), request, response, generation, sequence))
+			self._appended.notify_all()
+
+
+	def subscribe(
+			self,
+			method: Optional[str] = None,
+			path: Optional[str] = None,
+			status_code: Optional[int] = None,
+			max_queued: int = DEFAULT_MAX_QUEUED_RECORDS) -> int:
+		"""Subscribes to the records appended matching all the given conditions.
+
+		Args:
+			method (str):
+			path (str):
+			status_code (int):	Response status code.
+			max_queued (int):	Maximum number of records queued until read.
+
+		Returns:
+			The subscription id, to be passed to `next_records()` and `unsubscribe()`.
+
+		"""
+		with self._lock:
+			subscription_id = self._next_subscription_id
+			self._next_subscription_id += 1
+			self._subscriptions[subscription_id] = _Subscription(
+				None if method is None else method.upper(),
+				path,
+				status_code,
+				max_queued
+			)
+
+		return subscription_id
+
+
+	def unsubscribe(self, subscription_id: int):
 
-		self._request_records.append(record)
-		self._endpoint_record_mapping[endpoint].append(record)
+		with self._lock:
+			self._subscriptions.pop(subscription_id, None)
+
+
+	def next_records(self, subscription_id: int, timeout: Optional[float] = None) -> Tuple[List[RequestRecord], int]:
+		"""Waits up to `timeout` seconds for records of a subscription and dequeues them.
+
+		Returns:
+			records (List[RequestRecord])	The records queued, oldest first.
+			dropped_count (int)		The number of records dropped since the last call.
+
+		Raises:
+			KeyError	If the subscription does not exist.
+
+		"""
+		with self._appended:
+			subscription = self._subscriptions[subscription_id]
+			self._appended.wait_for(lambda: subscription.records or subscription.dropped_count, timeout)
+			records = list(subscription.records)
+			subscription.records.clear()
+			dropped_count = subscription.dropped_count
+			subscription.dropped_count = 0
+
+		return records, dropped_count
+
+
+	def add_expectation(
+			self,
+			endpoint: Tuple[str, str],
+			request: Optional[HTTPRequest] = None,
+			min_count: int = 1,
+			max_count: Optional[int] = None) -> int:
+		"""Expects the endpoint to be called with `request` from `min_count` to `max_count` times.
+
+		The requests appended from now on are checked against `request`, selecting the validator as
+		`assert_called_with()` does. Without `request` or with an empty body, every request of the
+		endpoint is counted.
+
+		Returns:
+			The expectation id.
+
+		Raises:
+			ValueError	If `min_count` is less than 0 or `max_count` is less than `min_count`.
+			Whatever the validator raises if `request` is not a valid schema or regex.
+
+		"""
+		if min_count < 0:
+			raise ValueError(f"'min_count' must not be less than 0 but it is {min_count}")
+		if max_count is not None and max_count < min_count:
+			raise ValueError(f"'max_count' must not be less than 'min_count' {min_count} but it is {max_count}")
+
+		validator = None
+		if request is not None and request.body not in ('', b'', None):
+			validator = self._resolve_validator(request)
+		endpoint = (endpoint[0].upper(), endpoint[1])
+
+		with self._lock:
+			expectation = _Expectation(self._next_expectation_id, endpoint, validator, min_count, max_count)
+			self._next_expectation_id += 1
+			self._expectations[expectation.expectation_id] = expectation
+			self._endpoint_expectations[endpoint] = self._endpoint_expectations.get(endpoint, ()) + (expectation,)
+
+		return expectation.expectation_id
+
+
+	def verify_expectations(self, timeout: Optional[float] = None) -> List[ExpectationResult]:
+		"""Returns the results of the expectations, waiting up to `timeout` seconds for their minimum counts.
+
+		Counts include the requests evicted since.
+
+		"""
+		with self._appended:
+			if timeout:
+				self._appended.wait_for(
+					lambda: all(expectation.count >= expectation.min_count for expectation in self._expectations.values()),
+					timeout
+				)
+
+			return [expectation.result() for expectation in self._expectations.values()]
+
+
+	def clear_expectations(self):
+
+		with self._lock:
+			self._expectations = {}
+			self._endpoint_expectations = {}
 
 
 	def request_count(self, endpoint: Optional[Tuple[str, str]] = None) -> int:
+		"""Returns the number of requests recorded, including the evicted ones. """
+
+		with self._lock:
+			if endpoint is None:
+				return self._request_count
+
+			return self._endpoint_request_counts.get(endpoint, 0)
+
+
+	def wait_request_count(
+			self,
+			endpoint: Optional[Tuple[str, str]] = None,
+			minimum: int = 1,
+			timeout: Optional[float] = None) -> int:
+		"""Waits until at least `minimum` requests are recorded or `timeout` seconds elapse.
+
+		Returns:
+			The number of requests recorded, including the evicted ones.
+
+		"""
+		def request_count() -> int:
 
-		if endpoint is None:
-			return len(self._request_records)
+			if endpoint is None:
+				return self._request_count
 
-		return len(self._endpoint_record_mapping.get(endpoint, []))
+			return self._endpoint_request_counts.get(endpoint, 0)
+
+		with self._appended:
+			self._appended.wait_for(lambda: request_count() >= minimum, timeout)
+
+			return request_count()
+
+
+	def evicted_count(self, endpoint: Optional[Tuple[str, str]] = None) -> int:
+		"""Returns the number of records evicted. """
+
+		with self._lock:
+			self._evict_expired()
+
+			if endpoint is None:
+				return self._evicted_count
+
+			return self._endpoint_evicted_counts.get(endpoint, 0)
+
+
+	def close(self):
+		"""Releases the storage and the validation processes. E.g. stops the writer thread and deletes the log of a DiskStorage. """
+
+		with self._lock:
+			self._storage.close()
+		self._validation_pool.close()
+		self._regex_matcher.close()
 
 
 	def request_body(self) -> Tuple[str, Union[dict, str, bytes]]:
@@ -58,82 +474,475 @@ class History:
 			AssertionError	If no request was recorded yet.
 
 		"""
-		try:
-			request = self._request_records[-1].request
-		except IndexError as e:
-			raise AssertionError('No requests') from e
+		with self._lock:
+			self._evict_expired()
+			stored_record = self._storage.last()
+
+		if stored_record is None:
+			raise AssertionError('No requests')
+
+		record, = self._storage.materialize([stored_record])
 
-		return request.headers.get('Content-Type'), request.body
+		return record.request.headers.get('Content-Type'), record.request.body
 
 
 	def request_body_list(self)-> List[RequestRecord]:
 
-		return self._request_records
+		with self._lock:
+			self._evict_expired()
+			stored_records = self._storage.records()
+
+		return self._storage.materialize(stored_records)
+
+
+	def find_records(
+			self,
+			method: Optional[str] = None,
+			path: Optional[str] = None,
+			status_code: Optional[int] = None,
+			since: Optional[datetime] = None,
+			until: Optional[datetime] = None,
+			after_sequence: Optional[int] = None,
+			before_sequence: Optional[int] = None,
+			limit: Optional[int] = None) -> List[RequestRecord]:
+		"""Returns the records kept matching all the given conditions, oldest first.
+
+		Args:
+			method (str):
+			path (str):
+			status_code (int):	Response status code.
+			since (datetime):	Minimum timestamp. Naive datetimes are UTC.
+			until (datetime):	Timestamp the records must be older than.
+			after_sequence (int):	Sequence the records must be newer than.
+			before_sequence (int):	Sequence the records must be older than.
+			limit (int):		Maximum number of records returned.
+
+		"""
+		record_filter = RecordFilter(
+			None if method is None else method.upper(),
+			path,
+			status_code,
+			None if since is None else to_timestamp_ns(since),
+			None if until is None else to_timestamp_ns(until),
+			after_sequence,
+			before_sequence
+		)
+
+		with self._lock:
+			self._evict_expired()
+			stored_records = self._storage.find(record_filter, limit)
+
+		return self._storage.materialize(stored_records)
+
+
+	def validator_cache_stats(self) -> dict:
+		"""Returns the statistics of the cache of the schema validators compiled for the assertions,
+		with those of the cache of the parsed record bodies as `parsed_bodies`.
+
+		"""
+		return {**self._validator_cache.stats(), "parsed_bodies": self._parsed_bodies.stats()}
 
 
-	def assert_called(self, endpoint: Tuple[str, str]):
-		"""Assert that the endpoint was called at least once. """
+	def assert_called(self, endpoint: Tuple[str, str], timeout: Optional[float] = None):
+		"""Assert that the endpoint was called at least once, waiting up to `timeout` seconds. """
 
-		if self._endpoint_record_mapping.get(endpoint) is None:
+		if self.wait_request_count(endpoint, 1, timeout or 0) == 0:
 			raise AssertionError('Not called')
 
 
-	def assert_called_once(self, endpoint: Tuple[str, str]):
-		"""Assert that the mock was called exactly once. """
+	def assert_called_once(self, endpoint: Tuple[str, str], timeout: Optional[float] = None):
+		"""Assert that the mock was called exactly once, waiting up to `timeout` seconds for the call. """
 
-		records = self._endpoint_record_mapping.get(endpoint)
-		if records is None:
+		request_count = self.wait_request_count(endpoint, 1, timeout or 0)
+		if request_count == 0:
 			raise AssertionError('Not called')
 
-		if len(records) > 1:
+		if request_count > 1:
 			raise AssertionError('Called more than once')
 
 
-	def assert_called_with(self, endpoint: Tuple[str, str], request: HTTPRequest):
+	def assert_called_with(self, endpoint: Tuple[str, str], request: HTTPRequest, timeout: Optional[float] = None):
+		"""Assert that the endpoint was called with `request`, waiting up to `timeout` seconds. """
 
-		records = self._endpoint_record_mapping.get(endpoint)
-		if records is None:
+		validator = self._resolve_validator(request)
+		if timeout:
+			self._wait_called_with(endpoint, validator, request, timeout)
+			return
+
+		match_count = self._index_count(endpoint, validator)
+		if match_count is None:
+			records = self._endpoint_records(endpoint)
+			match_count = 0 if records is None else self._count_valid(validator, request, records, 1)
+		if match_count == 0:
 			raise AssertionError('Not called')
 
+
+	def assert_called_once_with(
+			self,
+			endpoint: Tuple[str, str],
+			request: HTTPRequest,
+			timeout: Optional[float] = None):
+		"""Assert that the endpoint was called once with `request`, waiting up to `timeout` seconds for the call. """
+
 		validator = self._resolve_validator(request)
-		for record in records:
-			if validator.validate(record.request):
+		if timeout:
+			self._wait_called_with(endpoint, validator, request, timeout)
+
+		match_count = self._index_count(endpoint, validator)
+		if match_count is None:
+			records = self._endpoint_records(endpoint)
+			match_count = 0 if records is None else self._count_valid(validator, request, records, 2)
+		if match_count == 0:
+			raise AssertionError('Not called')
+		if match_count > 1:
+			raise AssertionError('Called more than once')
+
+
+	def match_counts(
+			self,
+			endpoint: Tuple[str, str],
+			validation_requests: List[HTTPRequest],
+			limit: Optional[int] = None) -> List[int]:
+		"""Returns the number of records kept of the endpoint valid for each validation request.
+
+		The records are read and validated in one pass for all the validation requests. Counts stop
+		at `limit`, and the pass ends once every count reached it. The regexes are searched
+		together, within the longest of their time limits.
+
+		Raises:
+			RegexTimeoutError	If searching the regexes takes longer than their time limit.
+			Whatever a validator raises if its validation request is not a valid schema or regex.
+
+		"""
+		validators = [self._resolve_validator(validation_request) for validation_request in validation_requests]
+		counts = [0] * len(validators)
+		pending = []
+		regex_indexes = []
+		for index, validator in enumerate(validators):
+			count = self._index_count(endpoint, validator)
+			if count is not None:
+				counts[index] = count if limit is None else min(count, limit)
+			elif isinstance(validator, RegexValidator):
+				regex_indexes.append(index)
+			else:
+				pending.append(index)
+
+		records = self._endpoint_records(endpoint) if pending or regex_indexes else None
+		if regex_indexes and records:
+			regex_counts = self._count_regex_matches(
+				[validators[index] for index in regex_indexes],
+				[record.request.body for record in records],
+				limit
+			)
+			for index, count in zip(regex_indexes, regex_counts):
+				counts[index] = count
+
+		if pending:
+			for record in records or ():
+				for index in list(pending):
+					if self._validate(validators[index], record):
+						counts[index] += 1
+						if counts[index] == limit:
+							pending.remove(index)
+				if not pending:
+					break
+
+		return counts
+
+
+	def _wait_called_with(
+			self,
+			endpoint: Tuple[str, str],
+			validator: Validator,
+			validation_request: HTTPRequest,
+			timeout: float):
+		"""Waits until a record of the endpoint is valid or `timeout` seconds elapse.
+
+		Each record is validated once, as it is appended, without holding the lock.
+
+		Raises:
+			AssertionError	If no valid record was found within the timeout.
+
+		"""
+		if isinstance(validator, IsEqualValidator):
+			with self._appended:
+				key = (endpoint, validator.digest)
+				if not self._appended.wait_for(lambda: self._body_digest_counts.get(key, 0) > 0, timeout):
+					raise AssertionError('Not called')
+			return
+
+		deadline = time.monotonic() + timeout
+		record_filter = RecordFilter(endpoint[0].upper(), endpoint[1])
+		while True:
+			with self._lock:
+				self._evict_expired()
+				request_count = self._endpoint_request_counts.get(endpoint, 0)
+				stored_records = self._storage.find(record_filter)
+
+			records = self._storage.materialize(stored_records)
+			if self._count_valid(validator, validation_request, records, 1):
 				return
+			if records:
+				record_filter = dataclasses.replace(record_filter, after_sequence=records[-1].sequence)
 
-		raise AssertionError('Not called')
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or self.wait_request_count(endpoint, request_count + 1, remaining) <= request_count:
+				raise AssertionError('Not called')
 
 
-	def assert_called_once_with(self, endpoint: Tuple[str, str], request: HTTPRequest):
+	def _count_valid(
+			self,
+			validator: Validator,
+			validation_request: HTTPRequest,
+			records: List[RequestRecord],
+			limit: int) -> int:
+		"""Returns the number of records valid, counting up to `limit`.
 
-		match_count = 0
+		Many records are validated by the validation pool if the validator parses bodies, or in this
+		thread if the pool can't be used. Regexes are searched by the regex matcher.
 
-		records = self._endpoint_record_mapping.get(endpoint)
-		if records is None:
-			raise AssertionError('Not called')
+		Raises:
+			RegexTimeoutError	If searching the regex takes longer than its time limit.
 
-		validator = self._resolve_validator(request)
+		"""
+		if not records:
+			return 0
+
+		if isinstance(validator, RegexValidator):
+			return self._count_regex_matches([validator], [record.request.body for record in records], limit)[0]
+
+		if (validator.body_format is not None
+				and len(records) >= _PARALLEL_VALIDATION_MIN_RECORDS
+				and self._validation_pool.max_workers > 1):
+			try:
+				return self._validation_pool.count_valid(
+					type(validator),
+					validation_request,
+					[record.request.body for record in records],
+					limit
+				)
+			except (BrokenProcessPool, OSError) as e:
+				logging.warning('Validating in this thread, since the validation pool failed: %s', e)
+				self._validation_pool.close()
+
+		count = 0
 		for record in records:
-			if validator.validate(record.request):
-				match_count += 1
-				if match_count > 1:
-					raise AssertionError('Called more than once')
-		if match_count == 0:
-			raise AssertionError('Not called')
+			if self._validate(validator, record):
+				count += 1
+				if count == limit:
+					break
+
+		return count
+
+
+	def _count_regex_matches(self, validators: List[RegexValidator], bodies: List[Any], limit: Optional[int]) -> List[int]:
+		"""Returns the number of bodies each regex is found in, counting up to `limit`.
+
+		The regexes are searched by the regex matcher within the longest of their time limits, or
+		in this thread if the matcher can't be used.
+
+		Raises:
+			RegexTimeoutError	If searching the regexes takes longer than their time limit.
+
+		"""
+		patterns = [validator.pattern for validator in validators]
+		try:
+			return self._regex_matcher.count_matches(patterns, bodies, limit, max(validator.time_limit for validator in validators))
+		except OSError as e:
+			logging.warning('Searching in this thread, since the regex matcher failed: %s', e)
+
+		return count_regex_matches(patterns, bodies, limit)
+
+
+	def _index_count(self, endpoint: Tuple[str, str], validator: Validator) -> Optional[int]:
+		"""Returns the number of records kept of the endpoint valid for the validator, from the
+		indexes, or None if the indexes can't tell.
+
+		A field index tells only about the records appended while the field was indexed. It tells
+		the count of a jsonpath validator checking one field, or that no record is valid if none
+		has the expected value of a field.
+
+		"""
+		if not isinstance(validator, (IsEqualValidator, JSONPathValidator)):
+			return None
+
+		with self._lock:
+			self._evict_expired()
+
+			if isinstance(validator, IsEqualValidator):
+				return self._body_digest_counts.get((endpoint, validator.digest), 0)
+
+			kept_count = self._endpoint_request_counts.get(endpoint, 0) - self._endpoint_evicted_counts.get(endpoint, 0)
+			field_counts = [
+				self._field_counts.get((endpoint, path.expression, value), 0)
+				for path, value in validator.conditions
+				if self._indexed_counts.get((endpoint, path.expression), 0) == kept_count
+			]
+
+		if kept_count == 0 or 0 in field_counts:
+			return 0
+		if len(field_counts) == 1 and len(validator.conditions) == 1:
+			return field_counts[0]
+
+		return None
 
 
 	@staticmethod
-	def _resolve_validator(validation_request: HTTPRequest) -> Validator:
+	def _field_keys(body: Any, index: Tuple[str, ...]) -> Tuple[Tuple[str, str], ...]:
+		"""Returns the (JSONPath expression, canonical value) keys of the indexed fields of a body. """
+
+		try:
+			document = parse_body(BODY_JSON, body)
+		except ValueError:
+			return ()
+
+		return tuple({
+			(expression, canonical(value))
+			for expression in index
+			for value in compile_path(expression).find(document)
+		})
+
+
+	def _endpoint_records(self, endpoint: Tuple[str, str]) -> Optional[List[RequestRecord]]:
+		"""Returns a copy of the endpoint records or None if no record of the endpoint is kept. """
+
+		with self._lock:
+			self._evict_expired()
+			stored_records = self._storage.endpoint_records(endpoint)
+
+		return self._storage.materialize(stored_records) or None
+
+
+	def _match_expectations(
+			self,
+			expectations: Tuple[_Expectation, ...],
+			request: HTTPRequest,
+			digest: int) -> List[_Expectation]:
+		"""Returns the expectations a request being appended is valid for, parsing its body once. """
+
+		invalid = object()
+		documents: Dict[str, Any] = {}
+		matched_expectations = []
+		for expectation in expectations:
+			validator = expectation.validator
+			if validator is None:
+				valid = True
+			elif isinstance(validator, IsEqualValidator):
+				valid = validator.digest == digest
+			elif isinstance(validator, RegexValidator):
+				try:
+					valid = self._count_regex_matches([validator], [request.body], 1) == [1]
+				except RegexTimeoutError as e:
+					logging.warning('Expectation %s not checked: %s', expectation.expectation_id, e)
+					valid = False
+			elif validator.body_format is None:
+				valid = validator.validate(request)
+			else:
+				if validator.body_format not in documents:
+					try:
+						documents[validator.body_format] = parse_body(validator.body_format, request.body)
+					except ValueError:
+						documents[validator.body_format] = invalid
+				document = documents[validator.body_format]
+				valid = document is not invalid and validator.validate_document(document)
+			if valid:
+				matched_expectations.append(expectation)
+
+		return matched_expectations
+
+
+	def _publish(self, record: RequestRecord):
+		"""Queues an appended record in the matching subscriptions. Called holding `_lock`. """
+
+		for subscription in self._subscriptions.values():
+			if subscription.matches(record.request, record.response):
+				if len(subscription.records) < subscription.max_queued:
+					subscription.records.append(record)
+				else:
+					subscription.dropped_count += 1
+
+
+	def _evict(self, now_ns: int):
+		"""Evicts the oldest records while a bound is exceeded. Called holding `_lock`. """
+
+		storage = self._storage
+		expiry_ns = None if self._ttl_ns is None else now_ns - self._ttl_ns
+		while len(storage) and (
+				(self._max_records is not None and len(storage) > self._max_records)
+				or (self._max_bytes is not None and storage.size() > self._max_bytes)
+				or (expiry_ns is not None and storage.oldest_timestamp() < expiry_ns)):
+			endpoint = storage.evict_oldest()
+			self._evicted_count += 1
+			self._endpoint_evicted_counts[endpoint] += 1
+			self._evict_body_digest(endpoint)
+			self._evict_field_keys(endpoint)
+
+
+	def _evict_body_digest(self, endpoint: Tuple[str, str]):
+		"""Drops the body digest of the oldest record, just evicted, from the index. Called holding `_lock`. """
+
+		key = (endpoint, self._body_digests[self._body_digests_head])
+		self._body_digest_counts[key] -= 1
+		if self._body_digest_counts[key] == 0:
+			del self._body_digest_counts[key]
+
+		self._body_digests_head += 1
+		if self._body_digests_head >= _DIGEST_COMPACTION_THRESHOLD and self._body_digests_head * 2 >= len(self._body_digests):
+			del self._body_digests[:self._body_digests_head]
+			self._body_digests_head = 0
+
+
+	def _evict_field_keys(self, endpoint: Tuple[str, str]):
+		"""Drops the field index keys of the oldest record, just evicted. Called holding `_lock`. """
+
+		index, field_keys = self._record_field_keys.popleft()
+		for counts, keys in (
+				(self._indexed_counts, [(endpoint, expression) for expression in index]),
+				(self._field_counts, [(endpoint, *key) for key in field_keys])):
+			for key in keys:
+				counts[key] -= 1
+				if counts[key] == 0:
+					del counts[key]
+
+
+	def _evict_expired(self):
+		"""Evicts the records older than the TTL. Called holding `_lock`. """
+
+		if self._ttl_ns is not None:
+			self._evict(time.time_ns())
+
+
+	def _validate(self, validator: Validator, record: RequestRecord) -> bool:
+		"""Validates the request of a record, parsing its body once for all the assertions. """
+
+		if validator.body_format is None:
+			return validator.validate(record.request)
+
+		try:
+			document = self._parsed_bodies.document(record.sequence, validator.body_format, record.request.body)
+		except ValueError:
+			return False
+
+		return validator.validate_document(document)
+
+
+	def _resolve_validator(self, validation_request: HTTPRequest) -> Validator:
+		"""Returns the validator of an assertion. Schema and jsonpath validators are compiled once per body, regexes once per pattern. """
 
 		validation_content_type = validation_request.headers.get('Content-Type')
 
 		if validation_content_type == 'application/schema+json':
-			return JSONSchemaValidator(validation_request)
+			return self._validator_cache.get(JSONSchemaValidator, validation_request)
 
 		if validation_content_type == 'application/xml':
-			return XMLSchemaValidator(validation_request)
+			return self._validator_cache.get(XMLSchemaValidator, validation_request)
 
 		validator_header = validation_request.headers.get('X-Mockallan-Validator')
 		if validator_header == 'regex':
 			return RegexValidator(validation_request)
 
+		if validator_header == 'jsonpath':
+			return self._validator_cache.get(JSONPathValidator, validation_request)
+
 		return IsEqualValidator(validation_request)
+
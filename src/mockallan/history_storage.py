@@ -0,0 +1,945 @@
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from abc import ABC, abstractmethod
+from array import array
+import bisect
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.message import Message
+import heapq
+import http.client
+import io
+import itertools
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from .request import HTTPRequest, HTTPResponse, CompiledResponse
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Body kinds
+_BODY_STR = 0
+_BODY_BYTES = 1
+_BODY_JSON = 2
+
+# Headers id of the records whose headers are stored with the record
+_NOT_INTERNED = 0xFFFFFFFF
+_MAX_INTERNED_HEADERS = 65536
+
+# Compaction runs once this many evicted records lead the columns, and they are at least half of them
+_COMPACTION_THRESHOLD = 4096
+
+
+def to_datetime(timestamp_ns: int) -> datetime:
+	"""Returns the UTC datetime of a timestamp in nanoseconds since the epoch. """
+
+	return _EPOCH + timedelta(microseconds=timestamp_ns // 1000)
+
+
+def to_timestamp_ns(date_time: datetime) -> int:
+	"""Returns the timestamp in nanoseconds since the epoch of a datetime. Naive datetimes are UTC. """
+
+	if date_time.tzinfo is not None:
+		date_time = date_time.astimezone(timezone.utc).replace(tzinfo=None)
+	delta = date_time - _EPOCH
+
+	return (delta.days * 86400 + delta.seconds) * 1_000_000_000 + delta.microseconds * 1000
+
+
+@dataclass
+class RequestRecord:
+	timestamp: datetime
+	request: HTTPRequest
+	response: HTTPResponse
+	generation: Optional[int] = None
+	sequence: Optional[int] = None
+
+
+class StoredRecord(NamedTuple):
+	"""Copy of the encoded data of a record, materialized by `HistoryStorage.materialize()`. """
+	timestamp_ns: int
+	sequence: int
+	endpoint: Tuple[str, str]
+	generation: int
+	headers_id: int
+	response: Optional[HTTPResponse]
+	body_kind: int
+	body: bytes
+	extras: bytes
+
+
+@dataclass(frozen=True)
+class RecordFilter:
+	"""Conditions on the records returned by `HistoryStorage.find()`.
+
+	Args:
+		method (str):		Request method.
+		path (str):		Request path.
+		status_code (int):	Response status code.
+		since_ns (int):		Minimum timestamp in nanoseconds.
+		until_ns (int):		Timestamp in nanoseconds the records must be older than.
+		after_sequence (int):	Sequence the records must be newer than.
+		before_sequence (int):	Sequence the records must be older than.
+
+	"""
+	method: Optional[str] = None
+	path: Optional[str] = None
+	status_code: Optional[int] = None
+	since_ns: Optional[int] = None
+	until_ns: Optional[int] = None
+	after_sequence: Optional[int] = None
+	before_sequence: Optional[int] = None
+
+
+class HistoryStorage(ABC):
+	"""Storage of the request records of a `History`.
+
+	Records are numbered by a sequence starting at 0 and evicted oldest first. Timestamps never
+	decrease. Implementations are not thread-safe; `History` serializes the calls but those to
+	`materialize()`.
+
+	Reads return `StoredRecord` copies, so that `History` only holds its lock while copying the
+	records and materializes them after releasing it.
+
+	"""
+	@abstractmethod
+	def append(
+			self,
+			timestamp_ns: int,
+			request: HTTPRequest,
+			response: HTTPResponse,
+			generation: Optional[int]) -> int:
+		"""Stores a record. Returns its sequence. """
+
+
+	@abstractmethod
+	def __len__(self) -> int:
+		"""Returns the number of records kept. """
+
+
+	@abstractmethod
+	def size(self) -> int:
+		"""Returns the estimated number of bytes taken by the records kept. """
+
+
+	@abstractmethod
+	def oldest_timestamp(self) -> Optional[int]:
+		"""Returns the timestamp in nanoseconds of the oldest record kept. """
+
+
+	@abstractmethod
+	def evict_oldest(self) -> Tuple[str, str]:
+		"""Evicts the oldest record. Returns its endpoint. """
+
+
+	@abstractmethod
+	def last(self) -> Optional[StoredRecord]:
+		"""Returns the newest record kept. """
+
+
+	@abstractmethod
+	def records(self) -> List[StoredRecord]:
+		"""Returns all the records kept, oldest first. """
+
+
+	@abstractmethod
+	def endpoint_records(self, endpoint: Tuple[str, str]) -> List[StoredRecord]:
+		"""Returns the records kept of `endpoint`, oldest first. """
+
+
+	@abstractmethod
+	def find(self, record_filter: RecordFilter, limit: Optional[int] = None) -> List[StoredRecord]:
+		"""Returns up to `limit` records kept matching `record_filter`, oldest first. """
+
+
+	@abstractmethod
+	def materialize(self, stored_records: Iterable[StoredRecord]) -> List[RequestRecord]:
+		"""Returns the request records of stored records. Safe to call concurrently with the other methods. """
+
+
+	def close(self):
+		"""Releases the resources held by the storage. """
+
+
+class _IndexedStorage(HistoryStorage):
+	"""Base of the storages indexing their records with in-memory array columns.
+
+	Holds the timestamp, endpoint id, status code and response id columns, the per-endpoint indexes
+	and the interned endpoints, header sets and compiled responses. Subclasses add columns to
+	`_columns` and store the rest of the record.
+
+	Compiled responses are interned by content, since the responses recorded through a manager
+	proxy are copies, and dropped once all the records using them are evicted.
+
+	Evicted records are dropped from the front of the columns in batches. `find()` narrows the
+	records down with the indexes before materializing any: timestamp ranges and sequences are
+	searched in the columns and endpoints in the per-endpoint sequences.
+
+	"""
+	def __init__(self):
+
+		self._timestamps = array('q')
+		self._endpoint_ids = array('I')
+		self._status_codes = array('H')
+		self._response_ids = array('i')
+		self._columns: Tuple[array, ...] = (self._timestamps, self._endpoint_ids, self._status_codes, self._response_ids)
+
+		# Sequence of the entry 0 of the columns and index of the oldest record kept
+		self._base_sequence = 0
+		self._head = 0
+
+		self._endpoints: List[Tuple[str, str]] = []
+		self._endpoint_id_mapping: Dict[Tuple[str, str], int] = {}
+		# Per endpoint sequences of the records kept, from index `_endpoint_heads[endpoint_id]`
+		self._endpoint_sequences: List[array] = []
+		self._endpoint_heads: List[int] = []
+
+		self._headers: List[Tuple[bool, tuple]] = []
+		self._headers_id_mapping: Dict[Tuple[bool, tuple], int] = {}
+		# Materialized headers by headers id, shared by the records materialized
+		self._loaded_headers: Dict[int, Any] = {}
+		self._responses: List[Optional[HTTPResponse]] = []
+		self._response_id_mapping: Dict[CompiledResponse, int] = {}
+		# Number of records kept per response id and ids of the dropped responses
+		self._response_record_counts: List[int] = []
+		self._free_response_ids: List[int] = []
+
+
+	def __len__(self) -> int:
+
+		return len(self._timestamps) - self._head
+
+
+	def oldest_timestamp(self) -> Optional[int]:
+
+		return self._timestamps[self._head] if len(self) else None
+
+
+	def evict_oldest(self) -> Tuple[str, str]:
+
+		endpoint_id = self._endpoint_ids[self._head]
+		self._release_response(self._response_ids[self._head])
+		self._head += 1
+		self._endpoint_heads[endpoint_id] += 1
+
+		endpoint_head = self._endpoint_heads[endpoint_id]
+		endpoint_sequences = self._endpoint_sequences[endpoint_id]
+		if endpoint_head >= _COMPACTION_THRESHOLD and endpoint_head * 2 >= len(endpoint_sequences):
+			del endpoint_sequences[:endpoint_head]
+			self._endpoint_heads[endpoint_id] = 0
+
+		self._evicted()
+		if self._head >= _COMPACTION_THRESHOLD and self._head * 2 >= len(self._timestamps) or len(self) == 0:
+			self._compact()
+
+		return self._endpoints[endpoint_id]
+
+
+	def last(self) -> Optional[StoredRecord]:
+
+		if len(self) == 0:
+			return None
+
+		return self._record(len(self._timestamps) - 1)
+
+
+	def records(self) -> List[StoredRecord]:
+
+		return [self._record(index) for index in range(self._head, len(self._timestamps))]
+
+
+	def endpoint_records(self, endpoint: Tuple[str, str]) -> List[StoredRecord]:
+
+		endpoint_id = self._endpoint_id_mapping.get(endpoint)
+		if endpoint_id is None:
+			return []
+
+		endpoint_sequences = self._endpoint_sequences[endpoint_id]
+
+		return [
+			self._record(sequence - self._base_sequence)
+			for sequence in endpoint_sequences[self._endpoint_heads[endpoint_id]:]
+		]
+
+
+	def find(self, record_filter: RecordFilter, limit: Optional[int] = None) -> List[StoredRecord]:
+
+		start = self._head
+		end = len(self._timestamps)
+		if record_filter.after_sequence is not None:
+			start = max(start, record_filter.after_sequence + 1 - self._base_sequence)
+		if record_filter.before_sequence is not None:
+			end = min(end, record_filter.before_sequence - self._base_sequence)
+		if start >= end:
+			return []
+
+		if record_filter.since_ns is not None:
+			start = bisect.bisect_left(self._timestamps, record_filter.since_ns, start, end)
+		if record_filter.until_ns is not None:
+			end = bisect.bisect_left(self._timestamps, record_filter.until_ns, start, end)
+
+		indexes: Iterable[int]
+		if record_filter.method is None and record_filter.path is None:
+			indexes = range(start, end)
+		else:
+			indexes = self._endpoint_indexes(record_filter.method, record_filter.path, start, end)
+
+		records = []
+		status_code = record_filter.status_code
+		for index in indexes:
+			if limit is not None and len(records) >= limit:
+				break
+			if status_code is None or self._status_codes[index] == status_code:
+				records.append(self._record(index))
+
+		return records
+
+
+	def _endpoint_indexes(self, method: Optional[str], path: Optional[str], start: int, end: int) -> Iterable[int]:
+		"""Yields the column indexes from `start` to `end` of the records of the matching endpoints. """
+
+		if method is not None and path is not None:
+			endpoint_id = self._endpoint_id_mapping.get((method, path))
+			endpoint_ids = [] if endpoint_id is None else [endpoint_id]
+		else:
+			endpoint_ids = [
+				endpoint_id for endpoint_id, (endpoint_method, endpoint_path) in enumerate(self._endpoints)
+				if method in (None, endpoint_method) and path in (None, endpoint_path)
+			]
+
+		start_sequence = self._base_sequence + start
+		end_sequence = self._base_sequence + end
+		endpoint_sequences = []
+		for endpoint_id in endpoint_ids:
+			sequences = self._endpoint_sequences[endpoint_id]
+			low = bisect.bisect_left(sequences, start_sequence, self._endpoint_heads[endpoint_id])
+			high = bisect.bisect_left(sequences, end_sequence, low)
+			if low < high:
+				endpoint_sequences.append(itertools.islice(sequences, low, high))
+
+		for sequence in heapq.merge(*endpoint_sequences):
+			yield sequence - self._base_sequence
+
+
+	def materialize(self, stored_records: Iterable[StoredRecord]) -> List[RequestRecord]:
+
+		return [self._materialize(stored_record) for stored_record in stored_records]
+
+
+	@abstractmethod
+	def _record(self, index: int) -> StoredRecord:
+		"""Copies the record at `index` of the columns. """
+
+
+	def _evicted(self):
+		"""Called after the oldest record is evicted. """
+
+
+	def _drop(self, head: int):
+		"""Drops the data of the records before `head`, which are about to be dropped from the columns. """
+
+
+	def _compact(self):
+		"""Drops the evicted records from the front of the columns. """
+
+		head = self._head
+		if head == 0:
+			return
+
+		self._drop(head)
+		for column in self._columns:
+			del column[:head]
+		self._base_sequence += head
+		self._head = 0
+
+
+	def _index(self, timestamp_ns: int, request: HTTPRequest, response: HTTPResponse, response_id: int) -> int:
+		"""Appends the record to the timestamp, endpoint, status code and response id columns and indexes.
+
+		Returns:
+			The sequence of the record.
+
+		"""
+		sequence = self._base_sequence + len(self._timestamps)
+		endpoint_id = self._endpoint_id(HTTPRequest.endpoint(request))
+		self._timestamps.append(timestamp_ns)
+		self._endpoint_ids.append(endpoint_id)
+		self._status_codes.append(response.status_code)
+		self._response_ids.append(response_id)
+		self._endpoint_sequences[endpoint_id].append(sequence)
+
+		return sequence
+
+
+	def _endpoint_id(self, endpoint: Tuple[str, str]) -> int:
+
+		endpoint_id = self._endpoint_id_mapping.get(endpoint)
+		if endpoint_id is None:
+			endpoint_id = len(self._endpoints)
+			self._endpoints.append(endpoint)
+			self._endpoint_id_mapping[endpoint] = endpoint_id
+			self._endpoint_sequences.append(array('Q'))
+			self._endpoint_heads.append(0)
+
+		return endpoint_id
+
+
+	def _encode(self, request: HTTPRequest, response: HTTPResponse) -> Tuple[int, int, int, bytes, bytes]:
+		"""Returns (headers_id, response_id, body_kind, body, extras) of a record.
+
+		`extras` is a JSON object with the query, path parameters and the headers or response that
+		are not interned, or empty.
+
+		"""
+		extras = {}
+		if request.query:
+			extras['query'] = request.query
+		if request.path_params:
+			extras['path_params'] = request.path_params
+
+		headers_key = _headers_key(request.headers)
+		headers_id = self._headers_id_mapping.get(headers_key)
+		if headers_id is None:
+			if len(self._headers) < _MAX_INTERNED_HEADERS:
+				headers_id = len(self._headers)
+				self._headers.append(headers_key)
+				self._headers_id_mapping[headers_key] = headers_id
+			else:
+				headers_id = _NOT_INTERNED
+				extras['headers'] = [headers_key[0], headers_key[1]]
+
+		response_id = self._response_id(response)
+		if response_id < 0:
+			extras['response'] = _dump_response(response)
+
+		body_kind, body = _encode_body(request.body)
+		extras_bytes = json.dumps(extras, separators=(',', ':')).encode('utf-8') if extras else b''
+
+		return headers_id, response_id, body_kind, body, extras_bytes
+
+
+	def _stored_record(
+			self,
+			index: int,
+			generation: int,
+			headers_id: int,
+			body_kind: int,
+			body: bytes,
+			extras: bytes) -> StoredRecord:
+		"""Returns the stored record at `index` of the columns given the data kept out of them. """
+
+		response_id = self._response_ids[index]
+
+		return StoredRecord(
+			self._timestamps[index],
+			self._base_sequence + index,
+			self._endpoints[self._endpoint_ids[index]],
+			generation,
+			headers_id,
+			None if response_id < 0 else self._responses[response_id],
+			body_kind,
+			body,
+			extras
+		)
+
+
+	def _materialize(self, stored_record: StoredRecord) -> RequestRecord:
+		"""Decodes a stored record. Only reads the interned headers, which are never modified. """
+
+		extras = json.loads(stored_record.extras) if stored_record.extras else {}
+
+		headers_id = stored_record.headers_id
+		if headers_id == _NOT_INTERNED:
+			headers = _load_headers(*extras['headers'])
+		else:
+			headers = self._loaded_headers.get(headers_id)
+			if headers is None:
+				headers = self._loaded_headers[headers_id] = _load_headers(*self._headers[headers_id])
+
+		method, path = stored_record.endpoint
+		body = _decode_body(stored_record.body_kind, stored_record.body)
+		request = HTTPRequest(method, path, extras.get('query', {}), headers, body)
+		request.path_params = extras.get('path_params', {})
+
+		response = stored_record.response
+		if response is None:
+			response = _load_response(extras['response'])
+
+		return RequestRecord(
+			to_datetime(stored_record.timestamp_ns),
+			request,
+			response,
+			None if stored_record.generation < 0 else stored_record.generation,
+			stored_record.sequence
+		)
+
+
+	def _response_id(self, response: HTTPResponse) -> int:
+		"""Returns the id of the interned response or -1 if the response is stored with the record.
+
+		Only compiled responses, which are shared by the requests served with them, are interned.
+		The record count of the response is incremented.
+
+		"""
+		if not response.is_compiled:
+			return -1
+
+		compiled_response = response.compile()
+		response_id = self._response_id_mapping.get(compiled_response)
+		if response_id is None:
+			if self._free_response_ids:
+				response_id = self._free_response_ids.pop()
+				self._responses[response_id] = response
+			else:
+				response_id = len(self._responses)
+				self._responses.append(response)
+				self._response_record_counts.append(0)
+			self._response_id_mapping[compiled_response] = response_id
+		self._response_record_counts[response_id] += 1
+
+		return response_id
+
+
+	def _release_response(self, response_id: int):
+		"""Decrements the record count of an interned response. Drops the response once it is 0. """
+
+		if response_id < 0:
+			return
+
+		self._response_record_counts[response_id] -= 1
+		if self._response_record_counts[response_id] == 0:
+			del self._response_id_mapping[self._responses[response_id].compile()]
+			self._responses[response_id] = None
+			self._free_response_ids.append(response_id)
+
+
+class MemoryStorage(_IndexedStorage):
+	"""Columnar in-memory storage.
+
+	Each record takes one entry in a few typed arrays (timestamp, endpoint id, status code,
+	generation, response id, headers id, arena offset, body length and body kind) and a slice of a
+	byte arena holding its body, followed by a JSON object with its query and path parameters when
+	it has any. Endpoints, header sets and compiled responses are interned, so that a record takes
+	about 40 bytes plus its body.
+
+	Records are materialized on demand. Materialized records with the same headers share the
+	headers object, which must not be modified.
+
+	"""
+	_COLUMN_BYTES = 8 + 4 + 2 + 4 + 4 + 4 + 8 + 4 + 1
+
+	def __init__(self):
+
+		super().__init__()
+		self._generations = array('i')
+		self._headers_ids = array('I')
+		self._offsets = array('Q')
+		self._body_lengths = array('I')
+		self._body_kinds = array('B')
+		self._columns += (
+			self._generations,
+			self._headers_ids,
+			self._offsets,
+			self._body_lengths,
+			self._body_kinds
+		)
+
+		self._arena = bytearray()
+		# Offsets are logical; the arena starts at logical offset `_arena_base`
+		self._arena_base = 0
+
+
+	def append(
+			self,
+			timestamp_ns: int,
+			request: HTTPRequest,
+			response: HTTPResponse,
+			generation: Optional[int]) -> int:
+
+		headers_id, response_id, body_kind, body, extras = self._encode(request, response)
+
+		self._generations.append(-1 if generation is None else generation)
+		self._headers_ids.append(headers_id)
+		self._offsets.append(self._arena_base + len(self._arena))
+		self._body_lengths.append(len(body))
+		self._body_kinds.append(body_kind)
+
+		self._arena += body
+		self._arena += extras
+
+		return self._index(timestamp_ns, request, response, response_id)
+
+
+	def size(self) -> int:
+
+		if len(self) == 0:
+			return 0
+
+		return len(self) * MemoryStorage._COLUMN_BYTES + self._arena_base + len(self._arena) - self._offsets[self._head]
+
+
+	def _drop(self, head: int):
+
+		arena_head = self._offsets[head] - self._arena_base if head < len(self._offsets) else len(self._arena)
+		del self._arena[:arena_head]
+		self._arena_base += arena_head
+
+
+	def _record(self, index: int) -> StoredRecord:
+
+		start = self._offsets[index] - self._arena_base
+		if index + 1 < len(self._offsets):
+			end = self._offsets[index + 1] - self._arena_base
+		else:
+			end = len(self._arena)
+		body_end = start + self._body_lengths[index]
+
+		return self._stored_record(
+			index,
+			self._generations[index],
+			self._headers_ids[index],
+			self._body_kinds[index],
+			bytes(self._arena[start:body_end]),
+			bytes(self._arena[body_end:end])
+		)
+
+
+class DiskStorage(_IndexedStorage):
+	"""Storage spilling the records to an append-only log of segment files.
+
+	Only the timestamp, endpoint id, status code, response id, log offset and length columns are
+	kept in memory. Appends encode the record into a pending buffer, which a background writer
+	thread appends to the log every `flush_interval` seconds or once it holds `max_pending_bytes`.
+	Reads never wait for the log: the records not written yet are read from the buffer being
+	written or the pending buffer, the others through a memory map of their segment.
+
+	A new segment file is started once the current one holds `segment_bytes`. Segment files are
+	deleted by the writer thread once all their records are evicted. A failed write is truncated
+	off the log and its bytes are put back into the pending buffer to be written again. The log is
+	created in a new directory inside `directory`, which is deleted by `close()`.
+
+	Args:
+		directory (str):		Directory of the log.
+		segment_bytes (int):		Segment file size.
+		flush_interval (float):		Seconds between flushes of the pending buffer.
+		max_pending_bytes (int):	Pending buffer size that triggers a flush.
+
+	"""
+	_RECORD_HEADER = struct.Struct('<iIBII')
+	_COLUMN_BYTES = 8 + 4 + 2 + 4 + 8 + 4
+
+	def __init__(
+			self,
+			directory: str,
+			segment_bytes: int = 64 * 1024 * 1024,
+			flush_interval: float = 0.05,
+			max_pending_bytes: int = 4 * 1024 * 1024):
+
+		super().__init__()
+		self._offsets = array('Q')
+		self._lengths = array('I')
+		self._columns += (self._offsets, self._lengths)
+
+		os.makedirs(directory, exist_ok=True)
+		self._directory = tempfile.mkdtemp(prefix='mockallan-history-', dir=directory)
+		self._segment_bytes = segment_bytes
+		self._flush_interval = flush_interval
+		self._max_pending_bytes = max_pending_bytes
+
+		# Segments as [path, file, mmap] and their first logical offsets. The last one is being written.
+		self._segments: List[list] = []
+		self._segment_offsets = array('Q')
+		# Segments whose records are all evicted, deleted by the writer thread
+		self._evicted_segments: List[list] = []
+		self._end_offset = 0
+		self._written_offset = 0
+
+		# The buffer being written starts at `_written_offset` and is followed by the pending buffer
+		self._writing = bytearray()
+		self._pending = bytearray()
+		# Held while accessing the buffers, the segments and `_written_offset`
+		self._pending_lock = threading.Lock()
+		# Held while writing to the log
+		self._write_lock = threading.Lock()
+		self._flush_requested = threading.Event()
+		self._failed: Optional[OSError] = None
+		self._closed = False
+		self._writer = threading.Thread(target=self._write_loop, name='mockallan-history-writer', daemon=True)
+		self._writer.start()
+
+
+	def append(
+			self,
+			timestamp_ns: int,
+			request: HTTPRequest,
+			response: HTTPResponse,
+			generation: Optional[int]) -> int:
+
+		headers_id, response_id, body_kind, body, extras = self._encode(request, response)
+		record_header = DiskStorage._RECORD_HEADER.pack(
+			-1 if generation is None else generation,
+			headers_id,
+			body_kind,
+			len(body),
+			len(extras)
+		)
+		length = len(record_header) + len(body) + len(extras)
+
+		self._offsets.append(self._end_offset)
+		self._lengths.append(length)
+		self._end_offset += length
+
+		with self._pending_lock:
+			self._pending += record_header
+			self._pending += body
+			self._pending += extras
+			pending_bytes = len(self._pending)
+
+		if pending_bytes >= self._max_pending_bytes:
+			self._flush_requested.set()
+
+		return self._index(timestamp_ns, request, response, response_id)
+
+
+	def size(self) -> int:
+
+		if len(self) == 0:
+			return 0
+
+		return self._end_offset - self._offsets[self._head]
+
+
+	def close(self):
+
+		if self._closed:
+			return
+
+		self._closed = True
+		self._flush_requested.set()
+		self._writer.join()
+		with self._write_lock, self._pending_lock:
+			for segment in self._evicted_segments + self._segments:
+				self._close_segment(segment)
+			self._evicted_segments = []
+			self._segments = []
+		shutil.rmtree(self._directory, ignore_errors=True)
+
+
+	def flush(self):
+		"""Deletes the segments whose records are all evicted and appends the pending buffer to the log.
+
+		Raises:
+			OSError		If the write fails. The pending buffer is kept.
+
+		"""
+		self._delete_evicted_segments()
+		with self._write_lock:
+			with self._pending_lock:
+				if self._failed is not None:
+					raise self._failed
+				if not self._pending:
+					return
+				self._writing, self._pending = self._pending, bytearray()
+				writing = self._writing
+				# A flush is written to a single segment so that records never span segments
+				open_segment = not self._segments or self._written_offset - self._segment_offsets[-1] >= self._segment_bytes
+
+			try:
+				if open_segment:
+					self._open_segment()
+				segment_file = self._segments[-1][1]
+				start = segment_file.seek(0, os.SEEK_END)
+				try:
+					segment_file.write(writing)
+					segment_file.flush()
+				except OSError:
+					self._truncate(segment_file, start)
+					raise
+			except OSError:
+				with self._pending_lock:
+					self._pending[:0] = self._writing
+					self._writing = bytearray()
+				raise
+
+			with self._pending_lock:
+				self._written_offset += len(writing)
+				self._writing = bytearray()
+
+
+	def _truncate(self, segment_file, size: int):
+		"""Truncates the segment being written to `size` after a failed write. If it fails the log is not written anymore. """
+
+		try:
+			segment_file.truncate(size)
+		except OSError as e:
+			logging.error('`%s` was raised while truncating the history log: %s', e.__class__.__name__, e)
+			self._failed = e
+
+
+	def _write_loop(self):
+
+		failing = False
+		while not self._closed:
+			self._flush_requested.wait(self._flush_interval)
+			self._flush_requested.clear()
+			try:
+				self.flush()
+				failing = False
+			except OSError as e:
+				# Logged once per failure streak
+				if not failing:
+					logging.error('`%s` was raised while writing the history log: %s', e.__class__.__name__, e)
+				failing = True
+
+		try:
+			self.flush()
+		except OSError:
+			pass
+
+
+	def _open_segment(self):
+		"""Starts a new segment file. Called holding `_write_lock`. """
+
+		path = os.path.join(self._directory, f'segment-{self._written_offset:016d}.log')
+		# pylint: disable=consider-using-with
+		segment_file = open(path, 'a+b')
+		with self._pending_lock:
+			self._segments.append([path, segment_file, None])
+			self._segment_offsets.append(self._written_offset)
+
+
+	def _delete_evicted_segments(self):
+
+		with self._pending_lock:
+			evicted_segments, self._evicted_segments = self._evicted_segments, []
+
+		for segment in evicted_segments:
+			self._close_segment(segment)
+			try:
+				os.remove(segment[0])
+			except OSError as e:
+				logging.error('`%s` was raised while deleting a history log segment: %s', e.__class__.__name__, e)
+
+
+	@staticmethod
+	def _close_segment(segment: list):
+
+		if segment[2] is not None:
+			segment[2].close()
+		segment[1].close()
+
+
+	def _evicted(self):
+
+		offset = self._offsets[self._head] if self._head < len(self._offsets) else self._end_offset
+		if len(self._segment_offsets) < 2 or self._segment_offsets[1] > offset:
+			return
+
+		with self._pending_lock:
+			# Hands the segments whose records are all evicted but the one being written to the writer
+			while len(self._segments) > 1 and self._segment_offsets[1] <= offset:
+				self._evicted_segments.append(self._segments.pop(0))
+				self._segment_offsets.pop(0)
+
+
+	def _record(self, index: int) -> StoredRecord:
+
+		data = self._read(self._offsets[index], self._lengths[index])
+
+		generation, headers_id, body_kind, body_length, extras_length = DiskStorage._RECORD_HEADER.unpack_from(data)
+		body_start = DiskStorage._RECORD_HEADER.size
+		body_end = body_start + body_length
+
+		return self._stored_record(
+			index,
+			generation,
+			headers_id,
+			body_kind,
+			data[body_start:body_end],
+			data[body_end:body_end + extras_length]
+		)
+
+
+	def _read(self, offset: int, length: int) -> bytes:
+		"""Reads `length` bytes of the log at `offset`, from the buffers if they are not written yet. """
+
+		with self._pending_lock:
+			start = offset - self._written_offset
+			if start >= 0:
+				# Records never span the buffers, which are swapped whole
+				if start < len(self._writing):
+					return bytes(self._writing[start:start + length])
+				start -= len(self._writing)
+				return bytes(self._pending[start:start + length])
+
+			segment_index = bisect.bisect_right(self._segment_offsets, offset) - 1
+			segment = self._segments[segment_index]
+			start = offset - self._segment_offsets[segment_index]
+
+			segment_map = segment[2]
+			if segment_map is None or len(segment_map) < start + length:
+				if segment_map is not None:
+					segment_map.close()
+				segment_map = segment[2] = mmap.mmap(segment[1].fileno(), 0, access=mmap.ACCESS_READ)
+
+			return segment_map[start:start + length]
+
+
+def _headers_key(headers: Any) -> Tuple[bool, tuple]:
+	"""Returns (is_message, header items). """
+
+	return isinstance(headers, Message), tuple((str(name), str(value)) for name, value in headers.items())
+
+
+def _load_headers(is_message: bool, items) -> Any:
+
+	if not is_message:
+		return {name: value for name, value in items}
+
+	header_lines = ''.join(f'{name}: {value}\r\n' for name, value in items) + '\r\n'
+
+	return http.client.parse_headers(io.BytesIO(header_lines.encode('latin-1', errors='replace')))
+
+
+def _encode_body(body: Any) -> Tuple[int, bytes]:
+
+	if isinstance(body, str):
+		return _BODY_STR, body.encode('utf-8', errors='surrogatepass')
+	if isinstance(body, (bytes, bytearray)):
+		return _BODY_BYTES, bytes(body)
+
+	return _BODY_JSON, json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+
+def _decode_body(kind: int, body: bytes) -> Any:
+
+	if kind == _BODY_STR:
+		return body.decode('utf-8', errors='surrogatepass')
+	if kind == _BODY_BYTES:
+		return body
+
+	return json.loads(body)
+
+
+def _dump_response(response: HTTPResponse) -> dict:
+
+	body_kind, body = _encode_body(response.body)
+
+	return {
+		"status_code": response.status_code,
+		"headers": response.headers,
+		"body_kind": body_kind,
+		"body": body.decode('latin-1')
+	}
+
+
+def _load_response(response_json: dict) -> HTTPResponse:
+
+	body = _decode_body(response_json['body_kind'], response_json['body'].encode('latin-1'))
+
+	return HTTPResponse(response_json['status_code'], response_json['headers'], body)
@@ -0,0 +1,122 @@
+from typing import Any, List, Sequence, Tuple, Union
+import functools
+import json
+import re
+
+
+_IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_STEP_RE = re.compile(
+	r'\.(?P<name>[A-Za-z_][A-Za-z0-9_]*)'
+	r'|(?P<wildcard>\.\*|\[\*\])'
+	r'|\[(?P<index>-?\d+)\]'
+	r"|\['(?P<quoted>[^']*)'\]"
+	r'|\[(?P<json_quoted>"(?:[^"\\]|\\.)*")\]'
+)
+
+# A step is a member name, an array index or the wildcard
+Step = Union[str, int, None]
+
+
+class JSONPathError(ValueError):
+	"""Raised if a JSONPath expression is invalid or uses unsupported syntax. """
+
+
+class JSONPath():
+	"""Compiled JSONPath expression.
+
+	Supports the root `$`, member names `.name`, `['name']` and `["name"]`, array indexes `[0]` and
+	`[-1]`, and the wildcards `.*` and `[*]`. Filters, slices and recursive descent are not
+	supported.
+
+	Attributes:
+		expression (str):	Canonical expression, e.g. `$.items[*].sku`, by which fields are
+					compared and indexed.
+
+	"""
+	__slots__ = ('expression', '_steps')
+
+	def __init__(self, steps: Sequence[Step]):
+
+		self._steps: Tuple[Step, ...] = tuple(steps)
+		self.expression = '$' + ''.join(_format_step(step) for step in self._steps)
+
+
+	def __eq__(self, other: Any) -> bool:
+
+		return isinstance(other, JSONPath) and self.expression == other.expression
+
+
+	def __hash__(self) -> int:
+
+		return hash(self.expression)
+
+
+	def __repr__(self) -> str:
+
+		return f'JSONPath({self.expression!r})'
+
+
+	def find(self, document: Any) -> List[Any]:
+		"""Returns the values of the fields of `document` the expression matches, in document order. """
+
+		values = [document]
+		for step in self._steps:
+			matched_values = []
+			for value in values:
+				if step is None:
+					if isinstance(value, dict):
+						matched_values.extend(value.values())
+					elif isinstance(value, list):
+						matched_values.extend(value)
+				elif isinstance(step, int):
+					if isinstance(value, list) and -len(value) <= step < len(value):
+						matched_values.append(value[step])
+				elif isinstance(value, dict) and step in value:
+					matched_values.append(value[step])
+			values = matched_values
+
+		return values
+
+
+@functools.lru_cache(maxsize=256)
+def compile_path(expression: str) -> JSONPath:
+	"""Returns the compiled JSONPath expression.
+
+	Raises:
+		JSONPathError	If the expression is invalid or uses unsupported syntax.
+
+	"""
+	if not isinstance(expression, str) or not expression.startswith('$'):
+		raise JSONPathError(f"'{expression}': JSONPath expressions must start with '$'")
+
+	steps: List[Step] = []
+	position = 1
+	while position < len(expression):
+		match = _STEP_RE.match(expression, position)
+		if match is None:
+			raise JSONPathError(f"'{expression}': unsupported JSONPath syntax at position {position}")
+		if match['name'] is not None:
+			steps.append(match['name'])
+		elif match['wildcard'] is not None:
+			steps.append(None)
+		elif match['index'] is not None:
+			steps.append(int(match['index']))
+		elif match['quoted'] is not None:
+			steps.append(match['quoted'])
+		else:
+			steps.append(json.loads(match['json_quoted']))
+		position = match.end()
+
+	return JSONPath(steps)
+
+
+def _format_step(step: Step) -> str:
+
+	if step is None:
+		return '[*]'
+	if isinstance(step, int):
+		return f'[{step}]'
+	if _IDENTIFIER_RE.match(step):
+		return f'.{step}'
+
+	return f'[{json.dumps(step, ensure_ascii=False)}]'
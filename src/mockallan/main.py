@@ -1,25 +1,46 @@
-from typing import Union, Optional
+from typing import Union, Optional, Sequence
 from argparse import ArgumentParser
 import logging
-import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import socket
+import threading
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 import urllib.parse
-from .request import HTTPRequest, HTTPResponse, ContentType
+from .request import (
+	HTTPRequest,
+	HTTPResponse,
+	StreamingResponse,
+	ContentType,
+	LAST_CHUNK,
+	encode_chunk,
+	http_date
+)
 from .stub_config import StubConfig
 from .app_handler import AppHandler
+from .history import History
+from .asyncio_server import AsyncioHTTPServer, DEFAULT_IDLE_TIMEOUT, MAX_BODY_BYTES
+from .workers import MockHTTPServerWorkers
 
 __version__ = '0.1.2'
 
 __all__ = ['MockHTTPServer']
 
+ENGINES = ('single', 'threaded', 'asyncio')
+DEFAULT_MAX_WORKERS = 64
 
-def http_request_handler_class_factory(app_handler: AppHandler):
+# Seconds a connection waits for a worker of the threaded engine before it is answered 503
+_WORKER_WAIT_TIMEOUT = 1.0
+
+
+def http_request_handler_class_factory(app_handler: AppHandler, idle_timeout: Optional[float] = None):
 	"""Returns the MockHTTPRequestHandler class parametrized with `app_handler`.
 
+	Connections idle for `idle_timeout` seconds are closed.
+
 	"""
 	class MockHTTPRequestHandler(BaseHTTPRequestHandler):
 
 		protocol_version = "HTTP/1.1"
+		timeout = idle_timeout
 
 		def __init__(self, request, client_address, server):
 
@@ -43,21 +64,45 @@ def http_request_handler_class_factory(app_handler: AppHandler):
 
 			self._do_request_with_body('POST')
 
+		def do_PATCH(self):
+
+			self._do_request_with_body('PATCH')
+
+		def do_DELETE(self):
+
+			if self.headers['Content-Length']:
+				self._do_request_with_body('DELETE')
+				return
+
+			parse_result = urllib.parse.urlparse(self.path)
+			query = urllib.parse.parse_qs(parse_result.query)
+
+			request = HTTPRequest('DELETE', parse_result.path, query, self.headers)
+			response = self.app_handler.handle_request(request)
+			self._write_response(response)
+
 		def _do_request_with_body(self, method: str):
 
 			parse_result = urllib.parse.urlparse(self.path)
 			query = urllib.parse.parse_qs(parse_result.query)
 
 			content_length = self.headers['Content-Length']
-			if content_length:
+			if content_length and not content_length.isdigit():
+				# The body is not read, so the connection can't be kept alive
+				self.close_connection = True
+				response = self._create_bad_request_response('Bad Content-Length')
+			elif content_length and int(content_length) > MAX_BODY_BYTES:
+				self.close_connection = True
+				response = self._create_bad_request_response('Content too large', 413)
+			elif content_length:
 				try:
 					body = self.rfile.read(int(content_length))
 				except ConnectionError as e:
 					logging.warning('`%s` was raised while reading the socket: %s', e.__class__.__name__, e)
 					response = None
 				else:
-					body_str = body.decode('utf-8')
-					request = HTTPRequest(method, parse_result.path, query, self.headers, body_str)
+					# Kept as bytes; validators and the history API decode it when they need to
+					request = HTTPRequest(method, parse_result.path, query, self.headers, body)
 
 					response = self.app_handler.handle_request(request)
 			else:
@@ -66,32 +111,51 @@ def http_request_handler_class_factory(app_handler: AppHandler):
 			if response:
 				self._write_response(response)
 
-		def _write_response(self, response: HTTPResponse):
+		def _write_response(self, response: Union[HTTPResponse, StreamingResponse]):
+			"""Writes the compiled response with a single gathering write. """
 
-			self.send_response(response.status_code)
-			for key, value in response.headers.items():
-				self.send_header(key, value)
+			if isinstance(response, StreamingResponse):
+				self._write_streaming_response(response)
+				return
 
-			if isinstance(response.body, dict):
-				response.body = json.dumps(response.body)
+			compiled_response = response.compile()
+			self.log_request(compiled_response.status_code)
+			extra_headers = f'Server: {self.version_string()}\r\nDate: {http_date()}\r\n'.encode('latin-1')
 
-			body_bytes = response.body.encode('utf-8')
-			self.send_header('Content-Length', str(len(body_bytes)))
-			self.end_headers()
+			try:
+				_send_buffers(self.connection, compiled_response.buffers(extra_headers))
+			except ConnectionError as e:
+				logging.warning('`%s` was raised while writting the socket: %s', e.__class__.__name__, e)
+
+		def _write_streaming_response(self, response: StreamingResponse):
+			"""Writes the chunks as they are produced. Closes the connection if producing one fails. """
+
+			self.log_request(response.status_code)
+			extra_headers = f'Server: {self.version_string()}\r\nDate: {http_date()}\r\n'.encode('latin-1')
 
 			try:
-				self.wfile.write(body_bytes)
+				self.wfile.write(response.head(extra_headers))
+				for chunk in response.chunks:
+					if chunk:
+						self.wfile.write(encode_chunk(chunk))
+				self.wfile.write(LAST_CHUNK)
 			except ConnectionError as e:
 				logging.warning('`%s` was raised while writting the socket: %s', e.__class__.__name__, e)
+				self.close_connection = True
+			except Exception as e:	# pylint: disable=broad-except
+				logging.exception('`%s` was raised while streaming the response', e.__class__.__name__)
+				self.close_connection = True
+			finally:
+				response.close()
 
 		@staticmethod
-		def _create_bad_request_response(message: str) -> HTTPResponse:
+		def _create_bad_request_response(message: str, status_code: int = 400) -> HTTPResponse:
 
 			return HTTPResponse(
-				400,
+				status_code,
 				ContentType.APPLICATION_JSON_ERROR,
 				{
-					"status": 400,
+					"status": status_code,
 					"type": "bad-request",
 					"message": message
 				}
@@ -103,25 +167,146 @@ def http_request_handler_class_factory(app_handler: AppHandler):
 	return MockHTTPRequestHandler
 
 
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+	"""ThreadingHTTPServer that serves at most `max_workers` connections at a time.
+
+	When all the workers are busy the accept loop waits for one of them to finish. A connection
+	that finds no worker within a second is answered 503 and closed, so that the accept loop never
+	blocks for long and `shutdown()` always returns. The handler should close idle keep-alive
+	connections to release their workers.
+
+	"""
+	def __init__(
+			self,
+			server_address,
+			RequestHandlerClass,
+			max_workers: int = DEFAULT_MAX_WORKERS,
+			bind_and_activate: bool = True):
+
+		if max_workers < 1:
+			raise ValueError(f'max_workers must be greater than 0 but it is {max_workers}')
+
+		self._workers = threading.BoundedSemaphore(max_workers)
+		super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+	def process_request(self, request, client_address):
+
+		if not self._workers.acquire(timeout=_WORKER_WAIT_TIMEOUT):
+			self._reject_request(request)
+			return
+
+		try:
+			super().process_request(request, client_address)
+		except BaseException:
+			self._workers.release()
+			raise
+
+	def process_request_thread(self, request, client_address):
+
+		try:
+			super().process_request_thread(request, client_address)
+		finally:
+			self._workers.release()
+
+	def _reject_request(self, request):
+
+		response = HTTPResponse(
+			503,
+			{'Content-Type': 'application/json+error', 'Connection': 'close', 'Retry-After': '1'},
+			{
+				"status": 503,
+				"type": "server-busy",
+				"message": "All the workers are busy"
+			}
+		)
+		try:
+			request.settimeout(_WORKER_WAIT_TIMEOUT)
+			request.sendall(response.compile().to_bytes(f'Date: {http_date()}\r\n'.encode('latin-1')))
+		except OSError:
+			pass
+		self.shutdown_request(request)
+
+
 class MockHTTPServer():
 	"""Lightweight HTTP server mock.
 
 	Configurable at initialization time from a JSON file or python dict. Configurable at run time via REST API.
 
+	Args:
+		engine (str):		'single' serves one connection at a time. 'threaded' serves each connection
+					in its own thread, up to `max_workers` at a time. 'asyncio' serves all the
+					connections from an asyncio event loop.
+		max_workers (int):	Maximum number of concurrent connections of the 'threaded' engine.
+		idle_timeout (float):	Seconds after which idle keep-alive connections are closed.
+		reuse_port (bool):	Sets SO_REUSEPORT on the listening socket so that many processes can
+					listen on the same port.
+		stub_config (StubConfig):	Stub configuration to use instead of loading `stub_config_json`.
+		history (History):	Request history to use instead of a new one.
+		shared_state (bool):	Whether `stub_config` and `history` are shared with other processes.
+					Their calls then block on IPC, so the 'asyncio' engine handles every
+					request off the event loop.
+
 	"""
-	def __init__(self, server_address, stub_config_json: Optional[Union[dict, str]]):
+	def __init__(
+			self,
+			server_address,
+			stub_config_json: Optional[Union[dict, str]],
+			engine: str = 'single',
+			max_workers: int = DEFAULT_MAX_WORKERS,
+			idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+			reuse_port: bool = False,
+			stub_config: Optional[StubConfig] = None,
+			history: Optional[History] = None,
+			shared_state: bool = False):
+
+		if stub_config is None:
+			stub_config = StubConfig(stub_config_json)
+		# The single engine could not serve the requests waited for
+		app_handler = AppHandler(stub_config, history, allow_waits=engine != 'single')
+		if engine == 'single':
+			http_request_handler_class = http_request_handler_class_factory(app_handler, idle_timeout)
+			self._http_server = HTTPServer(server_address, http_request_handler_class, False)
+		elif engine == 'threaded':
+			http_request_handler_class = http_request_handler_class_factory(app_handler, idle_timeout)
+			self._http_server = BoundedThreadingHTTPServer(server_address, http_request_handler_class, max_workers, False)
+		elif engine == 'asyncio':
+			self._http_server = AsyncioHTTPServer(
+				server_address,
+				app_handler,
+				f'Mockallan/{__version__}',
+				idle_timeout,
+				reuse_port=reuse_port,
+				inline_test_requests=not shared_state
+			)
+			return
+		else:
+			raise ValueError(f"'{engine}': unsupported engine")
+
+		try:
+			if reuse_port:
+				self._http_server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+			self._http_server.server_bind()
+			self._http_server.server_activate()
+		except:
+			self._http_server.server_close()
+			raise
 
-		stub_config = StubConfig(stub_config_json)
-		app_handler = AppHandler(stub_config)
-		http_request_handler_class = http_request_handler_class_factory(app_handler)
-		self._http_server = HTTPServer(server_address, http_request_handler_class)
+	@property
+	def server_address(self):
+
+		return self._http_server.server_address
 
 	def serve_forever(self, poll_interval=0.5):
 
 		self._http_server.serve_forever(poll_interval)
 
+	def shutdown(self):
+		"""Stops the serve_forever() loop. Must be called from another thread. """
+
+		self._http_server.shutdown()
+
 	def close(self):
-		self._http_server.socket.close()
+		self._http_server.server_close()
 
 
 def main():
@@ -129,15 +314,47 @@ def main():
 	argparse.add_argument("-H", "--host", type=str, metavar="HOST", dest="host", default="0.0.0.0")
 	argparse.add_argument("-p", "--port", type=int, metavar="PORT", dest="port", default=8080)
 	argparse.add_argument("-c", "--stub-config", type=str, metavar="STUB_CONFIG", dest="stub_config_json")
+	argparse.add_argument("-e", "--engine", type=str, choices=ENGINES, dest="engine", default="single")
+	argparse.add_argument("--max-workers", type=int, metavar="MAX_WORKERS", dest="max_workers", default=DEFAULT_MAX_WORKERS)
+	argparse.add_argument("--idle-timeout", type=float, metavar="SECONDS", dest="idle_timeout", default=DEFAULT_IDLE_TIMEOUT)
+	argparse.add_argument("-w", "--workers", type=int, metavar="WORKERS", dest="workers", default=1)
+	argparse.add_argument("--history-max-records", type=int, metavar="RECORDS", dest="history_max_records")
+	argparse.add_argument("--history-max-bytes", type=int, metavar="BYTES", dest="history_max_bytes")
+	argparse.add_argument("--history-ttl", type=float, metavar="SECONDS", dest="history_ttl")
+	argparse.add_argument("--history-dir", type=str, metavar="DIRECTORY", dest="history_dir")
 
 	args = argparse.parse_args()
 
 	server_address = (args.host, args.port)
 	print(f'Listening on {server_address[0]}:{server_address[1]}')
 
+	history_options = {
+		'max_records': args.history_max_records,
+		'max_bytes': args.history_max_bytes,
+		'ttl': args.history_ttl,
+		'directory': args.history_dir
+	}
+
+	if args.workers > 1:
+		_run_workers(args, server_address, history_options)
+		return
+
+	try:
+		history = History(**history_options)
+	except (OSError, ValueError) as e:
+		print(f'Failed to instantiate History: {e}')
+		return
+
 	try:
-		mock_http_server = MockHTTPServer(server_address, args.stub_config_json)
-	except FileNotFoundError as e:
+		mock_http_server = MockHTTPServer(
+			server_address,
+			args.stub_config_json,
+			args.engine,
+			args.max_workers,
+			args.idle_timeout,
+			history=history
+		)
+	except (FileNotFoundError, ValueError) as e:
 		print(f'Failed to instantiate MockHTTPServer: {e}')
 	else:
 		try:
@@ -147,6 +364,48 @@ def main():
 
 		mock_http_server.close()
 
+	history.close()
+
+
+def _run_workers(args, server_address, history_options: dict):
+
+	try:
+		mock_http_server_workers = MockHTTPServerWorkers(
+			server_address,
+			args.stub_config_json,
+			args.workers,
+			args.engine,
+			args.max_workers,
+			args.idle_timeout,
+			history_options
+		)
+		mock_http_server_workers.start()
+	except (OSError, ValueError, RuntimeError) as e:
+		print(f'Failed to start MockHTTPServer workers: {e}')
+	else:
+		try:
+			mock_http_server_workers.join()
+		except KeyboardInterrupt:
+			print('\nShutting down')
+
+		mock_http_server_workers.close()
+
+
+def _send_buffers(sock: socket.socket, buffers: Sequence[bytes]):
+	"""Sends the buffers in order with `sendmsg`, so that they aren't joined into a copy first. """
+
+	if not hasattr(sock, 'sendmsg'):
+		sock.sendall(b''.join(buffers))
+		return
+
+	views = [memoryview(buffer) for buffer in buffers if buffer]
+	while views:
+		sent = sock.sendmsg(views)
+		while views and sent >= len(views[0]):
+			sent -= len(views.pop(0))
+		if sent:
+			views[0] = views[0][sent:]
+
 
 if __name__ == '__main__':
 	main()
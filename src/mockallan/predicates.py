@@ -0,0 +1,270 @@
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+from collections import Counter
+import json
+from .request import HTTPRequest
+
+
+# (source, name) where source is 'query', 'header' or 'body'. Body names are field path tuples.
+ConditionKey = Tuple[str, Any]
+
+_LEAF_SIZE = 4
+_NOT_PARSED = object()
+
+
+def canonical(value: Any) -> str:
+	"""Returns the canonical JSON text of `value`, used to compare and index values. """
+
+	return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+class RequestPredicate():
+	"""Conditions on the query parameters, headers and body fields of a request.
+
+	Args:
+		query (dict):	Query parameter values. A string matches a parameter given once;
+				a list matches the parameter values in order.
+		headers (dict):	Header values. Header names are case-insensitive.
+		body:		A JSON object matches the requests whose JSON body contains its fields
+				(nested objects included). Any other value matches the whole body.
+
+	"""
+	def __init__(self, query: Optional[dict] = None, headers: Optional[dict] = None, body: Any = None):
+
+		self.query = query or {}
+		self.headers = headers or {}
+		self.body = body if body not in (None, '') else None
+
+		conditions: Dict[ConditionKey, str] = {}
+		for name, value in self.query.items():
+			values = value if isinstance(value, list) else [value]
+			conditions[('query', name)] = canonical([str(item) for item in values])
+		for name, value in self.headers.items():
+			conditions[('header', name.lower())] = canonical(str(value))
+		if isinstance(self.body, dict):
+			for path, value in flatten_fields(self.body):
+				conditions[('body', path)] = canonical(value)
+		elif self.body is not None:
+			conditions[('body', ())] = canonical(self.body)
+
+		self.conditions = conditions
+		self.key: FrozenSet[Tuple[ConditionKey, str]] = frozenset(conditions.items())
+
+
+	def __bool__(self) -> bool:
+
+		return bool(self.conditions)
+
+
+	@staticmethod
+	def from_request(request: HTTPRequest) -> 'RequestPredicate':
+
+		return RequestPredicate(request.query, request.headers, request.body)
+
+
+def flatten_fields(value: dict, path: Tuple[str, ...] = ()):
+	"""Yields the (field path, value) of the fields of a JSON object. Non-empty nested objects are flattened. """
+
+	for name, item in value.items():
+		if isinstance(item, dict) and item:
+			yield from flatten_fields(item, path + (name,))
+		else:
+			yield path + (name,), item
+
+
+class RequestView():
+	"""Extracts and caches the canonical values of a request for condition keys. """
+
+	def __init__(self, request: HTTPRequest):
+
+		self._request = request
+		self._values: Dict[ConditionKey, Optional[str]] = {}
+		self._body = _NOT_PARSED
+		self._headers = None
+
+
+	def value(self, key: ConditionKey) -> Optional[str]:
+
+		try:
+			return self._values[key]
+		except KeyError:
+			pass
+
+		source, name = key
+		if source == 'query':
+			values = self._request.query.get(name)
+			if isinstance(values, str):
+				values = [values]
+			value = None if values is None else canonical(list(values))
+		elif source == 'header':
+			header = self._header(name)
+			value = None if header is None else canonical(header)
+		else:
+			value = self._body_value(name)
+
+		self._values[key] = value
+
+		return value
+
+
+	def _header(self, name: str) -> Optional[str]:
+
+		headers = self._request.headers
+		if isinstance(headers, dict):
+			if self._headers is None:
+				self._headers = {key.lower(): value for key, value in headers.items()}
+			return self._headers.get(name)
+
+		return headers.get(name)
+
+
+	def _body_value(self, path: Tuple[str, ...]) -> Optional[str]:
+
+		if self._body is _NOT_PARSED:
+			self._body = _parse_body(self._request.body)
+
+		if self._body is None:
+			return None
+
+		if not path:
+			return canonical(self._body)
+
+		value = self._body
+		for name in path:
+			if not isinstance(value, dict) or name not in value:
+				return None
+			value = value[name]
+
+		return canonical(value)
+
+
+def _parse_body(body: Any) -> Any:
+
+	if isinstance(body, (str, bytes)):
+		if not body:
+			return None
+		try:
+			return json.loads(body)
+		except ValueError:
+			pass
+		if isinstance(body, str):
+			return body
+		try:
+			return body.decode('utf-8')
+		except UnicodeDecodeError:
+			return None
+
+	return body
+
+
+class _Candidate():
+
+	__slots__ = ('value', 'rank', 'conditions')
+
+	def __init__(self, value: Any, rank: tuple, conditions: Dict[ConditionKey, str]):
+
+		self.value = value
+		self.rank = rank
+		self.conditions = conditions
+
+
+class _Leaf():
+
+	__slots__ = ('candidates',)
+
+	def __init__(self, candidates: List[_Candidate]):
+
+		self.candidates = sorted(candidates, key=lambda candidate: candidate.rank)
+
+
+	def match(self, view: RequestView) -> Optional[_Candidate]:
+
+		for candidate in self.candidates:
+			if all(view.value(key) == value for key, value in candidate.conditions.items()):
+				return candidate
+
+		return None
+
+
+class _Branch():
+
+	__slots__ = ('key', 'branches', 'default')
+
+	def __init__(self, key: ConditionKey, branches: Dict[str, Any], default: Any):
+
+		self.key = key
+		self.branches = branches
+		self.default = default
+
+
+	def match(self, view: RequestView) -> Optional[_Candidate]:
+
+		candidate = None
+		branch = self.branches.get(view.value(self.key))
+		if branch is not None:
+			candidate = branch.match(view)
+
+		if self.default is not None:
+			default_candidate = self.default.match(view)
+			if default_candidate is not None and (candidate is None or default_candidate.rank < candidate.rank):
+				candidate = default_candidate
+
+		return candidate
+
+
+class DecisionTree():
+	"""Selects the best ranked value whose predicate matches a request.
+
+	Values are indexed by the condition key shared by most predicates: the request value for that
+	key selects one branch, and values without a condition on the key go to a default branch.
+	Branches are split again until they are small enough to be tested in turn, so that selecting
+	a value among thousands tests only a few predicates.
+
+	Args:
+		entries:	(value, predicate, rank) tuples. The lowest rank wins.
+
+	"""
+	def __init__(self, entries: Sequence[Tuple[Any, RequestPredicate, tuple]]):
+
+		candidates = [_Candidate(value, rank, dict(predicate.conditions)) for value, predicate, rank in entries]
+		self._root = _build(candidates) if candidates else None
+
+
+	def match(self, request: HTTPRequest, view: Optional[RequestView] = None) -> Optional[Any]:
+
+		if self._root is None:
+			return None
+
+		candidate = self._root.match(view or RequestView(request))
+
+		return None if candidate is None else candidate.value
+
+
+def _build(candidates: List[_Candidate]):
+
+	if len(candidates) <= _LEAF_SIZE:
+		return _Leaf(candidates)
+
+	key_counts = Counter(key for candidate in candidates for key in candidate.conditions)
+	if not key_counts:
+		return _Leaf(candidates)
+
+	key, count = key_counts.most_common(1)[0]
+	if count < 2:
+		return _Leaf(candidates)
+
+	grouped: Dict[str, List[_Candidate]] = {}
+	default = []
+	for candidate in candidates:
+		value = candidate.conditions.get(key)
+		if value is None:
+			default.append(candidate)
+		else:
+			conditions = dict(candidate.conditions)
+			del conditions[key]
+			grouped.setdefault(value, []).append(_Candidate(candidate.value, candidate.rank, conditions))
+
+	return _Branch(
+		key,
+		{value: _build(group) for value, group in grouped.items()},
+		_build(default) if default else None
+	)
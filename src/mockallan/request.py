@@ -1,5 +1,9 @@
-from typing import Union, Tuple
+from typing import Iterator, Union, Tuple, Optional
 from dataclasses import dataclass, field
+from http import HTTPStatus
+import email.utils
+import json
+import time
 
 
 class ContentType:
@@ -8,6 +12,8 @@ class ContentType:
 	APPLICATION_JSON_ERROR = {'Content-Type': 'application/json+error'}
 	APPLICATION_XML = {'Content-Type': 'application/xml'}
 	APPLICATION_OCTET_STREAM = {'Content-Type': 'application/octet-stream'}
+	APPLICATION_X_NDJSON = {'Content-Type': 'application/x-ndjson'}
+	TEXT_EVENT_STREAM = {'Content-Type': 'text/event-stream'}
 
 
 @dataclass
@@ -17,6 +23,7 @@ class HTTPRequest:
 	query: dict = field(default_factory=dict)
 	headers: dict = field(default_factory=dict)
 	body: Union[dict, str, bytes] = ''
+	path_params: dict = field(default_factory=dict, compare=False)
 
 	def __post_init__(self):
 		if self.method not in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
@@ -32,7 +39,131 @@ class HTTPResponse:
 	status_code: int
 	headers: dict = field(default_factory=dict)
 	body: Union[dict, str, bytes] = ''
+	_compiled: Optional['CompiledResponse'] = field(default=None, init=False, repr=False, compare=False)
 
 	def __post_init__(self):
 		if not isinstance(self.status_code, int):
 			raise TypeError(f"'status_code' must be {int} but it is actually {type(self.status_code)}")
+
+	def compile(self) -> 'CompiledResponse':
+		"""Returns the response serialized as HTTP/1.1. Serialized once; the response must not be modified afterwards. """
+
+		if self._compiled is None:
+			self._compiled = CompiledResponse.from_response(self)
+
+		return self._compiled
+
+	@property
+	def is_compiled(self) -> bool:
+		return self._compiled is not None
+
+
+@dataclass(frozen=True)
+class CompiledResponse:
+	"""HTTP/1.1 response serialized ahead of time.
+
+	Attributes:
+		status_code (int):
+		status_line (bytes):	E.g. b'HTTP/1.1 200 OK\\r\\n'.
+		payload (bytes):	Header lines including Content-Length, the empty line and the body.
+
+	"""
+	status_code: int
+	status_line: bytes
+	payload: bytes
+
+	@staticmethod
+	def from_response(response: HTTPResponse) -> 'CompiledResponse':
+
+		try:
+			phrase = HTTPStatus(response.status_code).phrase
+		except ValueError:
+			phrase = ''
+
+		body = encode_body(response.body)
+		header_lines = [f'{key}: {value}\r\n' for key, value in response.headers.items()]
+		header_lines.append(f'Content-Length: {len(body)}\r\n\r\n')
+
+		return CompiledResponse(
+			response.status_code,
+			f'HTTP/1.1 {response.status_code} {phrase}\r\n'.encode('latin-1'),
+			''.join(header_lines).encode('latin-1') + body
+		)
+
+	def buffers(self, extra_headers: bytes = b'') -> Tuple[bytes, bytes, bytes]:
+		"""Returns the parts of the message, for a gathering write that doesn't copy the payload. """
+
+		return self.status_line, extra_headers, self.payload
+
+	def to_bytes(self, extra_headers: bytes = b'') -> bytes:
+		"""Returns the message with `extra_headers` (e.g. b'Date: ...\\r\\n') inserted after the status line. """
+
+		return b''.join(self.buffers(extra_headers))
+
+
+@dataclass
+class StreamingResponse:
+	"""HTTP/1.1 response whose body is sent with the chunked transfer coding as it is produced.
+
+	Attributes:
+		status_code (int):
+		headers (dict):
+		chunks (Iterator[bytes]):	Body chunks. Produced while the response is being sent.
+
+	"""
+	status_code: int
+	headers: dict
+	chunks: Iterator[bytes]
+
+	def head(self, extra_headers: bytes = b'') -> bytes:
+		"""Returns the status line, `extra_headers`, the header lines and the empty line. """
+
+		try:
+			phrase = HTTPStatus(self.status_code).phrase
+		except ValueError:
+			phrase = ''
+
+		header_lines = [f'{key}: {value}\r\n' for key, value in self.headers.items()]
+		header_lines.append('Transfer-Encoding: chunked\r\n\r\n')
+
+		return f'HTTP/1.1 {self.status_code} {phrase}\r\n'.encode('latin-1') + extra_headers + ''.join(header_lines).encode('latin-1')
+
+	def close(self):
+		"""Closes the chunks if they are a generator, releasing what it holds. Must not be called while a chunk is produced. """
+
+		close = getattr(self.chunks, 'close', None)
+		if close is not None:
+			close()
+
+
+LAST_CHUNK = b'0\r\n\r\n'
+
+
+def encode_chunk(data: bytes) -> bytes:
+	"""Returns `data` framed as a chunk of the chunked transfer coding. `data` must not be empty. """
+
+	return b'%x\r\n%b\r\n' % (len(data), data)
+
+
+def encode_body(body: Union[dict, str, bytes]) -> bytes:
+
+	if isinstance(body, dict):
+		body = json.dumps(body)
+	if isinstance(body, str):
+		body = body.encode('utf-8')
+
+	return body
+
+
+_date_cache = (0, '')
+
+def http_date() -> str:
+	"""Returns the current date formatted for the Date header. Formatted once per second. """
+
+	global _date_cache	# pylint: disable=global-statement
+
+	now = int(time.time())
+	if _date_cache[0] != now:
+		_date_cache = (now, email.utils.formatdate(now, usegmt=True))
+
+	return _date_cache[1]
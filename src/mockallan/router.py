@@ -0,0 +1,308 @@
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+import re
+import urllib.parse
+
+
+_NO_VALUE = object()
+_PARAM_RE = re.compile(r'^\{(?P<name>\w+)(?::(?P<regex>.+)|(?P<tail>\*))?\}$')
+
+
+class TemplateError(ValueError):
+	def __init__(self, template: str, reason: str):
+		super().__init__(f'{template}: {reason}')
+
+
+class _Node():
+
+	__slots__ = ('static', 'regex', 'param', 'wildcard', 'tail', 'value')
+
+	def __init__(self):
+
+		self.static: Dict[str, _Node] = {}
+		self.regex: List[Tuple[str, str, re.Pattern, _Node]] = []
+		self.param: List[Tuple[str, _Node]] = []
+		self.wildcard: Optional[_Node] = None
+		self.tail: Optional[Tuple[Optional[str], Any]] = None
+		self.value: Any = _NO_VALUE
+
+
+	def copy(self) -> '_Node':
+
+		node = _Node()
+		node.static = dict(self.static)
+		node.regex = list(self.regex)
+		node.param = list(self.param)
+		node.wildcard = self.wildcard
+		node.tail = self.tail
+		node.value = self.value
+
+		return node
+
+
+class Router():
+	"""Maps (method, path template) keys to values.
+
+	Path template segments:
+		name		Static segment.
+		{name}		Captures one segment as the `name` parameter.
+		{name:regex}	Captures one segment that fully matches `regex`.
+		*		Matches one segment.
+		**		Matches the remaining segments. Last segment only.
+		{name*}		Captures the remaining segments as the `name` parameter. Last segment only.
+
+	Static templates are looked up in a dict. The other templates are compiled into a trie per
+	method, keyed by path segment, so that the lookup cost depends on the path length and not on
+	the number of routes. On a segment, static children take precedence over regex segments,
+	regex segments over parameters, parameters over `*` and `*` over trailing wildcards.
+
+	`copy()` returns a router sharing the trie with this one. Trie nodes are copied on write, so
+	changing a copy copies only the nodes on the path of the changed routes and never affects the
+	lookups on the original.
+
+	"""
+	def __init__(self):
+
+		self._routes: Dict[Tuple[str, str], Any] = {}
+		self._static: Dict[Tuple[str, str], Any] = {}
+		self._roots: Dict[str, _Node] = {}
+		# Nodes created or copied by this router, which it may change in place
+		self._owned_nodes: Set[_Node] = set()
+
+
+	def __len__(self) -> int:
+
+		return len(self._routes)
+
+
+	def items(self) -> Iterator[Tuple[Tuple[str, str], Any]]:
+		"""Yields ((method, template), value) in insertion order. """
+
+		return iter(self._routes.items())
+
+
+	def get(self, method: str, template: str) -> Optional[Any]:
+
+		return self._routes.get((method, template))
+
+
+	def copy(self) -> 'Router':
+
+		# Both routers copy the shared nodes before changing them
+		self._owned_nodes = set()
+		router = Router()
+		router._routes = dict(self._routes)
+		router._static = dict(self._static)
+		router._roots = dict(self._roots)
+
+		return router
+
+
+	def add(self, method: str, template: str, value: Any):
+		"""Adds or replaces the route.
+
+		Raises:
+			TemplateError
+
+		"""
+		if not template.startswith('/'):
+			raise TemplateError(template, "path must start with '/'")
+
+		if is_static(template):
+			self._static[(method, template)] = value
+		else:
+			segments = template.split('/')[1:]
+			for segment in segments[:-1]:
+				if segment == '**' or _tail_name(segment):
+					raise TemplateError(template, f"'{segment}' must be the last segment")
+
+			node = self._own_root(method)
+			for segment in segments:
+				if segment == '**' or _tail_name(segment):
+					node.tail = (_tail_name(segment), value)
+					break
+				node = self._child(template, node, segment)
+			else:
+				node.value = value
+
+		self._routes[(method, template)] = value
+
+
+	def remove(self, method: str, template: str) -> bool:
+		"""Removes the route. Returns False if there is no such route.
+
+		Trie nodes are left in place; they match nothing once they hold no value.
+
+		"""
+		value = self._routes.pop((method, template), _NO_VALUE)
+		if value is _NO_VALUE:
+			return False
+
+		if is_static(template):
+			del self._static[(method, template)]
+			return True
+
+		node = self._own_root(method)
+		segments = template.split('/')[1:]
+		for segment in segments:
+			if segment == '**' or _tail_name(segment):
+				# Templates such as /a/** and /a/{rest*} share the tail of /a
+				if node.tail is not None and node.tail[1] is value:
+					node.tail = None
+				break
+			node = self._child(template, node, segment)
+		else:
+			if node.value is value:
+				node.value = _NO_VALUE
+
+		return True
+
+
+	def lookup(self, method: str, path: str) -> Optional[Tuple[Any, Dict[str, str]]]:
+		"""Returns (value, path parameters) of the route matching `path` or None. """
+
+		value = self._static.get((method, path))
+		if value is not None:
+			return value, {}
+
+		root = self._roots.get(method)
+		if root is None:
+			return None
+
+		params: Dict[str, str] = {}
+		value = _match(root, path.split('/')[1:], 0, params)
+		if value is _NO_VALUE:
+			return None
+
+		return value, params
+
+
+	def _own_root(self, method: str) -> _Node:
+
+		root = self._roots.get(method)
+		root = self._roots[method] = self._new_node() if root is None else self._own(root)
+
+		return root
+
+
+	def _new_node(self) -> _Node:
+
+		node = _Node()
+		self._owned_nodes.add(node)
+
+		return node
+
+
+	def _own(self, node: _Node) -> _Node:
+		"""Returns `node` if this router owns it, otherwise an owned copy. """
+
+		if node in self._owned_nodes:
+			return node
+
+		node = node.copy()
+		self._owned_nodes.add(node)
+
+		return node
+
+
+	def _child(self, template: str, node: _Node, segment: str) -> _Node:
+		"""Returns the owned child of the owned `node` for `segment`. Adds it if needed. """
+
+		if segment == '*':
+			node.wildcard = self._new_node() if node.wildcard is None else self._own(node.wildcard)
+			return node.wildcard
+
+		match = _PARAM_RE.match(segment)
+		if match is None:
+			if '{' in segment or '}' in segment:
+				raise TemplateError(template, f"'{segment}': invalid segment")
+			child = node.static.get(segment)
+			child = node.static[segment] = self._new_node() if child is None else self._own(child)
+			return child
+
+		name = match['name']
+		regex = match['regex']
+		if regex is None:
+			for index, (param_name, child) in enumerate(node.param):
+				if param_name == name:
+					child = self._own(child)
+					node.param[index] = (name, child)
+					return child
+			child = self._new_node()
+			node.param.append((name, child))
+			return child
+
+		for index, (param_name, param_regex, pattern, child) in enumerate(node.regex):
+			if param_name == name and param_regex == regex:
+				child = self._own(child)
+				node.regex[index] = (name, regex, pattern, child)
+				return child
+		try:
+			pattern = re.compile(regex)
+		except re.error as e:
+			raise TemplateError(template, f'{e.__class__.__name__}: {e}') from e
+		child = self._new_node()
+		node.regex.append((name, regex, pattern, child))
+
+		return child
+
+
+def is_static(template: str) -> bool:
+
+	return '{' not in template and '*' not in template
+
+
+def _tail_name(segment: str) -> Optional[str]:
+
+	match = _PARAM_RE.match(segment)
+	if match is not None and match['tail']:
+		return match['name']
+
+	return None
+
+
+def _match(node: _Node, segments: List[str], index: int, params: Dict[str, str]) -> Any:
+
+	if index == len(segments):
+		if node.value is not _NO_VALUE:
+			return node.value
+		if node.tail is not None:
+			name, value = node.tail
+			if name:
+				params[name] = ''
+			return value
+		return _NO_VALUE
+
+	segment = segments[index]
+
+	child = node.static.get(segment)
+	if child is not None:
+		value = _match(child, segments, index + 1, params)
+		if value is not _NO_VALUE:
+			return value
+
+	if segment:
+		for name, _, pattern, child in node.regex:
+			if pattern.fullmatch(segment):
+				value = _match(child, segments, index + 1, params)
+				if value is not _NO_VALUE:
+					params[name] = urllib.parse.unquote(segment)
+					return value
+
+		for name, child in node.param:
+			value = _match(child, segments, index + 1, params)
+			if value is not _NO_VALUE:
+				params[name] = urllib.parse.unquote(segment)
+				return value
+
+		if node.wildcard is not None:
+			value = _match(node.wildcard, segments, index + 1, params)
+			if value is not _NO_VALUE:
+				return value
+
+	if node.tail is not None:
+		name, value = node.tail
+		if name:
+			params[name] = urllib.parse.unquote('/'.join(segments[index:]))
+		return value
+
+	return _NO_VALUE
@@ -1,6 +1,17 @@
-from typing import Union, Optional, List
+from typing import Union, Optional, List, Dict, Any, Tuple
+import base64
+import binascii
+import itertools
 import json
+import random
+import re
+import threading
+import time
+import uuid
 from .request import HTTPRequest, HTTPResponse
+from .router import Router, TemplateError
+from .jsonpath import compile_path
+from .predicates import RequestPredicate, DecisionTree, canonical
 
 
 class MissingProperty(Exception):
@@ -13,12 +24,232 @@ class UnexpectedProperty(Exception):
 		super().__init__(f'{property}: unexpected property')
 
 
+_PLACEHOLDER_RE = re.compile(r'\{\{(\w+)\}\}')
+
+SEQUENCE_POLICIES = ('stick', 'cycle', 'random')
+
+
+class LocalCounter():
+	"""Lock-free counter. `next()` on `itertools.count` is atomic under the GIL.
+
+	`value` is the number of positions taken so far. It may lag behind under concurrent use.
+
+	"""
+	def __init__(self):
+
+		self._count = itertools.count()
+		self.value = 0
+
+
+	def __next__(self) -> int:
+
+		position = next(self._count)
+		self.value = position + 1
+
+		return position
+
+
+class SequenceCursor():
+	"""Position of an endpoint in its response sequence.
+
+	Policies:
+		stick	Advances through the responses and sticks on the last one.
+		cycle	Starts over after the last response.
+		random	Picks a random response. With a `seed`, the response served at each position
+			is reproducible regardless of how the requests interleave.
+
+	"""
+	__slots__ = ('length', 'policy', 'seed', '_counter')
+
+	def __init__(self, length: int, policy: str = 'stick', seed: Optional[int] = None, counter=None):
+
+		if policy not in SEQUENCE_POLICIES:
+			raise ValueError(f"'{policy}': unsupported sequence policy")
+
+		self.length = length
+		self.policy = policy
+		self.seed = seed
+		self._counter = LocalCounter() if counter is None else counter
+
+
+	@property
+	def position(self) -> int:
+
+		return self._counter.value
+
+
+	def next_index(self) -> int:
+
+		position = next(self._counter)
+		if self.policy == 'stick':
+			return min(position, self.length - 1)
+		if self.policy == 'cycle':
+			return position % self.length
+		if self.seed is None:
+			return random.randrange(self.length)
+
+		return random.Random(hash((self.seed, position))).randrange(self.length)
+
+
+class StubEndpoint():
+	"""Configured response of an endpoint for the requests matching `predicate`.
+
+	`templated` is True if the response contains `{{name}}` placeholders to be replaced with the
+	path parameters captured by the endpoint path template. `cursor` selects the response to serve
+	when the response is a sequence. `index` lists the canonical JSONPath expressions of the
+	request body fields that the history indexes.
+
+	"""
+	__slots__ = ('response', 'templated', 'predicate', 'priority', 'cursor', 'index')
+
+	def __init__(
+			self,
+			response: Union[HTTPResponse, List[HTTPResponse]],
+			predicate: Optional[RequestPredicate] = None,
+			priority: int = 0,
+			cursor: Optional[SequenceCursor] = None,
+			index: Tuple[str, ...] = ()):
+
+		self.response = response
+		responses = response if isinstance(response, list) else [response]
+		self.templated = any(_has_placeholders([r.headers, r.body]) for r in responses)
+		self.predicate = predicate or RequestPredicate()
+		self.priority = priority
+		self.cursor = cursor
+		self.index = index
+
+
+	def next_response(self) -> HTTPResponse:
+
+		if self.cursor is None:
+			return self.response
+
+		return self.response[self.cursor.next_index()]
+
+
+class StubRoute():
+	"""Stub endpoints sharing a (method, path template), selected by their request predicates.
+
+	Among the matching endpoints the highest priority wins, then the one with most conditions, then
+	the first configured. The decision tree is built on the first lookup.
+
+	Routes are immutable so that they can be replaced while being looked up. `with_endpoint()` and
+	`without_endpoint()` return a new route.
+
+	Args:
+		stub_endpoints (dict):	Stub endpoints by `RequestPredicate.key`.
+
+	"""
+	__slots__ = ('_stub_endpoints', '_decision_tree')
+
+	def __init__(self, stub_endpoints: Optional[dict] = None):
+
+		self._stub_endpoints = stub_endpoints or {}
+		self._decision_tree: Optional[DecisionTree] = None
+
+
+	def __iter__(self):
+
+		return iter(self._stub_endpoints.values())
+
+
+	def __len__(self) -> int:
+
+		return len(self._stub_endpoints)
+
+
+	def cursors(self) -> List[SequenceCursor]:
+
+		return [stub_endpoint.cursor for stub_endpoint in self._stub_endpoints.values() if stub_endpoint.cursor is not None]
+
+
+	def with_endpoint(self, stub_endpoint: StubEndpoint) -> 'StubRoute':
+		"""Returns a route with `stub_endpoint` replacing the endpoint with the same predicate. """
+
+		stub_endpoints = dict(self._stub_endpoints)
+		stub_endpoints[stub_endpoint.predicate.key] = stub_endpoint
+
+		return StubRoute(stub_endpoints)
+
+
+	def without_endpoint(self, predicate: RequestPredicate) -> Optional['StubRoute']:
+		"""Returns a route without the endpoint with `predicate` or None if no endpoint is left. """
+
+		stub_endpoints = dict(self._stub_endpoints)
+		stub_endpoints.pop(predicate.key, None)
+
+		return StubRoute(stub_endpoints) if stub_endpoints else None
+
+
+	def match(self, request: HTTPRequest) -> Optional[StubEndpoint]:
+
+		if len(self._stub_endpoints) == 1:
+			stub_endpoint = next(iter(self._stub_endpoints.values()))
+			if not stub_endpoint.predicate:
+				return stub_endpoint
+
+		decision_tree = self._decision_tree
+		if decision_tree is None:
+			decision_tree = DecisionTree([
+				(
+					stub_endpoint,
+					stub_endpoint.predicate,
+					(-stub_endpoint.priority, -len(stub_endpoint.predicate.conditions), order)
+				)
+				for order, stub_endpoint in enumerate(self._stub_endpoints.values())
+			])
+			self._decision_tree = decision_tree
+
+		return decision_tree.match(request)
+
+
+class ConfigSnapshot():
+	"""Immutable stub configuration.
+
+	Attributes:
+		generation (int):		Incremented by every configuration change.
+		default_response (HTTPResponse):
+		endpoints (Router):		Per-endpoint StubRoute mapping.
+		cursors (frozenset):		Sequence cursors of the endpoints.
+		timestamp (float):		Creation time, in seconds since the epoch.
+
+	"""
+	__slots__ = ('generation', 'default_response', 'endpoints', 'cursors', 'timestamp')
+
+	def __init__(self, generation: int, default_response: HTTPResponse, endpoints: Router, cursors: frozenset):
+
+		self.generation = generation
+		self.default_response = default_response
+		self.endpoints = endpoints
+		self.cursors = cursors
+		self.timestamp = time.time()
+
+
+	@property
+	def version(self) -> str:
+		"""Changes whenever the configuration changes or a sequence advances. """
+
+		if not self.cursors:
+			return str(self.generation)
+
+		return f'{self.generation}.{sum(cursor.position for cursor in self.cursors)}'
+
+
 class StubConfig():
 	"""Stub Configuration. Holds default and per-endpoint responses.
 
+	Endpoint paths are either literal paths or path templates. See `Router`. Endpoints sharing a
+	path may set predicates on the request query, headers and body. See `RequestPredicate`.
+	Endpoints configured with a response list serve it as a sequence. See `SequenceCursor`.
+
 	Attributes:
-		_default_response (HTTPResponse):			Default response.
-		_endpoints (Dict[Tuple[str, str], HTTPResponse]):	Per-endpoint response mapping.
+		_snapshot (ConfigSnapshot):	Current configuration.
+
+	The configuration is an immutable `ConfigSnapshot`. Changes build a new snapshot under `_lock`
+	and swap it in with a single assignment, so that `lookup()` reads the current snapshot without
+	locking and never sees a partially applied change. Incremental changes copy the router, which
+	copies only the trie nodes on the path of the changed routes. Configured responses are
+	compiled into their wire format at load time and must not be modified afterwards.
 
 	"""
 	_FACTORY_DEFAULT_RESPONSE = HTTPResponse(
@@ -39,8 +270,9 @@ class StubConfig():
 			config_json (Union[dict, str]):	If type is a `str` then it is the path to a stub config JSON file.
 
 		"""
-		self._default_response = StubConfig._FACTORY_DEFAULT_RESPONSE
-		self._endpoints = {}
+		self._lock = threading.Lock()
+		self._instance_id = uuid.uuid4().hex[:12]
+		self._snapshot = ConfigSnapshot(0, StubConfig._FACTORY_DEFAULT_RESPONSE, Router(), frozenset())
 
 		if config_json is not None:
 			if isinstance(config_json, dict):
@@ -52,7 +284,19 @@ class StubConfig():
 
 	@property
 	def default_response(self) -> HTTPResponse:
-		return self._default_response
+		return self._snapshot.default_response
+
+
+	@property
+	def snapshot(self) -> ConfigSnapshot:
+		return self._snapshot
+
+
+	@property
+	def instance_id(self) -> str:
+		"""Random id of this configuration. Tells apart the generations of different server runs. """
+
+		return self._instance_id
 
 
 	def load_json(self, config_json: dict):
@@ -61,6 +305,8 @@ class StubConfig():
 		Raises:
 			MissingProperty
 			TypeError
+			ValueError
+			TemplateError
 
 		"""
 		try:
@@ -69,21 +315,204 @@ class StubConfig():
 		except KeyError as e:
 			raise MissingProperty(e) from e
 
-		self._default_response = HTTPResponse(**default_response_json)
+		default_response = self._load_response(default_response_json)
 
-		self._endpoints = {}
+		routes: Dict[Tuple[str, str], dict] = {}
+		for endpoint_json in config_json.get('endpoints', []):
+			method, path, stub_endpoint = self._load_endpoint_json(endpoint_json)
+			routes.setdefault((method, path), {})[stub_endpoint.predicate.key] = stub_endpoint
 
-		endpoints_json = config_json.get('endpoints', [])
-		for endpoint_json in endpoints_json:
-			try:
-				request_json = endpoint_json['request']
-			except KeyError as e:
-				raise MissingProperty(e) from e
+		endpoints = Router()
+		cursors = set()
+		for (method, path), stub_endpoints in routes.items():
+			stub_route = StubRoute(stub_endpoints)
+			endpoints.add(method, path, stub_route)
+			cursors.update(stub_route.cursors())
+
+		with self._lock:
+			self._publish(default_response, endpoints, frozenset(cursors))
+
+
+	def patch_json(self, patch_json: dict):
+		"""Applies a merge patch to the configuration.
+
+		`defaults` is merged into the current defaults as a JSON Merge Patch (RFC 7396). Each item of
+		`endpoints` replaces the endpoint with the same method, path and request predicates, or
+		deletes it if its `response` is null. The other endpoints are left untouched.
+
+		The patch is validated before any change is made.
+
+		Raises:
+			MissingProperty
+			TypeError
+			ValueError
+			TemplateError
+
+		"""
+		if not isinstance(patch_json, dict):
+			raise TypeError(f"merge patch must be {dict} but it is actually {type(patch_json)}")
+
+		upserts = []
+		deletes = []
+		for endpoint_json in patch_json.get('endpoints', []):
+			if 'response' in endpoint_json and endpoint_json['response'] is None:
+				request = self._load_request_json(endpoint_json)
+				deletes.append((request.method.upper(), request.path, RequestPredicate.from_request(request)))
+			else:
+				upserts.append(self._load_endpoint_json(endpoint_json))
+
+		# Raises TemplateError before any change
+		templates = Router()
+		for method, path, _ in upserts:
+			templates.add(method, path, None)
+
+		with self._lock:
+			snapshot = self._snapshot
+			default_response = snapshot.default_response
+			if 'defaults' in patch_json:
+				default_response_json = StubConfig._dump_response_json(default_response)
+				defaults_patch_json = patch_json['defaults']
+				response_patch_json = defaults_patch_json.get('response') if isinstance(defaults_patch_json, dict) else None
+				if isinstance(response_patch_json, dict) and {'body', 'body_base64'} & response_patch_json.keys():
+					# A new body replaces the current one whichever its encoding
+					default_response_json.pop('body', None)
+					default_response_json.pop('body_base64', None)
+				defaults_json = merge_patch({"response": default_response_json}, patch_json['defaults'])
+				try:
+					default_response = StubConfig._load_response(defaults_json['response'])
+				except KeyError as e:
+					raise MissingProperty(e) from e
+
+			endpoints = snapshot.endpoints.copy()
+			cursors = set(snapshot.cursors)
+			for method, path, stub_endpoint in upserts:
+				self._upsert(endpoints, cursors, method, path, stub_endpoint)
+			for method, path, predicate in deletes:
+				stub_route = endpoints.get(method, path)
+				if stub_route is not None:
+					self._replace_route(endpoints, cursors, method, path, stub_route.without_endpoint(predicate))
+
+			self._publish(default_response, endpoints, frozenset(cursors))
+
+
+	def upsert_endpoint(self, method: str, path: str, endpoint_json: dict):
+		"""Adds the endpoint or replaces the endpoint with the same request predicates.
+
+		`endpoint_json` is an endpoint JSON object whose `request` may be omitted. Its method and
+		path, if any, are overridden.
+
+		Raises:
+			MissingProperty
+			TypeError
+			ValueError
+			TemplateError
+
+		"""
+		if not isinstance(endpoint_json, dict):
+			raise TypeError(f"endpoint must be {dict} but it is actually {type(endpoint_json)}")
+
+		request_json = dict(endpoint_json.get('request', {}), method=method, path=path)
+		method, path, stub_endpoint = self._load_endpoint_json(dict(endpoint_json, request=request_json))
+		with self._lock:
+			snapshot = self._snapshot
+			endpoints = snapshot.endpoints.copy()
+			cursors = set(snapshot.cursors)
+			self._upsert(endpoints, cursors, method, path, stub_endpoint)
+			self._publish(snapshot.default_response, endpoints, frozenset(cursors))
 
-			request = HTTPRequest(**request_json)
-			endpoint = (request.method.upper(), request.path)
 
-			self._endpoints[endpoint] = StubConfig._load_response_json(endpoint_json)
+	def delete_endpoint(self, method: str, path: str) -> bool:
+		"""Deletes all the endpoints of `method` and `path`. Returns False if there were none. """
+
+		method = method.upper()
+		with self._lock:
+			snapshot = self._snapshot
+			if snapshot.endpoints.get(method, path) is None:
+				return False
+			endpoints = snapshot.endpoints.copy()
+			cursors = set(snapshot.cursors)
+			self._replace_route(endpoints, cursors, method, path, None)
+			self._publish(snapshot.default_response, endpoints, frozenset(cursors))
+
+		return True
+
+
+	def _publish(self, default_response: HTTPResponse, endpoints: Router, cursors: frozenset) -> ConfigSnapshot:
+		"""Swaps in a new snapshot. Called holding `_lock`. Overridden to share snapshots between processes. """
+
+		self._snapshot = ConfigSnapshot(self._snapshot.generation + 1, default_response, endpoints, cursors)
+
+		return self._snapshot
+
+
+	@staticmethod
+	def _upsert(endpoints: Router, cursors: set, method: str, path: str, stub_endpoint: StubEndpoint):
+
+		stub_route = endpoints.get(method, path)
+		if stub_route is None:
+			stub_route = StubRoute({stub_endpoint.predicate.key: stub_endpoint})
+		else:
+			stub_route = stub_route.with_endpoint(stub_endpoint)
+		StubConfig._replace_route(endpoints, cursors, method, path, stub_route)
+
+
+	@staticmethod
+	def _replace_route(endpoints: Router, cursors: set, method: str, path: str, stub_route: Optional[StubRoute]):
+		"""Replaces or removes a route of a router that is not published yet. """
+
+		old_stub_route = endpoints.get(method, path)
+		if old_stub_route is not None:
+			cursors.difference_update(old_stub_route.cursors())
+
+		if stub_route is None:
+			endpoints.remove(method, path)
+		else:
+			endpoints.add(method, path, stub_route)
+			cursors.update(stub_route.cursors())
+
+
+	@staticmethod
+	def _load_request_json(endpoint_json: dict) -> HTTPRequest:
+
+		try:
+			request_json = endpoint_json['request']
+		except KeyError as e:
+			raise MissingProperty(e) from e
+
+		return HTTPRequest(**request_json)
+
+
+	def _load_endpoint_json(self, endpoint_json: dict) -> Tuple[str, str, StubEndpoint]:
+
+		request = self._load_request_json(endpoint_json)
+		method = request.method.upper()
+		response = StubConfig._load_response_json(endpoint_json)
+		priority = endpoint_json.get('priority', 0)
+		if not isinstance(priority, int):
+			raise TypeError(f"'priority' must be {int} but it is actually {type(priority)}")
+		predicate = RequestPredicate.from_request(request)
+		cursor = None
+		if isinstance(response, list):
+			cursor = self._load_cursor_json(endpoint_json, (method, request.path), predicate, len(response))
+		index = StubConfig._load_index_json(endpoint_json)
+
+		return method, request.path, StubEndpoint(response, predicate, priority, cursor, index)
+
+
+	@staticmethod
+	def _load_index_json(endpoint_json: dict) -> Tuple[str, ...]:
+		"""Returns the canonical JSONPath expressions of the endpoint `index`.
+
+		Raises:
+			TypeError
+			JSONPathError
+
+		"""
+		index_json = endpoint_json.get('index', [])
+		if not isinstance(index_json, list) or not all(isinstance(expression, str) for expression in index_json):
+			raise TypeError(f"'index' must be a list of {str} but it is actually {index_json!r}")
+
+		return tuple(dict.fromkeys(compile_path(expression).expression for expression in index_json))
 
 
 	@staticmethod
@@ -95,53 +524,95 @@ class StubConfig():
 			raise MissingProperty(e) from e
 
 		if isinstance(response_json, dict):
-			response = HTTPResponse(**response_json)
+			response = StubConfig._load_response(response_json)
 		elif isinstance(response_json, List):
-			response = [HTTPResponse(**response_json_item) for response_json_item in response_json]
+			if not response_json:
+				raise ValueError('Error loading response JSON element. Empty response list')
+			response = [StubConfig._load_response(response_json_item) for response_json_item in response_json]
 		else:
 			raise ValueError(f'Error loading response JSON element. Invalid type {type(response_json)}')
 
 		return response
 
 
-	def dump_json(self) -> dict:
+	@staticmethod
+	def _load_response(response_json: dict) -> HTTPResponse:
+		"""Returns the compiled response. A `body_base64` property is decoded once, into a bytes body.
 
-		default_response_json = {
-			"status_code": self._default_response.status_code,
-			"headers": self._default_response.headers,
-			"body": self._default_response.body
-		}
+		Raises:
+			TypeError
+			ValueError	If `body_base64` is not valid base64 or is given along with `body`.
+
+		"""
+		if not isinstance(response_json, dict):
+			raise TypeError(f"'response' must be {dict} but it is actually {type(response_json)}")
+
+		if 'body_base64' in response_json:
+			response_json = dict(response_json)
+			body_base64 = response_json.pop('body_base64')
+			if 'body' in response_json:
+				raise ValueError("'body' and 'body_base64' are mutually exclusive")
+			if not isinstance(body_base64, str):
+				raise TypeError(f"'body_base64' must be {str} but it is actually {type(body_base64)}")
+			try:
+				response_json['body'] = base64.b64decode(body_base64, validate=True)
+			except binascii.Error as e:
+				raise ValueError(f"'body_base64': {e}") from e
+
+		response = HTTPResponse(**response_json)
+		response.compile()
+
+		return response
+
+
+	def _load_cursor_json(
+			self,
+			endpoint_json: dict,
+			endpoint: Tuple[str, str],
+			predicate: RequestPredicate,
+			length: int) -> SequenceCursor:
+
+		sequence_json = endpoint_json.get('sequence', 'stick')
+		if isinstance(sequence_json, str):
+			sequence_json = {'policy': sequence_json}
+		if not isinstance(sequence_json, dict):
+			raise TypeError(f"'sequence' must be {str} or {dict} but it is actually {type(sequence_json)}")
+
+		seed = sequence_json.get('seed')
+		if seed is not None and not isinstance(seed, int):
+			raise TypeError(f"'seed' must be {int} but it is actually {type(seed)}")
+
+		cursor_key = (endpoint[0], endpoint[1], canonical([predicate.query, predicate.headers, predicate.body]))
+
+		return SequenceCursor(
+			length,
+			sequence_json.get('policy', 'stick'),
+			seed,
+			self._create_counter(cursor_key)
+		)
+
+
+	def _create_counter(self, cursor_key: Tuple[str, str, str]):	# pylint: disable=unused-argument
+		"""Returns the counter of a sequence cursor. Overridden to share cursors between processes. """
+
+		return LocalCounter()
+
+
+	def dump_json(self, snapshot: Optional[ConfigSnapshot] = None) -> dict:
+		"""Returns the JSON stub configuration of `snapshot`. Defaults to the current one. """
+
+		return StubConfig._dump_snapshot_json(self._snapshot if snapshot is None else snapshot)
+
+
+	@staticmethod
+	def _dump_snapshot_json(snapshot: ConfigSnapshot) -> dict:
+
+		default_response_json = StubConfig._dump_response_json(snapshot.default_response)
 
 		endpoints_json = []
-		for endpoint, response in self._endpoints.items():
-			method = endpoint[0]
-			path = endpoint[1]
-
-			if isinstance(response, List):
-				output_response = []
-				for response_item in response:
-					output_response.append(
-						{
-							"status_code": response_item.status_code,
-							"headers": response_item.headers,
-							"body": response_item.body
-						}
-					)
-			elif isinstance(response, HTTPResponse):
-				output_response = {
-					"status_code": response.status_code,
-					"headers": response.headers,
-					"body": response.body
-				}
-
-			endpoint_json = {
-				"request": {
-					"method": method,
-					"path": path
-				},
-				"response": output_response
-			}
-			endpoints_json.append(endpoint_json)
+		for endpoint, stub_route in snapshot.endpoints.items():
+			for stub_endpoint in stub_route:
+				endpoints_json.append(StubConfig._dump_endpoint_json(endpoint, stub_endpoint))
 
 		return {
 			"defaults": {
@@ -151,11 +622,146 @@ class StubConfig():
 		}
 
 
-	def lookup(self, request: HTTPRequest) -> Optional[HTTPResponse]:
+	@staticmethod
+	def _dump_response_json(response: HTTPResponse) -> dict:
 
-		endpoint = HTTPRequest.endpoint(request)
-		response =  self._endpoints.get(endpoint)
-		if response is None:
-			response = self._default_response
+		response_json = {
+			"status_code": response.status_code,
+			"headers": response.headers
+		}
+		if isinstance(response.body, bytes):
+			response_json['body_base64'] = base64.b64encode(response.body).decode('ascii')
+		else:
+			response_json['body'] = response.body
 
-		return response
+		return response_json
+
+
+	@staticmethod
+	def _dump_endpoint_json(endpoint: Tuple[str, str], stub_endpoint: StubEndpoint) -> dict:
+
+		response = stub_endpoint.response
+		if isinstance(response, List):
+			output_response = [StubConfig._dump_response_json(response_item) for response_item in response]
+		else:
+			output_response = StubConfig._dump_response_json(response)
+
+		request_json = {
+			"method": endpoint[0],
+			"path": endpoint[1]
+		}
+		predicate = stub_endpoint.predicate
+		if predicate.query:
+			request_json['query'] = predicate.query
+		if predicate.headers:
+			request_json['headers'] = predicate.headers
+		if predicate.body is not None:
+			request_json['body'] = predicate.body
+
+		endpoint_json = {
+			"request": request_json,
+			"response": output_response
+		}
+		if stub_endpoint.priority:
+			endpoint_json['priority'] = stub_endpoint.priority
+		if stub_endpoint.index:
+			endpoint_json['index'] = list(stub_endpoint.index)
+		cursor = stub_endpoint.cursor
+		if cursor is not None:
+			endpoint_json['sequence'] = {
+				"policy": cursor.policy,
+				"position": cursor.position
+			}
+			if cursor.seed is not None:
+				endpoint_json['sequence']['seed'] = cursor.seed
+
+		return endpoint_json
+
+
+	def lookup(self, request: HTTPRequest, snapshot: Optional[ConfigSnapshot] = None) -> HTTPResponse:
+		"""Returns the response configured for the request endpoint or the default response.
+
+		Sets `request.path_params` to the parameters captured by the endpoint path template.
+
+		Args:
+			request (HTTPRequest):
+			snapshot (ConfigSnapshot):	Configuration to look up. Defaults to the current one.
+
+		"""
+		if snapshot is None:
+			snapshot = self._snapshot
+
+		return self.lookup_indexed(request, snapshot)[0]
+
+
+	def lookup_indexed(self, request: HTTPRequest, snapshot: ConfigSnapshot) -> Tuple[HTTPResponse, Tuple[str, ...]]:
+		"""Returns the response as `lookup()` does, along with the `index` of the endpoint. """
+
+		default_response = snapshot.default_response
+
+		method, path = HTTPRequest.endpoint(request)
+		match = snapshot.endpoints.lookup(method, path)
+		if match is None:
+			return default_response, ()
+
+		stub_route, path_params = match
+		request.path_params = path_params
+		stub_endpoint = stub_route.match(request)
+		if stub_endpoint is None:
+			return default_response, ()
+
+		response = stub_endpoint.next_response()
+		if stub_endpoint.templated and path_params:
+			return _render_response(response, path_params), stub_endpoint.index
+
+		return response, stub_endpoint.index
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+	"""Returns `target` with the JSON Merge Patch `patch` applied (RFC 7396). """
+
+	if not isinstance(patch, dict):
+		return patch
+
+	result = dict(target) if isinstance(target, dict) else {}
+	for name, value in patch.items():
+		if value is None:
+			result.pop(name, None)
+		else:
+			result[name] = merge_patch(result.get(name), value)
+
+	return result
+
+
+def _has_placeholders(value: Any) -> bool:
+
+	if isinstance(value, str):
+		return _PLACEHOLDER_RE.search(value) is not None
+	if isinstance(value, dict):
+		return any(_has_placeholders(item) for item in value.values())
+	if isinstance(value, list):
+		return any(_has_placeholders(item) for item in value)
+
+	return False
+
+
+def _render(value: Any, path_params: Dict[str, str]) -> Any:
+	"""Replaces `{{name}}` placeholders with path parameters. Unknown names are left as is. """
+
+	if isinstance(value, str):
+		return _PLACEHOLDER_RE.sub(lambda match: path_params.get(match[1], match[0]), value)
+	if isinstance(value, dict):
+		return {key: _render(item, path_params) for key, item in value.items()}
+	if isinstance(value, list):
+		return [_render(item, path_params) for item in value]
+
+	return value
+
+
+def _render_response(response: HTTPResponse, path_params: Dict[str, str]) -> HTTPResponse:
+
+	return HTTPResponse(
+		response.status_code,
+		_render(response.headers, path_params),
+		_render(response.body, path_params)
+	)
@@ -1,53 +1,160 @@
+from typing import Any, Dict, List, Optional, Pattern, Tuple, Type, Union
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import functools
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
 import re
+import signal
+import threading
 from lxml import etree
 import jsonschema
+from .jsonpath import JSONPath, JSONPathError, compile_path
+from .predicates import canonical, flatten_fields
 from .request import HTTPRequest
 
 
+# Bounds of the ValidatorCache by default
+DEFAULT_MAX_CACHED_VALIDATORS = 256
+DEFAULT_MAX_CACHED_BYTES = 16 * 1024 * 1024
+
+# Bound of the ParsedBodyCache by default
+DEFAULT_MAX_PARSED_BYTES = 64 * 1024 * 1024
+
+# Bodies per task of the ValidationPool by default
+DEFAULT_VALIDATION_CHUNK_SIZE = 2000
+
+# Seconds a regex may search the bodies of an assertion by default, and at most
+DEFAULT_REGEX_TIME_LIMIT = 10.0
+MAX_REGEX_TIME_LIMIT = 300.0
+
+# Header of the regex assert requests setting their time limit
+REGEX_TIME_LIMIT_HEADER = 'X-Mockallan-Regex-Time-Limit'
+
+# Seconds the RegexMatcher process may take to start
+_REGEX_MATCHER_START_TIMEOUT = 60.0
+
+# Parsed body formats
+BODY_JSON = 'json'
+BODY_XML = 'xml'
+
+# Estimated size of a parsed body per byte of body
+_PARSED_SIZE_FACTOR = 4
+
+# JSON text bodies up to this size have their digest memoized
+_MAX_MEMOIZED_DIGEST_BODY = 4096
+
+
+class RegexError(Exception):
+	"""Raised if the pattern or the time limit of a regex assertion is invalid. """
+
+
+class RegexTimeoutError(RegexError):
+	"""Raised if searching a regex takes longer than its time limit. """
+
+
 class Validator(ABC):
+	"""Validates the bodies of recorded requests.
+
+	Validators of parsed bodies set `body_format` and implement `validate_document()`, so that the
+	body of a record can be parsed once for all the assertions validating it.
+
+	"""
+	body_format: Optional[str] = None
 
 	@abstractmethod
 	def validate(self, request: HTTPRequest) -> bool:
 		...
 
+	def validate_document(self, document: Any) -> bool:
+		"""Validates a body parsed with `parse_body(self.body_format, body)`. """
+
+		raise NotImplementedError
+
 
 class IsEqualValidator(Validator):
-	"""Validates that request bodies are equal. """
+	"""Validates that request bodies are equal, comparing their `body_digest()`.
 
+	JSON documents are compared whatever their key order and whitespace, and whether they are
+	bodies decoded or JSON text.
+
+	"""
 	def __init__(self, validation_request: HTTPRequest):
 		self._validation_request = validation_request
+		self.digest = body_digest(validation_request.body)
 	
 	def validate(self, request: HTTPRequest) -> bool:
 
-		return request.body == self._validation_request.body
+		return body_digest(request.body) == self.digest
 
 
 class JSONSchemaValidator(Validator):
-	"""Validates a JSON request with a JSON schema. """
+	"""Validates a JSON request with a JSON schema.
+
+	The schema is checked and compiled once. JSON documents in str or bytes bodies are decoded,
+	both in the validation request and in the requests validated. Bodies which are not valid JSON
+	are not valid.
+
+	Raises:
+		jsonschema.SchemaError	If the schema is not valid JSON or not a valid JSON schema.
+
+	"""
+	body_format = BODY_JSON
 
 	def __init__(self, validation_request: HTTPRequest):
-		self._validation_request = validation_request
-	
+
+		schema = validation_request.body
+		if isinstance(schema, (str, bytes)):
+			try:
+				schema = json.loads(schema)
+			except ValueError as e:
+				raise jsonschema.SchemaError(f'The schema is not valid JSON: {e}') from e
+
+		validator_class = jsonschema.validators.validator_for(schema)
+		validator_class.check_schema(schema)
+		self._validator = validator_class(schema)
+
 	def validate(self, request: HTTPRequest) -> bool:
 
 		try:
-			jsonschema.validate(request.body, self._validation_request.body)
-		except jsonschema.ValidationError:
+			document = parse_body(BODY_JSON, request.body)
+		except ValueError:
 			return False
 
-		return True
+		return self.validate_document(document)
+
+	def validate_document(self, document: Any) -> bool:
+
+		return self._validator.is_valid(document)
 
 
 class XMLSchemaValidator(Validator):
-	"""Validates a XML request with a XML schema. """
+	"""Validates a XML request with a XML schema. Bodies which are not well-formed XML are not valid. """
+
+	body_format = BODY_XML
 
 	def __init__(self, validation_request: HTTPRequest):
-		self._schema = etree.XMLSchema(etree.fromstring(validation_request.body))
-	
+		self._schema = etree.XMLSchema(parse_body(BODY_XML, validation_request.body))
+		# XMLSchema objects must not validate in many threads at a time
+		self._lock = threading.Lock()
+
 	def validate(self, request: HTTPRequest) -> bool:
 
-		return self._schema.validate(etree.fromstring(request.body))
+		try:
+			document = parse_body(BODY_XML, request.body)
+		except ValueError:
+			return False
+
+		return self.validate_document(document)
+
+	def validate_document(self, document: Any) -> bool:
+
+		with self._lock:
+			return self._schema.validate(document)
 
 
 class RegexValidator(Validator):
@@ -56,12 +163,574 @@ class RegexValidator(Validator):
 	Requires that the assert request includes the header
 	'X-Mockallan-Validator: regex' to explicitly select this validator.
 
+	See `regex_search()`. The header 'X-Mockallan-Regex-Time-Limit' sets the seconds that a
+	`RegexMatcher` may search the bodies of an assertion.
+
+	Raises:
+		RegexError	If the pattern or the time limit is invalid.
+
+	"""
+	def __init__(self, validation_request: HTTPRequest):
+
+		pattern = validation_request.body
+		if isinstance(pattern, (bytes, bytearray)):
+			try:
+				pattern = bytes(pattern).decode('utf-8')
+			except UnicodeDecodeError as e:
+				raise RegexError(f'The regex is not valid UTF-8: {e}') from e
+		if not isinstance(pattern, str):
+			raise RegexError(f'The regex must be text but it is {type(pattern).__name__}')
+		try:
+			_compile_regex(pattern)
+		except re.error as e:
+			raise RegexError(f'The regex is not valid: {e}') from e
+		self.pattern = pattern
+
+		time_limit = validation_request.headers.get(REGEX_TIME_LIMIT_HEADER)
+		try:
+			self.time_limit = DEFAULT_REGEX_TIME_LIMIT if time_limit is None else float(time_limit)
+		except ValueError:
+			self.time_limit = -1.0
+		# Also rejects nan
+		if not 0 < self.time_limit <= MAX_REGEX_TIME_LIMIT:
+			raise RegexError(
+				f"Header `{REGEX_TIME_LIMIT_HEADER}` must be a number of seconds greater than 0 and up to "
+				f"{MAX_REGEX_TIME_LIMIT:g} but it is '{time_limit}'"
+			)
+
+	def validate(self, request: HTTPRequest) -> bool:
+
+		return regex_search(self.pattern, request.body)
+
+
+class JSONPathValidator(Validator):
+	"""Validates that fields of a JSON request have the expected values.
+
+	Requires that the assert request includes the header
+	'X-Mockallan-Validator: jsonpath' to explicitly select this validator.
+
+	The validation request body is a JSON object. If all its names start with '$', it maps JSONPath
+	expressions, e.g. `$.orderId`, to the expected values; an expression matching many fields
+	holds if any of them has the expected value. Otherwise it is a partial object, whose fields,
+	nested objects included, the request body must contain. Values are compared by their
+	canonical JSON text, so arrays must be equal.
+
+	Raises:
+		JSONPathError	If the body is not a JSON object or an expression is not valid.
+
 	"""
+	body_format = BODY_JSON
+
 	def __init__(self, validation_request: HTTPRequest):
 
-		assert isinstance(validation_request.body, str)
-		self._pattern = re.compile(validation_request.body)
+		body = validation_request.body
+		if isinstance(body, (str, bytes)):
+			try:
+				body = json.loads(body)
+			except ValueError as e:
+				raise JSONPathError(f'The body is not valid JSON: {e}') from e
+		if not isinstance(body, dict) or not body:
+			raise JSONPathError('The body must be a JSON object with at least one field')
+
+		self.conditions: List[Tuple[JSONPath, str]]
+		if all(name.startswith('$') for name in body):
+			self.conditions = [(compile_path(expression), canonical(value)) for expression, value in body.items()]
+		else:
+			self.conditions = [(JSONPath(names), canonical(value)) for names, value in flatten_fields(body)]
 
 	def validate(self, request: HTTPRequest) -> bool:
 
-		return bool(self._pattern.search(request.body))
+		try:
+			document = parse_body(BODY_JSON, request.body)
+		except ValueError:
+			return False
+
+		return self.validate_document(document)
+
+	def validate_document(self, document: Any) -> bool:
+
+		return all(
+			any(canonical(value) == expected for value in path.find(document))
+			for path, expected in self.conditions
+		)
+
+
+class ValidatorCache():
+	"""LRU cache of validators compiled from the validation request body, keyed by a hash of the body.
+
+	A validator is compiled once per distinct body, e.g. a JSON schema is checked once, and shared
+	by the assertions using it. Validators failing to compile are not cached. Safe to use from many
+	threads at a time.
+
+	Args:
+		max_entries (int):	Maximum number of validators cached.
+		max_bytes (int):	Maximum total size of the bodies of the validators cached.
+
+	"""
+	def __init__(self, max_entries: int = DEFAULT_MAX_CACHED_VALIDATORS, max_bytes: int = DEFAULT_MAX_CACHED_BYTES):
+
+		self._max_entries = max_entries
+		self._max_bytes = max_bytes
+		self._lock = threading.Lock()
+		# (validator, body size) by (validator class, body hash), least recently used first
+		self._validators: Dict[Tuple[type, bytes], Tuple[Validator, int]] = OrderedDict()
+		self._bytes = 0
+		self._hits = 0
+		self._misses = 0
+		self._evictions = 0
+
+	def get(self, validator_class: Type[Validator], validation_request: HTTPRequest) -> Validator:
+		"""Returns the cached validator of the validation request body or compiles it.
+
+		Raises:
+			Whatever `validator_class` raises if the body can't be compiled.
+
+		"""
+		body = _body_bytes(validation_request.body)
+		key = (validator_class, hashlib.sha256(body).digest())
+
+		# Compiles holding the lock, so that concurrent assertions compile a body once
+		with self._lock:
+			entry = self._validators.get(key)
+			if entry is not None:
+				self._validators.move_to_end(key)
+				self._hits += 1
+				return entry[0]
+
+			self._misses += 1
+			validator = validator_class(validation_request)
+			if len(body) <= self._max_bytes:
+				self._validators[key] = (validator, len(body))
+				self._bytes += len(body)
+				while len(self._validators) > self._max_entries or self._bytes > self._max_bytes:
+					_, (_, size) = self._validators.popitem(last=False)
+					self._bytes -= size
+					self._evictions += 1
+
+		return validator
+
+	def stats(self) -> dict:
+		"""Returns the number of validators cached, their body bytes, the hits, misses and evictions. """
+
+		with self._lock:
+			return {
+				"entries": len(self._validators),
+				"bytes": self._bytes,
+				"max_entries": self._max_entries,
+				"max_bytes": self._max_bytes,
+				"hits": self._hits,
+				"misses": self._misses,
+				"evictions": self._evictions
+			}
+
+
+class ParsedBodyCache():
+	"""LRU cache of the parsed bodies of recorded requests, keyed by record sequence and body format.
+
+	The size of a parsed body is estimated from the size of the body. Bodies which fail to parse
+	are cached too. Safe to use from many threads at a time; parsed bodies must not be modified.
+
+	Args:
+		max_bytes (int):	Maximum estimated size of the parsed bodies cached.
+
+	"""
+	_INVALID = object()
+
+	def __init__(self, max_bytes: int = DEFAULT_MAX_PARSED_BYTES):
+
+		self._max_bytes = max_bytes
+		self._lock = threading.Lock()
+		# (parsed body, estimated size) by (sequence, body format), least recently used first
+		self._documents: Dict[Tuple[int, str], Tuple[Any, int]] = OrderedDict()
+		self._bytes = 0
+		self._hits = 0
+		self._misses = 0
+
+	def document(self, sequence: int, body_format: str, body: Any) -> Any:
+		"""Returns the parsed body of the record numbered `sequence`, parsing it on a cache miss.
+
+		Raises:
+			ValueError	If the body can't be parsed.
+
+		"""
+		key = (sequence, body_format)
+		with self._lock:
+			entry = self._documents.get(key)
+			if entry is not None:
+				self._documents.move_to_end(key)
+				self._hits += 1
+			else:
+				self._misses += 1
+
+		if entry is not None:
+			document = entry[0]
+		else:
+			try:
+				document = parse_body(body_format, body)
+			except ValueError:
+				document = ParsedBodyCache._INVALID
+			size = len(body) * _PARSED_SIZE_FACTOR if isinstance(body, (str, bytes, bytearray)) else 0
+			self._add(key, document, size)
+
+		if document is ParsedBodyCache._INVALID:
+			raise ValueError(f'The body of request {sequence} is not valid {body_format}')
+
+		return document
+
+	def stats(self) -> dict:
+		"""Returns the number of parsed bodies cached, their estimated size, the hits and misses. """
+
+		with self._lock:
+			return {
+				"entries": len(self._documents),
+				"bytes": self._bytes,
+				"max_bytes": self._max_bytes,
+				"hits": self._hits,
+				"misses": self._misses
+			}
+
+	def _add(self, key: Tuple[int, str], document: Any, size: int):
+
+		if size > self._max_bytes:
+			return
+
+		with self._lock:
+			if key in self._documents:
+				return
+			self._documents[key] = (document, size)
+			self._bytes += size
+			while self._bytes > self._max_bytes:
+				_, (_, evicted_size) = self._documents.popitem(last=False)
+				self._bytes -= evicted_size
+
+
+class ValidationPool():
+	"""Pool of processes validating many bodies with a schema validator, split into chunks.
+
+	The processes are started on first use and compile each schema once. Counting stops once
+	the count reaches the limit; the chunks not yet started are then cancelled. Safe to use from
+	many threads at a time.
+
+	Args:
+		max_workers (int):	Number of processes. Defaults to the number of CPUs.
+		chunk_size (int):	Bodies validated per task.
+
+	"""
+	def __init__(self, max_workers: Optional[int] = None, chunk_size: int = DEFAULT_VALIDATION_CHUNK_SIZE):
+
+		self.max_workers = max_workers or os.cpu_count() or 1
+		self._chunk_size = chunk_size
+		self._lock = threading.Lock()
+		self._executor: Optional[ProcessPoolExecutor] = None
+
+	def count_valid(
+			self,
+			validator_class: Type[Validator],
+			validation_request: HTTPRequest,
+			bodies: List[Any],
+			limit: Optional[int] = None) -> int:
+		"""Returns the number of bodies valid for the validator of `validation_request`, up to `limit`.
+
+		Raises:
+			concurrent.futures.process.BrokenProcessPool	If a process died.
+			OSError						If the processes can't be started.
+
+		"""
+		with self._lock:
+			if self._executor is None:
+				# The history lives in threaded processes, which must not fork
+				self._executor = ProcessPoolExecutor(self.max_workers, multiprocessing.get_context('spawn'))
+			executor = self._executor
+
+		schema = validation_request.body
+		futures = [
+			executor.submit(_count_valid_bodies, validator_class, schema, bodies[start:start + self._chunk_size], limit)
+			for start in range(0, len(bodies), self._chunk_size)
+		]
+		count = 0
+		try:
+			for future in as_completed(futures):
+				count += future.result()
+				if limit is not None and count >= limit:
+					return limit
+		finally:
+			for future in futures:
+				future.cancel()
+
+		return count
+
+	def close(self):
+
+		with self._lock:
+			if self._executor is not None:
+				self._executor.shutdown(wait=False)
+				self._executor = None
+
+
+# Validators compiled in the processes of a ValidationPool
+_pool_validator_cache: Optional[ValidatorCache] = None
+
+
+def _count_valid_bodies(validator_class: Type[Validator], schema: Any, bodies: List[Any], limit: Optional[int]) -> int:
+	"""Returns the number of bodies valid for a schema, up to `limit`. Runs in a ValidationPool process. """
+
+	global _pool_validator_cache	# pylint: disable=global-statement
+
+	if _pool_validator_cache is None:
+		_pool_validator_cache = ValidatorCache()
+	validator = _pool_validator_cache.get(validator_class, HTTPRequest('POST', '/', body=schema))
+
+	count = 0
+	for body in bodies:
+		try:
+			document = parse_body(validator.body_format, body)
+		except ValueError:
+			continue
+		if validator.validate_document(document):
+			count += 1
+			if count == limit:
+				break
+
+	return count
+
+
+class RegexMatcher():
+	"""Searches regexes in bodies in a child process, so that a runaway regex can be stopped.
+
+	`re` holds the GIL while it searches, so a search can't be bounded in a thread. The process
+	is started on first use, and killed and started again when a search exceeds its time limit.
+	It searches for one caller at a time. Safe to use from many threads at a time.
+
+	"""
+	def __init__(self):
+
+		self._lock = threading.Lock()
+		self._process: Optional[multiprocessing.process.BaseProcess] = None
+		self._connection: Optional[multiprocessing.connection.Connection] = None
+
+	def count_matches(self, patterns: List[str], bodies: List[Any], limit: Optional[int], time_limit: float) -> List[int]:
+		"""Returns the number of bodies each regex is found in, counting up to `limit`. See `count_regex_matches()`.
+
+		Raises:
+			RegexTimeoutError	If the search takes longer than `time_limit` seconds.
+			OSError			If the process can't be started or died.
+
+		"""
+		with self._lock:
+			connection = self._start()
+			try:
+				connection.send((patterns, bodies, limit))
+				if not connection.poll(time_limit):
+					self._stop()
+					raise RegexTimeoutError(f'Searching the regex took longer than {time_limit:g} seconds')
+				result = connection.recv()
+			except (EOFError, BrokenPipeError) as e:
+				self._stop()
+				raise OSError(f'The regex matcher process died: {e}') from e
+
+		if isinstance(result, Exception):
+			raise result
+
+		return result
+
+	def close(self):
+
+		with self._lock:
+			self._stop()
+
+	def _start(self) -> multiprocessing.connection.Connection:
+		"""Starts the process unless it is running. Called holding `_lock`. """
+
+		if self._process is not None:
+			return self._connection
+
+		# The history lives in threaded processes, which must not fork
+		context = multiprocessing.get_context('spawn')
+		self._connection, child_connection = context.Pipe()
+		self._process = context.Process(target=_regex_matcher_main, args=(child_connection,), daemon=True)
+		self._process.start()
+		child_connection.close()
+
+		# Waits for the imports, which don't count in the time limit
+		try:
+			if not self._connection.poll(_REGEX_MATCHER_START_TIMEOUT):
+				raise OSError('The regex matcher process did not start')
+			self._connection.recv()
+		except (EOFError, OSError):
+			self._stop()
+			raise
+
+		return self._connection
+
+	def _stop(self):
+		"""Kills the process. Called holding `_lock`. """
+
+		if self._process is not None:
+			self._process.kill()
+			self._process.join()
+			self._connection.close()
+			self._process = None
+			self._connection = None
+
+
+def _regex_matcher_main(connection: multiprocessing.connection.Connection):
+	"""Runs in the RegexMatcher process. """
+
+	# Interrupted by the parent only
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	connection.send(None)
+	while True:
+		try:
+			patterns, bodies, limit = connection.recv()
+		except EOFError:
+			return
+		try:
+			result = count_regex_matches(patterns, bodies, limit)
+		except Exception as e:	# pylint: disable=broad-except
+			result = e
+		connection.send(result)
+
+
+def count_regex_matches(patterns: List[str], bodies: List[Any], limit: Optional[int] = None) -> List[int]:
+	"""Returns the number of bodies each regex is found in, counting up to `limit`.
+
+	Several regexes without groups or global flags are first searched as one alternation, so
+	that the bodies none of them is found in are searched once.
+
+	"""
+	counts = [0] * len(patterns)
+	pending = list(range(len(patterns)))
+	combined_pattern = _combine_regexes(tuple(patterns)) if len(patterns) > 1 else None
+	for body in bodies:
+		if combined_pattern is not None and not regex_search(combined_pattern, body):
+			continue
+		for index in list(pending):
+			if regex_search(patterns[index], body):
+				counts[index] += 1
+				if counts[index] == limit:
+					pending.remove(index)
+		if not pending:
+			break
+
+	return counts
+
+
+def regex_search(pattern: str, body: Any) -> bool:
+	"""Returns True if the regex is found in a body.
+
+	Patterns are compiled once. bytes bodies are searched without decoding them, with the UTF-8
+	encoding of the pattern compiled as a bytes pattern, so that e.g. `.` matches a byte and `\\w`
+	an ASCII word character. Decoded JSON bodies are searched as JSON text.
+
+	"""
+	if isinstance(body, (bytes, bytearray, memoryview)):
+		try:
+			compiled_pattern = _compile_regex(pattern.encode('utf-8'))
+		except re.error:
+			# E.g. patterns with inline Unicode flags
+			return bool(_compile_regex(pattern).search(bytes(body).decode('utf-8', errors='replace')))
+		return bool(compiled_pattern.search(body))
+
+	if not isinstance(body, str):
+		body = json.dumps(body)
+
+	return bool(_compile_regex(pattern).search(body))
+
+
+@functools.lru_cache(maxsize=DEFAULT_MAX_CACHED_VALIDATORS)
+def _compile_regex(pattern: Union[str, bytes]) -> Pattern:
+
+	return re.compile(pattern)
+
+
+@functools.lru_cache(maxsize=64)
+def _combine_regexes(patterns: Tuple[str, ...]) -> Optional[str]:
+	"""Returns an alternation of regexes, found in a body if any of them is, or None if they can't be combined.
+
+	Groups would be renumbered and global flags would apply to every alternative.
+
+	"""
+	for pattern in patterns:
+		compiled_pattern = _compile_regex(pattern)
+		if compiled_pattern.groups or compiled_pattern.flags & ~re.UNICODE:
+			return None
+
+	combined_pattern = '|'.join(f'(?:{pattern})' for pattern in patterns)
+	try:
+		_compile_regex(combined_pattern)
+	except re.error:
+		return None
+
+	return combined_pattern
+
+
+def body_digest(body: Any) -> int:
+	"""Returns the 64-bit digest of a request body.
+
+	JSON objects and arrays, decoded or JSON text, are canonicalized first with sorted keys and no
+	whitespace, so that equal documents have equal digests. Other str and bytes bodies are digested
+	as they are.
+
+	"""
+	if isinstance(body, bytearray):
+		body = bytes(body)
+	if isinstance(body, (str, bytes)) and body.lstrip()[:1] in ('{', '[', b'{', b'['):
+		if len(body) <= _MAX_MEMOIZED_DIGEST_BODY:
+			return _json_text_digest(body)
+		return _json_text_digest.__wrapped__(body)
+
+	return _digest(body)
+
+
+@functools.lru_cache(maxsize=1024)
+def _json_text_digest(body: Union[str, bytes]) -> int:
+	"""Returns the digest of a body which may be JSON text. Memoized, since clients often send the same bodies. """
+
+	try:
+		return _digest(json.loads(body))
+	except ValueError:
+		return _digest(body)
+
+
+def _digest(body: Any) -> int:
+
+	# Text and its UTF-8 encoding are the same body, since request bodies are kept as bytes
+	if isinstance(body, str):
+		data = b'b' + body.encode('utf-8', errors='surrogatepass')
+	elif isinstance(body, bytes):
+		data = b'b' + body
+	else:
+		data = b'j' + json.dumps(body, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8', errors='surrogatepass')
+
+	return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def parse_body(body_format: str, body: Any) -> Any:
+	"""Returns the JSON document or the lxml element of a request body.
+
+	Raises:
+		ValueError	If the body is not valid JSON or well-formed XML.
+
+	"""
+	if body_format == BODY_JSON:
+		return json.loads(body) if isinstance(body, (str, bytes, bytearray)) else body
+
+	if isinstance(body, str):
+		# lxml rejects str documents with an encoding declaration
+		body = body.encode('utf-8')
+	if not isinstance(body, (bytes, bytearray)):
+		raise ValueError(f'{type(body).__name__} bodies are not XML documents')
+	try:
+		return etree.fromstring(body)
+	except etree.XMLSyntaxError as e:
+		raise ValueError(f'{e}') from e
+
+
+def _body_bytes(body) -> bytes:
+
+	if isinstance(body, dict):
+		return json.dumps(body, sort_keys=True, separators=(',', ':')).encode('utf-8')
+	if isinstance(body, str):
+		return body.encode('utf-8', errors='surrogatepass')
+
+	return bytes(body)
@@ -0,0 +1,388 @@
+from typing import Optional, Union, Tuple
+from multiprocessing.managers import BaseManager
+import multiprocessing
+import multiprocessing.util
+import queue
+import socket
+import threading
+import uuid
+from .history import History
+from .stub_config import StubConfig, ConfigSnapshot
+
+
+_WORKER_START_TIMEOUT = 10.0
+
+
+class ConfigStore():
+	"""Holds the last stub configuration loaded by any of the workers.
+
+	Lives in the collector process. Each `publish()` increments `generation`, which is shared
+	memory, so that the workers detect configuration changes without an IPC round trip.
+
+	"""
+	def __init__(self, config_json: dict, generation):
+
+		self._lock = threading.Lock()
+		self._config_json = config_json
+		self._generation = generation
+		self._positions = {}
+		self._instance_id = uuid.uuid4().hex[:12]
+
+
+	def publish(
+			self,
+			config_json: dict,
+			reset_keys: Optional[list] = None,
+			base_generation: Optional[int] = None) -> Optional[int]:
+		"""Stores the configuration and resets the sequence cursors. Returns the new generation.
+
+		Args:
+			config_json (dict):
+			reset_keys (list):	Cursors to reset. All the cursors are reset if None.
+			base_generation (int):	Generation the configuration was changed from. If it is no
+						longer the current one, nothing is stored and None is returned.
+
+		"""
+		with self._lock:
+			if base_generation is not None and base_generation != self._generation.value:
+				return None
+
+			self._config_json = config_json
+			if reset_keys is None:
+				self._positions = {}
+			else:
+				for cursor_key in reset_keys:
+					self._positions.pop(cursor_key, None)
+			self._generation.value += 1
+
+			return self._generation.value
+
+
+	def instance_id(self) -> str:
+		"""Random id shared by the configurations of all the workers. """
+
+		return self._instance_id
+
+
+	def get(self) -> Tuple[int, dict]:
+
+		with self._lock:
+			return self._generation.value, self._config_json
+
+
+	def next_position(self, cursor_key: tuple) -> int:
+
+		with self._lock:
+			position = self._positions.get(cursor_key, 0)
+			self._positions[cursor_key] = position + 1
+
+			return position
+
+
+	def position(self, cursor_key: tuple) -> int:
+
+		with self._lock:
+			return self._positions.get(cursor_key, 0)
+
+
+class _StaleGeneration(Exception):
+	"""Raised when a change is published from a configuration that another worker changed meanwhile. """
+
+
+class CollectorManager(BaseManager):
+	"""Manager of the collector process holding the shared History and ConfigStore. """
+
+
+_collector = {}
+
+def _init_collector(config_json: dict, generation, history_options: dict):
+
+	history = History(**history_options)
+	# Runs when the manager shuts down
+	multiprocessing.util.Finalize(history, history.close, exitpriority=10)
+	_collector['history'] = history
+	_collector['config_store'] = ConfigStore(config_json, generation)
+
+
+CollectorManager.register('history', callable=lambda: _collector['history'])
+CollectorManager.register('config_store', callable=lambda: _collector['config_store'])
+
+
+class SharedCounter():
+	"""Sequence cursor counter held by the ConfigStore, shared by all the workers. """
+
+	def __init__(self, config_store, cursor_key: tuple):
+
+		self._config_store = config_store
+		self._cursor_key = cursor_key
+
+
+	def __next__(self) -> int:
+
+		return self._config_store.next_position(self._cursor_key)
+
+
+	@property
+	def value(self) -> int:
+
+		return self._config_store.position(self._cursor_key)
+
+
+class SharedStubConfig(StubConfig):
+	"""StubConfig of a worker process. Kept in sync with the ConfigStore of the collector.
+
+	Configuration changes made by this worker are published to the ConfigStore. Changes made by
+	other workers are loaded on the next lookup. Incremental changes are applied on top of the
+	latest configuration and the whole configuration is then published; only the cursors of the
+	changed endpoints are reset. If another worker published meanwhile, the change is applied
+	again on top of its configuration, so that concurrent changes are never lost. Snapshot generations are the ConfigStore generations, so that
+	they identify the same configuration in every worker.
+
+	"""
+	def __init__(self, config_store, generation):
+
+		self._config_store = config_store
+		self._shared_generation = generation
+		# Held while loading or changing the configuration and publishing it
+		self._sync_lock = threading.RLock()
+		self._loaded_generation: Optional[int] = None
+		self._created_cursor_keys: Optional[list] = None
+		super().__init__()
+		self._instance_id = config_store.instance_id()
+		# Not loaded yet
+		self._snapshot = ConfigSnapshot(-1, self._snapshot.default_response, self._snapshot.endpoints, frozenset())
+		self._sync()
+
+
+	def load_json(self, config_json: dict):
+
+		with self._sync_lock:
+			super().load_json(config_json)
+
+
+	def patch_json(self, patch_json: dict):
+
+		self._update(super().patch_json, patch_json)
+
+
+	def upsert_endpoint(self, method: str, path: str, endpoint_json: dict):
+
+		self._update(super().upsert_endpoint, method, path, endpoint_json)
+
+
+	def delete_endpoint(self, method: str, path: str) -> bool:
+
+		return self._update(super().delete_endpoint, method, path)
+
+
+	def dump_json(self, snapshot=None) -> dict:
+
+		if snapshot is None:
+			self._sync()
+
+		return super().dump_json(snapshot)
+
+
+	def lookup(self, request, snapshot=None):
+
+		if snapshot is None and self._shared_generation.value != self._snapshot.generation:
+			self._sync()
+
+		return super().lookup(request, snapshot)
+
+
+	@property
+	def snapshot(self):
+
+		if self._shared_generation.value != self._snapshot.generation:
+			self._sync()
+
+		return self._snapshot
+
+
+	def _create_counter(self, cursor_key: tuple) -> SharedCounter:
+
+		if self._created_cursor_keys is not None:
+			self._created_cursor_keys.append(cursor_key)
+
+		return SharedCounter(self._config_store, cursor_key)
+
+
+	def _publish(self, default_response, endpoints, cursors) -> ConfigSnapshot:
+
+		generation = self._loaded_generation
+		if generation is None:
+			snapshot = ConfigSnapshot(-1, default_response, endpoints, cursors)
+			generation = self._config_store.publish(
+				StubConfig._dump_snapshot_json(snapshot),
+				self._created_cursor_keys,
+				# Incremental changes are based on the current snapshot
+				None if self._created_cursor_keys is None else self._snapshot.generation
+			)
+			if generation is None:
+				raise _StaleGeneration()
+		self._snapshot = ConfigSnapshot(generation, default_response, endpoints, cursors)
+
+		return self._snapshot
+
+
+	def _update(self, update, *args):
+		"""Applies an incremental change on top of the latest configuration and publishes it. """
+
+		with self._sync_lock:
+			while True:
+				self._sync()
+				self._created_cursor_keys = []
+				try:
+					return update(*args)
+				except _StaleGeneration:
+					pass
+				finally:
+					self._created_cursor_keys = None
+
+
+	def _sync(self):
+
+		with self._sync_lock:
+			generation, config_json = self._config_store.get()
+			if generation != self._snapshot.generation:
+				self._loaded_generation = generation
+				try:
+					super().load_json(config_json)
+				finally:
+					self._loaded_generation = None
+
+
+class MockHTTPServerWorkers():
+	"""Runs `workers` MockHTTPServer processes listening on the same port with SO_REUSEPORT.
+
+	The workers share one History and one stub configuration held by a collector process, so that
+	the Assertion API gives the same answer regardless of the worker serving the request.
+
+	"""
+	def __init__(
+			self,
+			server_address,
+			stub_config_json: Optional[Union[dict, str]],
+			workers: int,
+			engine: str = 'single',
+			max_workers: Optional[int] = None,
+			idle_timeout: Optional[float] = None,
+			history_options: Optional[dict] = None):
+
+		if workers < 1:
+			raise ValueError(f'workers must be greater than 0 but it is {workers}')
+
+		self._ctx = multiprocessing.get_context('fork')
+		self._config_json = StubConfig(stub_config_json).dump_json()
+		self._workers = workers
+		self._history_options = history_options or {}
+		# The collector would fail to start without telling why
+		History.check_options(**self._history_options)
+		self._server_kwargs = {'engine': engine}
+		if max_workers is not None:
+			self._server_kwargs['max_workers'] = max_workers
+		if idle_timeout is not None:
+			self._server_kwargs['idle_timeout'] = idle_timeout
+
+		# Holds the port until the workers bind it. Bound sockets that don't listen get no connections.
+		self._port_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		self._port_socket.bind(server_address)
+		self.server_address = self._port_socket.getsockname()[:2]
+
+		self._manager: Optional[CollectorManager] = None
+		self._processes = []
+
+
+	def start(self):
+		"""Starts the collector and the workers and waits until all the workers listen.
+
+		Raises:
+			RuntimeError	If the collector or a worker fails to start.
+
+		"""
+		generation = self._ctx.RawValue('Q', 0)
+		self._manager = CollectorManager(ctx=self._ctx)
+		try:
+			self._manager.start(_init_collector, (self._config_json, generation, self._history_options))
+		except (EOFError, OSError) as e:
+			self._manager = None
+			self.close()
+			raise RuntimeError(f'Collector failed to start: {e.__class__.__name__}: {e}') from e
+
+		ready_queue = self._ctx.Queue()
+		for _ in range(self._workers):
+			process = self._ctx.Process(
+				target=_worker_main,
+				args=(
+					self._manager.address,
+					generation,
+					self.server_address,
+					self._server_kwargs,
+					ready_queue
+				),
+				daemon=True
+			)
+			process.start()
+			self._processes.append(process)
+
+		for _ in range(self._workers):
+			try:
+				error = ready_queue.get(timeout=_WORKER_START_TIMEOUT)
+			except queue.Empty:
+				error = 'timed out'
+			if error:
+				self.close()
+				raise RuntimeError(f'Worker failed to start: {error}')
+
+
+	def join(self):
+
+		for process in self._processes:
+			process.join()
+
+
+	def close(self):
+
+		for process in self._processes:
+			process.terminate()
+		for process in self._processes:
+			process.join()
+		self._processes = []
+
+		if self._manager is not None:
+			self._manager.shutdown()
+			self._manager = None
+
+		self._port_socket.close()
+
+
+def _worker_main(manager_address, generation, server_address, server_kwargs: dict, ready_queue):
+
+	# Imported here because main imports this module
+	from .main import MockHTTPServer	# pylint: disable=import-outside-toplevel
+
+	try:
+		manager = CollectorManager(address=manager_address)
+		manager.connect()
+		stub_config = SharedStubConfig(manager.config_store(), generation)
+		mock_http_server = MockHTTPServer(
+			server_address,
+			None,
+			reuse_port=True,
+			stub_config=stub_config,
+			history=manager.history(),
+			shared_state=True,
+			**server_kwargs
+		)
+	except Exception as e:	# pylint: disable=broad-except
+		ready_queue.put(f'{e.__class__.__name__}: {e}')
+		return
+
+	ready_queue.put(None)
+	try:
+		mock_http_server.serve_forever()
+	finally:
+		mock_http_server.close()
@@ -1,6 +1,9 @@
+import gzip
+import json
+import threading
 from pytest import fixture
 from mockallan.request import ContentType, HTTPRequest
-from mockallan.app_handler import AppHandler, StubConfig
+from mockallan.app_handler import AppHandler, StubConfig, History
 
 
 _PATH_1823 = '/path/1823'
@@ -624,3 +627,366 @@ def test_handle_request_get_call_args_list_status_200(app_handler: AppHandler):
 	assert response.headers['Content-Type'] == 'application/json'
 	assert len(response.body['items']) == 1
 
+
+def test_handle_request_get_request_body_list_filtered(app_handler: AppHandler):
+	"""Tests GET /request-body-list with filters, pagination and field selection """
+
+	for i in range(5):
+		app_handler.handle_request(HTTPRequest('POST', _PATH_1823, body=str(i)))
+		app_handler.handle_request(HTTPRequest('GET', '/path/1'))
+
+	query = {'method': ['POST'], 'path': [_PATH_1823], 'limit': ['2'], 'fields': ['sequence,request']}
+	response = app_handler.handle_request(HTTPRequest('GET', '/request-body-list', query=query))
+
+	assert response.status_code == 200
+	assert response.body == {
+		"items": [
+			{"sequence": 0, "request": f"POST {_PATH_1823} 0"},
+			{"sequence": 2, "request": f"POST {_PATH_1823} 1"}
+		],
+		"next_cursor": "2"
+	}
+
+	query['cursor'] = [response.body['next_cursor']]
+	query['limit'] = ['10']
+	response = app_handler.handle_request(HTTPRequest('GET', '/request-body-list', query=query))
+
+	assert [item['sequence'] for item in response.body['items']] == [4, 6, 8]
+	assert 'next_cursor' not in response.body
+
+	query = {'since': ['2000-01-01T00:00:00Z'], 'until': ['2000-01-02T00:00:00+00:00']}
+	response = app_handler.handle_request(HTTPRequest('GET', '/request-body-list', query=query))
+	assert response.body == {"items": []}
+
+
+def test_handle_request_get_request_body_list_status_400(app_handler: AppHandler):
+	"""Tests GET /request-body-list with invalid query parameters """
+
+	for query in ({'limit': ['0']}, {'status': ['ok']}, {'since': ['yesterday']}, {'fields': ['request,headers']}):
+		response = app_handler.handle_request(HTTPRequest('GET', '/request-body-list', query=query))
+
+		assert response.status_code == 400
+		assert response.body['type'] == 'invalid-query-param'
+
+
+def test_handle_request_get_request_body_list_ndjson(app_handler: AppHandler, monkeypatch):
+	"""Tests GET /request-body-list with Accept: application/x-ndjson """
+
+	monkeypatch.setattr('mockallan.app_handler._RECORD_PAGE_SIZE', 2)
+	for i in range(5):
+		app_handler.handle_request(HTTPRequest('POST', _PATH_1823, body=str(i)))
+
+	request = HTTPRequest(
+		'GET',
+		'/request-body-list',
+		query={'limit': ['4'], 'fields': ['sequence']},
+		headers={'Accept': 'application/x-ndjson'}
+	)
+	response = app_handler.handle_request(request)
+	# Appended after the stream starts
+	app_handler.handle_request(HTTPRequest('POST', _PATH_1823, body='5'))
+
+	assert response.headers['Content-Type'] == 'application/x-ndjson'
+	chunks = list(response.chunks)
+	assert len(chunks) == 2
+	assert [json.loads(line) for line in b''.join(chunks).splitlines()] == [{"sequence": i} for i in range(4)]
+
+	request.query = {}
+	response = app_handler.handle_request(request)
+	app_handler.handle_request(HTTPRequest('POST', _PATH_1823, body='6'))
+
+	assert len(b''.join(response.chunks).splitlines()) == 7
+
+
+
+def test_handle_request_patch_config_status_204(app_handler: AppHandler):
+	"""Tests PATCH /config """
+
+	request = HTTPRequest(
+		'PATCH',
+		'/config',
+		headers=ContentType.APPLICATION_JSON,
+		body='{"endpoints": [{"request": {"method": "GET", "path": "/orders"}, "response": {"status_code": 202}}]}'
+	)
+	response = app_handler.handle_request(request)
+
+	assert response.status_code == 204
+	assert app_handler.handle_request(HTTPRequest('GET', '/orders')).status_code == 202
+
+
+def test_handle_request_put_delete_config_endpoint(app_handler: AppHandler):
+	"""Tests PUT and DELETE /config/endpoints/{method}/{path} """
+
+	request = HTTPRequest(
+		'PUT',
+		'/config/endpoints/get/orders/%7Border_id%7D',
+		headers=ContentType.APPLICATION_JSON,
+		body={"response": {"status_code": 202, "body": "{{order_id}}"}}
+	)
+	response = app_handler.handle_request(request)
+
+	assert response.status_code == 204
+	assert app_handler.handle_request(HTTPRequest('GET', '/orders/1823')).body == '1823'
+
+	request = HTTPRequest('DELETE', '/config/endpoints/GET/orders/{order_id}')
+	assert app_handler.handle_request(request).status_code == 204
+	assert app_handler.handle_request(request).status_code == 404
+	assert app_handler.handle_request(HTTPRequest('GET', '/orders/1823')).status_code != 202
+
+
+def test_handle_request_get_config_status_304(app_handler: AppHandler):
+	"""Tests GET /config with If-None-Match and generation """
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/config'))
+	etag = response.headers['ETag']
+	app_handler.handle_request(HTTPRequest('GET', '/path/1'))
+	generation = app_handler.history.request_body_list()[-1].generation
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/config', headers={'If-None-Match': etag}))
+	assert response.status_code == 304
+	response = app_handler.handle_request(HTTPRequest('GET', '/config', query={'generation': [str(generation)]}))
+	assert response.status_code == 304
+
+	app_handler.handle_request(
+		HTTPRequest('PUT', '/config/endpoints/GET/path/1', body={"response": {"status_code": 202}})
+	)
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/config', headers={'If-None-Match': etag}))
+	assert response.status_code == 200
+	assert response.headers['ETag'] != etag
+
+
+def test_handle_request_get_config_cached_gzip(app_handler: AppHandler):
+	"""Tests GET /config with Accept-Encoding: gzip and If-Modified-Since """
+
+	request = HTTPRequest('GET', '/config', headers={'Accept-Encoding': 'br;q=1.0, gzip;q=0.5'})
+	response = app_handler.handle_request(request)
+
+	assert response.status_code == 200
+	assert response.headers['Content-Encoding'] == 'gzip'
+	assert gzip.decompress(response.body) == app_handler.handle_request(HTTPRequest('GET', '/config')).body
+	assert app_handler.handle_request(request) is response
+
+	request = HTTPRequest('GET', '/config', headers={'If-Modified-Since': response.headers['Last-Modified']})
+	assert app_handler.handle_request(request).status_code == 304
+
+
+def test_handle_request_get_request_count_evicted(stub_config: StubConfig):
+	"""Tests that GET /request-count and GET /assert-called report eviction """
+
+	app_handler = AppHandler(stub_config, History(max_records=1))
+	app_handler.handle_request(HTTPRequest('GET', _PATH_1823))
+	app_handler.handle_request(HTTPRequest('GET', '/path/1'))
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/request-count'))
+	assert response.body['request_count'] == 2
+	assert response.body['evicted'] is True
+
+	response = app_handler.handle_request(
+		HTTPRequest('GET', '/assert-called', query={'method': ['GET'], 'path': ['/path/1']})
+	)
+	assert response.status_code == 200
+	assert response.body['evicted'] is False
+
+
+def test_handle_request_get_request_count_min_timeout(app_handler: AppHandler):
+	"""Tests GET /request-count?min=&timeout= """
+
+	timer = threading.Timer(0.1, app_handler.handle_request, (HTTPRequest('GET', '/path/1'),))
+	timer.start()
+	query = {'method': ['GET'], 'path': ['/path/1'], 'min': ['1'], 'timeout': ['5']}
+	response = app_handler.handle_request(HTTPRequest('GET', '/request-count', query=query))
+	timer.join()
+
+	assert response.status_code == 200
+	assert response.body['request_count'] == 1
+
+	query['min'] = ['2']
+	query['timeout'] = ['0.05']
+	response = app_handler.handle_request(HTTPRequest('GET', '/request-count', query=query))
+	assert response.body['request_count'] == 1
+
+
+def test_handle_request_assert_called_timeout_status_400(stub_config: StubConfig):
+	"""Tests a bad `timeout` and a `timeout` on a server handling one request at a time """
+
+	app_handler = AppHandler(stub_config)
+	for timeout in ('soon', '-1', 'nan', '3600'):
+		query = {'method': ['GET'], 'path': ['/path/1'], 'timeout': [timeout]}
+		response = app_handler.handle_request(HTTPRequest('GET', '/assert-called', query=query))
+		assert response.status_code == 400
+		assert response.body['type'] == 'invalid-query-param'
+
+	app_handler = AppHandler(stub_config, allow_waits=False)
+	query = {'method': ['GET'], 'path': ['/path/1'], 'timeout': ['1']}
+	assert app_handler.handle_request(HTTPRequest('GET', '/assert-called', query=query)).status_code == 400
+	assert app_handler.is_long_poll(HTTPRequest('GET', '/assert-called', query=query))
+
+
+def test_handle_request_get_config_etag_of_other_instance(app_handler: AppHandler):
+	"""Tests GET /config with the If-None-Match ETag of another server run with the same configuration """
+
+	etag = app_handler.handle_request(HTTPRequest('GET', '/config')).headers['ETag']
+	other_app_handler = AppHandler(StubConfig(config_json='stub_config.json'))
+
+	response = other_app_handler.handle_request(HTTPRequest('GET', '/config', headers={'If-None-Match': etag}))
+	assert response.status_code == 200
+	assert response.headers['ETag'] != etag
+
+
+def test_handle_request_history_stream(stub_config: StubConfig, monkeypatch):
+	"""Tests GET /history/stream from a Last-Event-ID, a dropped event and a bad query """
+
+	monkeypatch.setattr('mockallan.app_handler._STREAM_KEEP_ALIVE_INTERVAL', 0.01)
+	monkeypatch.setattr('mockallan.app_handler._STREAM_MAX_QUEUED_RECORDS', 1)
+	app_handler = AppHandler(stub_config)
+	for path in ('/path/1', '/path/2', '/path/1'):
+		app_handler.handle_request(HTTPRequest('GET', path))
+
+	query = {'path': ['/path/1'], 'fields': ['sequence']}
+	request = HTTPRequest('GET', '/history/stream', query=query, headers={'Last-Event-ID': '0'})
+	response = app_handler.handle_request(request)
+	assert response.status_code == 200
+	assert response.headers['Content-Type'] == 'text/event-stream'
+	assert app_handler.is_long_poll(request)
+
+	assert next(response.chunks) == b'id: 2\nevent: record\ndata: {"sequence": 2}\n\n'
+	for _ in range(2):
+		app_handler.handle_request(HTTPRequest('GET', '/path/1'))
+	assert next(response.chunks) == \
+		b'id: 3\nevent: record\ndata: {"sequence": 3}\n\nevent: dropped\ndata: {"dropped": 1, "cursor": "3"}\n\n'
+	assert next(response.chunks) == b': keep-alive\n\n'
+
+	response.close()
+	assert app_handler.history._subscriptions == {}
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/history/stream', query={'status': ['OK']}))
+	assert response.status_code == 400
+	single_app_handler = AppHandler(stub_config, allow_waits=False)
+	assert single_app_handler.handle_request(HTTPRequest('GET', '/history/stream')).status_code == 400
+
+
+def test_handle_request_assert_called_with_json_schema_cached(app_handler: AppHandler):
+	"""Tests POST /assert-called-with JSON schemas sent as text and GET /validator-cache """
+
+	app_handler.handle_request(HTTPRequest('PUT', '/path/4', headers=ContentType.APPLICATION_JSON, body='{"foo": "bar"}'))
+	query = {'method': ['PUT'], 'path': ['/path/4']}
+	headers = {'Content-Type': 'application/schema+json'}
+	for schema, status_code in (
+			('{"properties": {"foo": {"type": "string"}}}', 200),
+			('{"properties": {"foo": {"type": "boolean"}}}', 409),
+			('{"properties": {"foo": {"type": "string"}}}', 200),
+			('{"type": 7}', 400)):
+		response = app_handler.handle_request(HTTPRequest('POST', '/assert-called-with', query, headers, schema))
+		assert response.status_code == status_code
+		if status_code != 400:
+			assert response.body['duration_ms'] >= 0
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/validator-cache'))
+	assert response.status_code == 200
+	assert (response.body['entries'], response.body['hits'], response.body['misses']) == (2, 1, 3)
+
+
+def test_handle_request_expectations(app_handler: AppHandler):
+	"""Tests POST /expectations, GET /expectations/verify and DELETE /expectations """
+
+	for query, status_code in (
+			({'method': ['PUT'], 'path': ['/path/4'], 'count': ['1']}, 201),
+			({'method': ['GET'], 'path': ['/path/5'], 'max': ['0']}, 201),
+			({'method': ['GET'], 'path': ['/path/5'], 'count': ['1'], 'min': ['1']}, 400),
+			({'method': ['GET'], 'path': ['/path/5'], 'min': ['2'], 'max': ['1']}, 400),
+			({'method': ['GET']}, 400)):
+		response = app_handler.handle_request(HTTPRequest('POST', '/expectations', query, body='{"foo": "bar"}'))
+		assert response.status_code == status_code
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/expectations/verify'))
+	assert response.status_code == 409
+	assert [(item['min'], item['max'], item['count']) for item in response.body['expectations']] == [(1, 1, 0), (0, 0, 0)]
+
+	app_handler.handle_request(HTTPRequest('PUT', '/path/4', headers=ContentType.APPLICATION_JSON, body='{"foo": "bar"}'))
+	app_handler.handle_request(HTTPRequest('PUT', '/path/4', headers=ContentType.APPLICATION_JSON, body='{"foo": "baz"}'))
+
+	response = app_handler.handle_request(HTTPRequest('GET', '/expectations/verify'))
+	assert response.status_code == 200
+	assert response.body['detail'] == '2 of 2 expectations met.'
+
+	query = {'method': ['PUT'], 'path': ['/path/4']}
+	headers = {'Content-Type': 'application/schema+json'}
+	response = app_handler.handle_request(HTTPRequest('POST', '/expectations', query, headers, '{"type": 7}'))
+	assert response.status_code == 400
+
+	assert app_handler.handle_request(HTTPRequest('DELETE', '/expectations')).status_code == 204
+	assert app_handler.handle_request(HTTPRequest('GET', '/expectations/verify')).body['expectations'] == []
+
+
+def test_handle_request_assert_batch(app_handler: AppHandler):
+	"""Tests POST /assert-batch """
+
+	app_handler.handle_request(HTTPRequest('PUT', '/path/4', headers=ContentType.APPLICATION_JSON, body='{"foo": "bar"}'))
+	app_handler.handle_request(HTTPRequest('PUT', '/path/4', headers=ContentType.APPLICATION_JSON, body='{"foo": "baz"}'))
+	schema_headers = {'Content-Type': 'application/schema+json'}
+	assertions = [
+		{"assertion": "assert-called", "method": "put", "path": "/path/4"},
+		{"assertion": "assert-called-once-with", "method": "PUT", "path": "/path/4", "body": {"foo": "bar"}},
+		{"assertion": "request-count", "method": "PUT", "path": "/path/4", "count": 2},
+		{"assertion": "assert-called-with", "method": "PUT", "path": "/path/4", "headers": schema_headers, "body": {"required": ["foo"]}},
+		{"assertion": "assert-called-once-with", "method": "PUT", "path": "/path/4", "headers": schema_headers, "body": {"required": ["foo"]}},
+		{"assertion": "assert-called-once", "method": "GET", "path": "/path/5"}
+	]
+
+	response = app_handler.handle_request(HTTPRequest('POST', '/assert-batch', body=json.dumps(assertions)))
+	assert response.status_code == 409
+	assert [result['passed'] for result in response.body['results']] == [True, True, True, True, False, False]
+	assert response.body['results'][2]['request_count'] == 2
+	assert response.body['detail'] == '2 of 6 assertions failed.'
+
+	response = app_handler.handle_request(HTTPRequest('POST', '/assert-batch', body={"assertions": assertions[3:], "fail_fast": True}))
+	assert response.status_code == 409
+	assert [result.get('skipped', False) for result in response.body['results']] == [False, False, True]
+
+	response = app_handler.handle_request(HTTPRequest('POST', '/assert-batch', body=json.dumps(assertions[:4])))
+	assert response.status_code == 200
+
+	for body in ('[{"assertion": "assert-called"}]', '{"assertions": {}}', 'not json'):
+		response = app_handler.handle_request(HTTPRequest('POST', '/assert-batch', body=body))
+		assert response.status_code == 400
+		assert response.body['type'] == 'invalid-assertion-batch'
+
+
+def test_handle_request_assert_called_with_regex_errors(app_handler: AppHandler):
+	"""Tests that invalid and runaway regexes fail the assertion with 400 """
+
+	app_handler.handle_request(HTTPRequest('PUT', '/path/4', body='a' * 64 + 'b'))
+	query = {'method': ['PUT'], 'path': ['/path/4']}
+	try:
+		for headers, body in (
+				({'X-Mockallan-Validator': 'regex'}, '('),
+				({'X-Mockallan-Validator': 'regex', 'X-Mockallan-Regex-Time-Limit': '0.5'}, r'^(a+)+$')):
+			response = app_handler.handle_request(HTTPRequest('POST', '/assert-called-with', query, headers, body))
+			assert response.status_code == 400
+			assert response.body['type'] == 'regex-error'
+
+		response = app_handler.handle_request(HTTPRequest('POST', '/assert-called-with', query, {'X-Mockallan-Validator': 'regex'}, 'a+b$'))
+		assert response.status_code == 200
+	finally:
+		app_handler.history.close()
+
+
+def test_handle_request_assert_called_with_jsonpath(app_handler: AppHandler):
+	"""Tests jsonpath assertions on the fields indexed by the stub config """
+
+	response = app_handler.handle_request(HTTPRequest(
+		'PUT',
+		'/config/endpoints/POST/orders',
+		body={"response": {"status_code": 201}, "index": ["$.orderId"]}
+	))
+	assert response.status_code == 204
+	for order_id in ('o-1', 'o-2'):
+		app_handler.handle_request(HTTPRequest('POST', '/orders', body=f'{{"orderId": "{order_id}"}}'))
+
+	query = {'method': ['POST'], 'path': ['/orders']}
+	headers = {'X-Mockallan-Validator': 'jsonpath'}
+	for body, status_code in (('{"$.orderId": "o-2"}', 200), ('{"orderId": "o-3"}', 409), ('{"$..orderId": 1}', 400)):
+		response = app_handler.handle_request(HTTPRequest('POST', '/assert-called-once-with', query, headers, body))
+		assert response.status_code == status_code
+	assert response.body['type'] == 'jsonpath-error'
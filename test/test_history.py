@@ -1,5 +1,7 @@
+import threading
+import time
 import pytest
-from mockallan.app_handler import HTTPRequest, History
+from mockallan.app_handler import HTTPRequest, HTTPResponse, History
 
 
 def test_request_count_empty_history(empty_history: History):
@@ -55,6 +57,17 @@ def test_request_body_list(history: History):
 	assert request_records[5].request.path == '/path/2'
 
 
+def test_find_records(history: History):
+
+	request_records = history.find_records(method='post', path='/path/2', limit=2)
+
+	assert [record.sequence for record in request_records] == [1, 4]
+	assert [record.sequence for record in history.find_records(path='/path/2', after_sequence=4)] == [5]
+	assert history.find_records(since=request_records[0].timestamp, before_sequence=2)[-1].sequence == 1
+	assert history.find_records(until=history.find_records()[0].timestamp) == []
+	assert len(history.find_records(status_code=204)) == 1
+
+
 def test_assert_called(history: History):
 
 	history.assert_called(('PUT', '/path/4'))
@@ -219,3 +232,300 @@ def test_assert_called_once_with_regex_assertion_error(history: History):
 
 	with pytest.raises(AssertionError):
 		history.assert_called_once_with(endpoint_called, with_request)
+
+
+def test_append_concurrent(empty_history: History):
+	"""Tests that concurrent append() calls do not lose records. """
+
+	def append_requests(path: str):
+		for _ in range(500):
+			empty_history.append(HTTPRequest('GET', path), HTTPResponse(200))
+
+	threads = [threading.Thread(target=append_requests, args=(f'/path/{i}',)) for i in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert empty_history.request_count() == 4000
+	for i in range(8):
+		assert empty_history.request_count(('GET', f'/path/{i}')) == 500
+
+
+def test_records_materialized_without_lock(history: History):
+	"""Tests that reads only hold the lock while copying the records out of the storage. """
+
+	materialize = history._storage.materialize
+	locked = []
+
+	def check_materialize(stored_records):
+		locked.append(history._lock.locked())
+		return materialize(stored_records)
+
+	history._storage.materialize = check_materialize
+	history.request_body()
+	history.request_body_list()
+	history.find_records(path='/path/2')
+	regex_request = HTTPRequest('POST', '/path/2', headers={'X-Mockallan-Validator': 'regex'}, body='')
+	history.assert_called_with(('POST', '/path/2'), regex_request)
+	history.assert_called_with(('POST', '/path/2'), regex_request, timeout=1.0)
+
+	assert locked == [False] * 5
+
+
+def test_max_records_eviction():
+
+	history = History(max_records=3)
+	for path in ('/path/1', '/path/2', '/path/1', '/path/2', '/path/3'):
+		history.append(HTTPRequest('GET', path), HTTPResponse(200))
+
+	assert [record.request.path for record in history.request_body_list()] == ['/path/1', '/path/2', '/path/3']
+	assert history.request_count() == 5
+	assert history.request_count(('GET', '/path/1')) == 2
+	assert history.evicted_count() == 2
+	assert history.evicted_count(('GET', '/path/1')) == 1
+	assert history.evicted_count(('GET', '/path/3')) == 0
+	history.assert_called_with(('GET', '/path/1'), HTTPRequest('POST', '/assert-called-with'))
+	with pytest.raises(AssertionError):
+		history.assert_called_once(('GET', '/path/2'))
+
+
+def test_max_bytes_eviction():
+
+	history = History(max_bytes=4000)
+	for _ in range(10):
+		history.append(HTTPRequest('POST', '/path/1', body='x' * 1000), HTTPResponse(200))
+
+	assert 0 < len(history.request_body_list()) < 4
+	assert history.request_count(('POST', '/path/1')) == 10
+
+
+def test_ttl_eviction():
+
+	history = History(ttl=0.05)
+	history.append(HTTPRequest('GET', '/path/1'), HTTPResponse(200))
+	time.sleep(0.1)
+	history.append(HTTPRequest('GET', '/path/2'), HTTPResponse(200))
+
+	assert [record.request.path for record in history.request_body_list()] == ['/path/2']
+	assert history.evicted_count(('GET', '/path/1')) == 1
+	history.assert_called_once(('GET', '/path/1'))
+
+
+def test_history_directory(tmp_path):
+
+	history = History(max_records=2, directory=str(tmp_path))
+	try:
+		for path in ('/path/1', '/path/2', '/path/3'):
+			history.append(HTTPRequest('GET', path), HTTPResponse(200))
+
+		assert [record.request.path for record in history.request_body_list()] == ['/path/2', '/path/3']
+		assert history.request_count() == 3
+	finally:
+		history.close()
+
+
+def _append_later(history: History, request: HTTPRequest, delay: float = 0.1) -> threading.Timer:
+
+	timer = threading.Timer(delay, history.append, (request, HTTPResponse(200)))
+	timer.start()
+
+	return timer
+
+
+def test_assert_called_timeout(empty_history: History):
+
+	timer = _append_later(empty_history, HTTPRequest('GET', '/path/1'))
+	start = time.monotonic()
+	empty_history.assert_called(('GET', '/path/1'), timeout=5)
+	timer.join()
+
+	assert time.monotonic() - start < 2
+
+	start = time.monotonic()
+	with pytest.raises(AssertionError):
+		empty_history.assert_called_once(('GET', '/path/2'), timeout=0.1)
+	assert time.monotonic() - start >= 0.1
+
+
+def test_assert_called_with_timeout(empty_history: History):
+
+	empty_history.append(HTTPRequest('POST', '/path/1', body='{"id": 1}'), HTTPResponse(200))
+	timer = _append_later(empty_history, HTTPRequest('POST', '/path/1', body='{"id": 2}'))
+	empty_history.assert_called_once_with(('POST', '/path/1'), HTTPRequest('POST', '/assert-called-with', body='{"id": 2}'), timeout=5)
+	timer.join()
+
+	with pytest.raises(AssertionError):
+		empty_history.assert_called_with(('POST', '/path/1'), HTTPRequest('POST', '/assert-called-with', body='{"id": 3}'), timeout=0.1)
+
+
+def test_wait_request_count(empty_history: History):
+
+	timers = [_append_later(empty_history, HTTPRequest('GET', f'/path/{i}'), 0.05 * i) for i in range(3)]
+
+	assert empty_history.wait_request_count(None, 3, 5) == 3
+	assert empty_history.wait_request_count(('GET', '/path/1'), 2, 0.05) == 1
+	for timer in timers:
+		timer.join()
+
+
+def test_subscribe(empty_history: History):
+
+	subscription_id = empty_history.subscribe('post', '/orders', max_queued=2)
+	empty_history.append(HTTPRequest('GET', '/orders'), HTTPResponse(200))
+	for _ in range(4):
+		empty_history.append(HTTPRequest('POST', '/orders'), HTTPResponse(201))
+
+	records, dropped_count = empty_history.next_records(subscription_id, 1.0)
+
+	assert [record.sequence for record in records] == [1, 2]
+	assert records[0].request.path == '/orders'
+	assert records[0].response.status_code == 201
+	assert dropped_count == 2
+	assert empty_history.next_records(subscription_id, 0) == ([], 0)
+
+	threading.Timer(0.05, empty_history.append, (HTTPRequest('POST', '/orders'), HTTPResponse(201))).start()
+	records, _ = empty_history.next_records(subscription_id, 5.0)
+	assert [record.sequence for record in records] == [5]
+
+	empty_history.unsubscribe(subscription_id)
+	with pytest.raises(KeyError):
+		empty_history.next_records(subscription_id, 0)
+
+
+def test_assert_called_with_equal_index():
+	"""Tests that equality assertions match JSON documents and follow the evictions. """
+
+	history = History(max_records=3)
+	for body in ({'id': 1, 'tags': []}, '{"id": 2}', '{"id": 2}', '{"id": 3}'):
+		history.append(HTTPRequest('POST', '/orders', body=body), HTTPResponse(201))
+
+	history.assert_called_once_with(('POST', '/orders'), HTTPRequest('POST', '/orders', body={'id': 3}))
+	with pytest.raises(AssertionError, match='Called more than once'):
+		history.assert_called_once_with(('POST', '/orders'), HTTPRequest('POST', '/orders', body='{ "id" : 2 }'))
+	# Evicted
+	with pytest.raises(AssertionError, match='Not called'):
+		history.assert_called_with(('POST', '/orders'), HTTPRequest('POST', '/orders', body='{"tags": [], "id": 1}'))
+
+	threading.Timer(0.05, history.append, (HTTPRequest('POST', '/orders', body='{"id": 4}'), HTTPResponse(201))).start()
+	history.assert_called_with(('POST', '/orders'), HTTPRequest('POST', '/orders', body={'id': 4}), timeout=5.0)
+	with pytest.raises(AssertionError):
+		history.assert_called_with(('POST', '/orders'), HTTPRequest('POST', '/orders', body={'id': 5}), timeout=0.05)
+
+
+def test_expectations():
+	"""Tests that expectations count the matching requests appended after them, evicted or not. """
+
+	history = History(max_records=1)
+	history.append(HTTPRequest('POST', '/orders', body='{"id": 1}'), HTTPResponse(201))
+	equal_id = history.add_expectation(('post', '/orders'), HTTPRequest('POST', '/expectations', body={'id': 1}), 2, 2)
+	schema_id = history.add_expectation(
+		('POST', '/orders'),
+		HTTPRequest(
+			'POST',
+			'/expectations',
+			headers={'Content-Type': 'application/schema+json'},
+			body='{"required": ["id"]}'
+		),
+		0,
+		1
+	)
+	any_id = history.add_expectation(('GET', '/orders'))
+
+	for body in ('{"id": 1}', '{ "id" : 1 }', '{"name": "x"}', 'not json'):
+		history.append(HTTPRequest('POST', '/orders', body=body), HTTPResponse(201))
+
+	results = {result.expectation_id: result for result in history.verify_expectations()}
+	assert (results[equal_id].count, results[equal_id].satisfied) == (2, True)
+	assert (results[schema_id].count, results[schema_id].satisfied) == (2, False)
+	assert (results[any_id].count, results[any_id].satisfied) == (0, False)
+
+	threading.Timer(0.05, history.append, (HTTPRequest('GET', '/orders'), HTTPResponse(200))).start()
+	results = history.verify_expectations(timeout=5.0)
+	assert [result.count for result in results] == [2, 2, 1]
+
+	with pytest.raises(ValueError):
+		history.add_expectation(('GET', '/orders'), None, 2, 1)
+
+	history.clear_expectations()
+	assert history.verify_expectations() == []
+
+
+def test_match_counts(history: History):
+	"""Tests that match_counts() validates the records of an endpoint once for many validation requests. """
+
+	for body in ('{"id": 1}', '{"id": 2}', '{"id": 2}'):
+		history.append(HTTPRequest('POST', '/orders', body=body), HTTPResponse(201))
+	schema_request = HTTPRequest(
+		'POST',
+		'/assert-called-with',
+		headers={'Content-Type': 'application/schema+json'},
+		body='{"required": ["id"]}'
+	)
+	regex_request = HTTPRequest('POST', '/assert-called-with', headers={'X-Mockallan-Validator': 'regex'}, body='"id": [13]')
+
+	counts = history.match_counts(
+		('POST', '/orders'),
+		[HTTPRequest('POST', '/assert-called-with', body={'id': 2}), schema_request, regex_request]
+	)
+	assert counts == [2, 3, 1]
+	assert history.match_counts(('POST', '/orders'), [schema_request, regex_request], 2) == [2, 1]
+	assert history.match_counts(('GET', '/orders'), [schema_request]) == [0]
+
+
+def test_assert_called_with_validation_pool(monkeypatch):
+	"""Tests that schema assertions over many records are validated by a pool of processes. """
+
+	monkeypatch.setattr('mockallan.history._PARALLEL_VALIDATION_MIN_RECORDS', 10)
+	history = History(validation_processes=2)
+	monkeypatch.setattr(history._validation_pool, '_chunk_size', 4)	# pylint: disable=protected-access
+	for index in range(40):
+		history.append(HTTPRequest('POST', '/orders', body=f'{{"id": {index}}}'), HTTPResponse(201))
+	history.append(HTTPRequest('POST', '/orders', body='{"id": "last"}'), HTTPResponse(201))
+
+	def schema_request(schema: str) -> HTTPRequest:
+
+		return HTTPRequest('POST', '/assert-called-with', headers={'Content-Type': 'application/schema+json'}, body=schema)
+
+	try:
+		history.assert_called_with(('POST', '/orders'), schema_request('{"properties": {"id": {"type": "integer"}}}'))
+		history.assert_called_once_with(('POST', '/orders'), schema_request('{"properties": {"id": {"type": "string"}}}'))
+		with pytest.raises(AssertionError, match='Called more than once'):
+			history.assert_called_once_with(('POST', '/orders'), schema_request('{"properties": {"id": {"type": "integer"}}}'))
+		with pytest.raises(AssertionError, match='Not called'):
+			history.assert_called_with(('POST', '/orders'), schema_request('{"properties": {"id": {"type": "boolean"}}}'))
+		assert history._validation_pool._executor is not None	# pylint: disable=protected-access
+	finally:
+		history.close()
+
+
+def test_assert_called_with_field_index(monkeypatch):
+	"""Tests that jsonpath assertions on one indexed field are answered from the index. """
+
+	history = History(max_records=4)
+	history.append(HTTPRequest('POST', '/orders', body='{"orderId": "o-0"}'), HTTPResponse(201))
+	for order_id in ('o-1', 'o-2', 'o-2'):
+		history.append(HTTPRequest('POST', '/orders', body=f'{{"orderId": "{order_id}"}}'), HTTPResponse(201), index=('$.orderId',))
+
+	def jsonpath_request(body) -> HTTPRequest:
+
+		return HTTPRequest('POST', '/assert-called-with', headers={'X-Mockallan-Validator': 'jsonpath'}, body=body)
+
+	# Not every record kept is indexed yet
+	history.assert_called_once_with(('POST', '/orders'), jsonpath_request({"$.orderId": "o-1"}))
+
+	for order_id in ('o-3', 'o-4'):
+		history.append(HTTPRequest('POST', '/orders', body=f'{{"orderId": "{order_id}", "x": 1}}'), HTTPResponse(201), index=('$.orderId',))
+	monkeypatch.setattr(history, '_endpoint_records', None)
+
+	history.assert_called_once_with(('POST', '/orders'), jsonpath_request({"$.orderId": "o-3"}))
+	history.assert_called_with(('POST', '/orders'), jsonpath_request({"orderId": "o-2"}))
+	with pytest.raises(AssertionError, match='Called more than once'):
+		history.assert_called_once_with(('POST', '/orders'), jsonpath_request({"$.orderId": "o-2"}))
+	# Evicted
+	with pytest.raises(AssertionError, match='Not called'):
+		history.assert_called_with(('POST', '/orders'), jsonpath_request({"$['orderId']": "o-1"}))
+	# A field without the expected value rules out the other fields
+	with pytest.raises(AssertionError, match='Not called'):
+		history.assert_called_with(('POST', '/orders'), jsonpath_request({"orderId": "o-5", "x": 1}))
+	assert history.match_counts(('POST', '/orders'), [jsonpath_request({"$.orderId": "o-2"})]) == [2]
@@ -0,0 +1,180 @@
+import errno
+import http.client
+import io
+import pytest
+from mockallan.request import HTTPRequest, HTTPResponse
+from mockallan.history_storage import MemoryStorage, DiskStorage, RecordFilter
+
+
+def _headers(header_lines: str) -> http.client.HTTPMessage:
+
+	return http.client.parse_headers(io.BytesIO(header_lines.encode('latin-1')))
+
+
+def test_memory_storage_round_trip():
+
+	storage = MemoryStorage()
+	compiled_response = HTTPResponse(201, {'Content-Type': 'application/json'}, {'id': 'order_e2b9'})
+	compiled_response.compile()
+	request = HTTPRequest(
+		'POST',
+		'/orders/order_e2b9',
+		{'mode': ['fast']},
+		_headers('Content-Type: application/json\r\nContent-Length: 2\r\n\r\n'),
+		'{}'
+	)
+	request.path_params = {'order_id': 'order_e2b9'}
+
+	storage.append(1_700_000_000_000_000_000, request, compiled_response, 7)
+	storage.append(1_700_000_001_000_000_000, HTTPRequest('PUT', '/orders', body=b'\x00\xff'), HTTPResponse(204), None)
+
+	first, second = storage.materialize(storage.records())
+	assert first.sequence == 0
+	assert first.generation == 7
+	assert first.timestamp.isoformat() == '2023-11-14T22:13:20'
+	assert (first.request.method, first.request.path, first.request.query, first.request.body) == \
+		(request.method, request.path, request.query, request.body)
+	assert first.request.headers.items() == request.headers.items()
+	assert first.request.path_params == {'order_id': 'order_e2b9'}
+	assert first.request.headers.get('content-type') == 'application/json'
+	assert first.response is compiled_response
+	assert second.request.body == b'\x00\xff'
+	assert second.response == HTTPResponse(204)
+	assert second.generation is None
+
+
+def test_memory_storage_eviction_compaction():
+
+	storage = MemoryStorage()
+	response = HTTPResponse(200)
+	response.compile()
+	for i in range(10000):
+		storage.append(i, HTTPRequest('POST', f'/path/{i % 2}', body=str(i)), response, None)
+
+	size = storage.size()
+	for _ in range(9000):
+		storage.evict_oldest()
+
+	assert len(storage) == 1000
+	assert storage.size() < size / 5
+	assert storage.oldest_timestamp() == 9000
+	records = storage.materialize(storage.endpoint_records(('POST', '/path/1')))
+	assert [record.request.body for record in records][:2] == ['9001', '9003']
+	assert storage.last().sequence == 9999
+	assert storage.records()[0].sequence == 9000
+
+
+def test_memory_storage_response_interning():
+
+	storage = MemoryStorage()
+	for i in range(5000):
+		# Copies of the same response, as recorded through a manager proxy, and distinct responses
+		response = HTTPResponse(200, body={'id': 'order_e2b9'} if i % 2 else {'id': i})
+		response.compile()
+		storage.append(i, HTTPRequest('GET', '/orders'), response, None)
+		if len(storage) > 10:
+			storage.evict_oldest()
+
+	assert len(storage._response_id_mapping) <= 6
+	assert len(storage._responses) <= 7
+	assert [record.response.body for record in storage.materialize(storage.records())][-2:] == [{'id': 4998}, {'id': 'order_e2b9'}]
+
+
+def test_memory_storage_find():
+
+	storage = MemoryStorage()
+	for i in range(100):
+		storage.append(i * 10, HTTPRequest('POST' if i % 2 else 'GET', f'/path/{i % 4}'), HTTPResponse(200 + i % 3), None)
+	for _ in range(20):
+		storage.evict_oldest()
+
+	assert [record.sequence for record in storage.find(RecordFilter(), 3)] == [20, 21, 22]
+	assert [record.sequence for record in storage.find(RecordFilter(method='POST', path='/path/1'), 3)] == [21, 25, 29]
+	assert [record.sequence for record in storage.find(RecordFilter(method='POST'), 3)] == [21, 23, 25]
+	assert [record.sequence for record in storage.find(RecordFilter(path='/path/2', status_code=200), 2)] == [30, 42]
+	assert [record.sequence for record in storage.find(RecordFilter(since_ns=905, until_ns=950))] == [91, 92, 93, 94]
+	assert [record.sequence for record in storage.find(RecordFilter(after_sequence=96, before_sequence=99))] == [97, 98]
+	assert storage.find(RecordFilter(method='DELETE')) == []
+
+
+def test_disk_storage_round_trip(tmp_path):
+
+	storage = DiskStorage(str(tmp_path))
+	try:
+		request = HTTPRequest('POST', '/orders', {'mode': ['fast']}, _headers('Content-Length: 2\r\n\r\n'), '{}')
+		storage.append(1_700_000_000_000_000_000, request, HTTPResponse(201, body={'id': 'order_e2b9'}), 3)
+
+		record, = storage.materialize([storage.last()])
+		assert record.sequence == 0
+		assert record.generation == 3
+		assert record.request.query == {'mode': ['fast']}
+		assert record.request.headers['Content-Length'] == '2'
+		assert record.request.body == '{}'
+		assert record.response == HTTPResponse(201, body={'id': 'order_e2b9'})
+	finally:
+		storage.close()
+
+	assert list(tmp_path.iterdir()) == []
+
+
+def test_disk_storage_segments(tmp_path):
+
+	storage = DiskStorage(str(tmp_path), segment_bytes=4096, flush_interval=0.01)
+	try:
+		response = HTTPResponse(200)
+		response.compile()
+		for i in range(10000):
+			storage.append(i, HTTPRequest('POST', f'/path/{i % 2}', body=str(i)), response, None)
+			if i % 500 == 0:
+				storage.flush()
+
+		for _ in range(9000):
+			storage.evict_oldest()
+		storage.flush()
+
+		log_directory = next(tmp_path.iterdir())
+		assert len(list(log_directory.iterdir())) < 10
+		assert len(storage) == 1000
+		records = storage.materialize(storage.endpoint_records(('POST', '/path/0')))
+		assert [record.request.body for record in records][:2] == ['9000', '9002']
+		assert storage.last().body == b'9999'
+		records = storage.materialize(storage.find(RecordFilter(path='/path/1', after_sequence=9990)))
+		assert [record.request.body for record in records] == ['9991', '9993', '9995', '9997', '9999']
+	finally:
+		storage.close()
+
+
+def test_disk_storage_write_error(tmp_path):
+
+	storage = DiskStorage(str(tmp_path), flush_interval=60.0)
+	try:
+		for i in range(10):
+			storage.append(i, HTTPRequest('POST', '/orders', body=str(i)), HTTPResponse(201), None)
+		storage.flush()
+
+		segment = storage._segments[-1]
+		segment_file = segment[1]
+
+		class FailingFile:
+			def __getattr__(self, name):
+				return getattr(segment_file, name)
+
+			def write(self, data):
+				segment_file.write(data[:5])
+				segment_file.flush()
+				raise OSError(errno.ENOSPC, 'No space left on device')
+
+		segment[1] = FailingFile()
+		for i in range(10, 20):
+			storage.append(i, HTTPRequest('POST', '/orders', body=str(i)), HTTPResponse(201), None)
+		with pytest.raises(OSError):
+			storage.flush()
+
+		assert [record.request.body for record in storage.materialize(storage.records())] == [str(i) for i in range(20)]
+
+		segment[1] = segment_file
+		storage.flush()
+
+		assert [record.request.body for record in storage.materialize(storage.records())] == [str(i) for i in range(20)]
+	finally:
+		storage.close()
@@ -1,5 +1,5 @@
 import pytest
-from mockallan.request import ContentType, HTTPRequest
+from mockallan.request import ContentType, HTTPRequest, HTTPResponse
 from mockallan.app_handler import History
 
 
@@ -64,3 +64,23 @@ def test_assert_called_once_with_xml_schema_assertion_error(history: History):
 
 	with pytest.raises(AssertionError):
 		history.assert_called_once_with(endpoint_called, with_request)
+
+
+def test_assert_called_with_xml_schema_parses_bodies_once(history: History):
+	"""Tests that the bodies validated by XML schema assertions are parsed once. """
+
+	with_request = HTTPRequest(
+		'PUT',
+		'/path/xml/1',
+		headers=ContentType.APPLICATION_XML,
+		body='''<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+	<xs:element name="individual" />
+</xs:schema>''')
+	history.append(HTTPRequest('PUT', '/path/xml/1', body='not XML'), HTTPResponse(200))
+
+	for _ in range(3):
+		history.assert_called_with(('PUT', '/path/xml/1'), with_request)
+
+	parsed_bodies = history.validator_cache_stats()['parsed_bodies']
+	assert (parsed_bodies['entries'], parsed_bodies['misses'], parsed_bodies['hits']) == (1, 1, 2)
@@ -0,0 +1,30 @@
+import pytest
+from mockallan.jsonpath import JSONPath, JSONPathError, compile_path
+
+
+def test_compile_path_canonical_expression():
+
+	assert compile_path('$').expression == '$'
+	assert compile_path("$['orderId']").expression == '$.orderId'
+	assert compile_path('$.items.*.sku').expression == '$.items[*].sku'
+	assert compile_path('$["order id"][-1]').expression == '$["order id"][-1]'
+	assert compile_path('$.a') == JSONPath(['a'])
+
+
+def test_find():
+
+	document = {"orderId": "o-1", "items": [{"sku": "A"}, {"sku": "B"}, {"qty": 2}], "order id": [1, 2]}
+
+	assert compile_path('$.orderId').find(document) == ['o-1']
+	assert compile_path('$.items[*].sku').find(document) == ['A', 'B']
+	assert compile_path('$.items[-1].qty').find(document) == [2]
+	assert compile_path('$["order id"][5]').find(document) == []
+	assert compile_path('$.orderId.sku').find(document) == []
+	assert compile_path('$').find(document) == [document]
+
+
+@pytest.mark.parametrize('expression', ['orderId', '$..orderId', '$.items[0:2]', '$.items[?(@.sku)]', '$.'])
+def test_compile_path_error(expression: str):
+
+	with pytest.raises(JSONPathError):
+		compile_path(expression)
@@ -0,0 +1,645 @@
+import http.client
+import json
+import multiprocessing
+import socket
+import threading
+import time
+import pytest
+from pytest import fixture
+from mockallan.main import MockHTTPServer
+from mockallan.stub_config import StubConfig
+from mockallan.workers import MockHTTPServerWorkers, ConfigStore, SharedStubConfig
+
+
+@fixture
+def threaded_server():
+
+	mock_http_server = MockHTTPServer(('127.0.0.1', 0), 'stub_config.json', engine='threaded', max_workers=4)
+	thread = threading.Thread(target=mock_http_server.serve_forever, args=(0.05,), daemon=True)
+	thread.start()
+
+	yield mock_http_server
+
+	mock_http_server.shutdown()
+	mock_http_server.close()
+	thread.join()
+
+
+@fixture
+def asyncio_server():
+
+	mock_http_server = MockHTTPServer(('127.0.0.1', 0), 'stub_config.json', engine='asyncio', idle_timeout=0.5)
+	thread = threading.Thread(target=mock_http_server.serve_forever, daemon=True)
+	thread.start()
+
+	yield mock_http_server
+
+	mock_http_server.shutdown()
+	mock_http_server.close()
+	thread.join()
+
+
+def _request(server_address, method: str, path: str, body=None):
+
+	connection = http.client.HTTPConnection(*server_address, timeout=5)
+	try:
+		connection.request(method, path, body)
+		response = connection.getresponse()
+		return response.status, response.read()
+	finally:
+		connection.close()
+
+
+def test_threaded_engine_concurrent_requests(threaded_server: MockHTTPServer):
+	"""
+
+	Given:
+		- The threaded engine
+	When:
+		- Many clients call POST /orders/order_e2b9/products at a time
+	Then:
+		- Every client gets the configured response
+		- GET /request-count reports every request
+
+	"""
+	statuses = []
+
+	def client():
+		for _ in range(10):
+			status, _ = _request(threaded_server.server_address, 'POST', '/orders/order_e2b9/products', '{}')
+			statuses.append(status)
+
+	threads = [threading.Thread(target=client) for _ in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert statuses == [200] * 80
+
+	status, body = _request(
+		threaded_server.server_address,
+		'GET',
+		'/request-count?method=POST&path=/orders/order_e2b9/products'
+	)
+	assert status == 200
+	assert json.loads(body)['request_count'] == 80
+
+
+def test_threaded_engine_slow_client_does_not_block(threaded_server: MockHTTPServer):
+	"""
+
+	Given:
+		- A client connected but not sending its request
+	When:
+		- Another client calls GET /config
+	Then:
+		- The second client gets its response
+
+	"""
+	idle_connection = http.client.HTTPConnection(*threaded_server.server_address, timeout=5)
+	idle_connection.connect()
+	try:
+		status, _ = _request(threaded_server.server_address, 'GET', '/config')
+	finally:
+		idle_connection.close()
+
+	assert status == 200
+
+
+def test_threaded_engine_idle_keep_alive_connections():
+	"""
+
+	Given:
+		- The threaded engine with 2 workers
+	When:
+		- 2 clients keep idle keep-alive connections open
+		- Another client calls GET /config
+	Then:
+		- The idle connections are closed after the idle timeout and the third client gets its response
+		- Once every worker is busy for longer, new connections are answered 503
+		- shutdown() returns
+
+	"""
+	mock_http_server = MockHTTPServer(
+		('127.0.0.1', 0),
+		'stub_config.json',
+		engine='threaded',
+		max_workers=2,
+		idle_timeout=0.3
+	)
+	thread = threading.Thread(target=mock_http_server.serve_forever, args=(0.05,), daemon=True)
+	thread.start()
+
+	idle_connections = []
+	try:
+		for _ in range(2):
+			connection = http.client.HTTPConnection(*mock_http_server.server_address, timeout=5)
+			connection.request('GET', '/config')
+			connection.getresponse().read()
+			idle_connections.append(connection)
+
+		status, _ = _request(mock_http_server.server_address, 'GET', '/config')
+		assert status == 200
+
+		# Both workers wait on assertions for longer than a second
+		waiting = [
+			threading.Thread(
+				target=_request,
+				args=(mock_http_server.server_address, 'GET', '/assert-called?method=GET&path=/never&timeout=2')
+			)
+			for _ in range(2)
+		]
+		for waiting_thread in waiting:
+			waiting_thread.start()
+		time.sleep(0.2)
+
+		status, _ = _request(mock_http_server.server_address, 'GET', '/config')
+		assert status == 503
+		for waiting_thread in waiting:
+			waiting_thread.join()
+	finally:
+		for connection in idle_connections:
+			connection.close()
+		mock_http_server.shutdown()
+		mock_http_server.close()
+		thread.join()
+
+
+def test_asyncio_engine_keep_alive(asyncio_server: MockHTTPServer):
+	"""
+
+	Given:
+		- The asyncio engine
+	When:
+		- A client performs a test request and an assertion request on the same connection
+	Then:
+		- Both requests are answered
+		- The assertion succeeds
+
+	"""
+	connection = http.client.HTTPConnection(*asyncio_server.server_address, timeout=5)
+	try:
+		connection.request('POST', '/orders/order_e2b9/products', '{"product_id": "foo"}')
+		response = connection.getresponse()
+		assert response.status == 200
+		assert json.loads(response.read())['message'] == (
+			"This is mockallan's configured response for POST /orders/order_e2b9/products"
+		)
+
+		connection.request('GET', '/assert-called-once?method=POST&path=/orders/order_e2b9/products')
+		response = connection.getresponse()
+		assert response.status == 200
+		assert json.loads(response.read())['type'] == 'assertion-success'
+	finally:
+		connection.close()
+
+
+def _request_ndjson(server_address, path: str):
+
+	connection = http.client.HTTPConnection(*server_address, timeout=5)
+	try:
+		connection.request('GET', path, headers={'Accept': 'application/x-ndjson'})
+		response = connection.getresponse()
+		lines = response.read().splitlines()
+		assert response.getheader('Transfer-Encoding') == 'chunked'
+
+		# The connection is kept alive
+		connection.request('GET', '/request-count')
+		assert connection.getresponse().status == 200
+
+		return [json.loads(line) for line in lines]
+	finally:
+		connection.close()
+
+
+def test_threaded_engine_request_body_list_ndjson(threaded_server: MockHTTPServer):
+
+	for _ in range(3):
+		_request(threaded_server.server_address, 'POST', '/orders/order_e2b9/products', '{}')
+
+	items = _request_ndjson(threaded_server.server_address, '/request-body-list?fields=sequence&cursor=0')
+
+	assert items == [{"sequence": 1}, {"sequence": 2}]
+
+
+def test_asyncio_engine_request_body_list_ndjson(asyncio_server: MockHTTPServer):
+
+	for _ in range(3):
+		_request(asyncio_server.server_address, 'POST', '/orders/order_e2b9/products', '{}')
+
+	items = _request_ndjson(asyncio_server.server_address, '/request-body-list?fields=sequence&limit=2')
+
+	assert items == [{"sequence": 0}, {"sequence": 1}]
+
+
+def _read_event(response: http.client.HTTPResponse) -> list:
+	"""Reads the lines of the next Server-Sent Event, skipping the comments. """
+
+	lines = []
+	while True:
+		line = response.readline()
+		if line == b'\n':
+			if lines:
+				return lines
+		elif not line.startswith(b':'):
+			lines.append(line)
+
+
+@pytest.mark.parametrize('server_fixture', ['threaded_server', 'asyncio_server'])
+def test_history_stream(server_fixture: str, request, monkeypatch):
+	"""
+
+	Given:
+		- 2 requests recorded
+	When:
+		- A client streams GET /history/stream from cursor 0 and a request is performed meanwhile
+	Then:
+		- The client receives the second request then the new one as Server-Sent Events
+
+	"""
+	monkeypatch.setattr('mockallan.app_handler._STREAM_KEEP_ALIVE_INTERVAL', 0.2)
+	server = request.getfixturevalue(server_fixture)
+	for _ in range(2):
+		_request(server.server_address, 'POST', '/orders/order_e2b9/products', '{}')
+
+	connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+	try:
+		connection.request('GET', '/history/stream?method=POST&cursor=0&fields=sequence,request')
+		response = connection.getresponse()
+		assert response.status == 200
+		assert response.getheader('Content-Type') == 'text/event-stream'
+
+		assert _read_event(response) == [
+			b'id: 1\n',
+			b'event: record\n',
+			b'data: {"sequence": 1, "request": "POST /orders/order_e2b9/products {}"}\n'
+		]
+
+		_request(server.server_address, 'POST', '/orders/order_e2b9/products', '[]')
+		assert _read_event(response)[0] == b'id: 2\n'
+	finally:
+		connection.close()
+
+
+def test_asyncio_engine_long_poll(asyncio_server: MockHTTPServer):
+	"""
+
+	Given:
+		- A client waiting on GET /assert-called with a timeout
+	When:
+		- Other clients call the API and then the endpoint waited for
+	Then:
+		- The other API calls are answered while the assertion waits
+		- The assertion succeeds once the endpoint is called
+
+	"""
+	results = []
+	path = '/assert-called?method=GET&path=/orders&timeout=5'
+	threads = [
+		threading.Thread(target=lambda: results.append(_request(asyncio_server.server_address, 'GET', path)))
+		for _ in range(40)
+	]
+	for thread in threads:
+		thread.start()
+
+	status, _ = _request(asyncio_server.server_address, 'GET', '/request-count')
+	assert status == 200
+	assert results == []
+
+	_request(asyncio_server.server_address, 'GET', '/orders')
+	for thread in threads:
+		thread.join()
+
+	assert [status for status, _ in results] == [200] * 40
+
+
+def test_asyncio_engine_pipelining(asyncio_server: MockHTTPServer):
+	"""
+
+	When:
+		- A client sends three requests before reading any response
+	Then:
+		- The three responses are sent in order
+
+	"""
+	with socket.create_connection(asyncio_server.server_address, timeout=5) as sock:
+		sock.sendall(
+			b'GET /path/1 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+			b'GET /request-count HTTP/1.1\r\nHost: localhost\r\n\r\n'
+			b'POST /path/2 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+			b'Transfer-Encoding: chunked\r\n\r\n3\r\nfoo\r\n0\r\n\r\n'
+		)
+		data = b''
+		while True:
+			chunk = sock.recv(65536)
+			if not chunk:
+				break
+			data += chunk
+
+	assert data.count(b'HTTP/1.1 200 OK') == 3
+	assert b'"request_count": 1' in data
+	_, body = _request(asyncio_server.server_address, 'GET', '/request-count')
+	assert json.loads(body)['request_count'] == 2
+
+
+def test_asyncio_engine_idle_timeout(asyncio_server: MockHTTPServer):
+	"""
+
+	When:
+		- A client stays idle for longer than the idle timeout
+	Then:
+		- The server closes the connection
+
+	"""
+	with socket.create_connection(asyncio_server.server_address, timeout=5) as sock:
+		assert sock.recv(1) == b''
+
+
+def test_asyncio_engine_post_without_body(asyncio_server: MockHTTPServer):
+
+	with socket.create_connection(asyncio_server.server_address, timeout=5) as sock:
+		sock.sendall(b'POST /path/1 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+		data = sock.recv(65536)
+
+	assert data.startswith(b'HTTP/1.1 400 ')
+
+
+def _recv_all(sock: socket.socket) -> bytes:
+
+	data = b''
+	while True:
+		chunk = sock.recv(65536)
+		if not chunk:
+			return data
+		data += chunk
+
+
+@pytest.mark.parametrize('server_fixture', ['threaded_server', 'asyncio_server'])
+def test_negative_content_length(server_fixture: str, request):
+
+	mock_http_server = request.getfixturevalue(server_fixture)
+	with socket.create_connection(mock_http_server.server_address, timeout=5) as sock:
+		sock.sendall(b'POST /path/1 HTTP/1.1\r\nHost: localhost\r\nContent-Length: -5\r\n\r\nGET /path/2 HTTP/1.1\r\n\r\n')
+		data = _recv_all(sock)
+
+	# The bytes after the headers are not served as another request
+	assert data.startswith(b'HTTP/1.1 400 ')
+	assert data.count(b'HTTP/1.1 ') == 1
+
+
+@pytest.mark.parametrize('server_fixture', ['threaded_server', 'asyncio_server'])
+def test_delete_with_body(server_fixture: str, request):
+
+	mock_http_server = request.getfixturevalue(server_fixture)
+	status, _ = _request(mock_http_server.server_address, 'DELETE', '/orders/order_e2b9', '{"reason": "duplicate"}')
+	assert status == 200
+
+	status, body = _request(mock_http_server.server_address, 'GET', '/request-body')
+	assert body == b'{"reason": "duplicate"}'
+
+
+@pytest.mark.parametrize('server_fixture', ['threaded_server', 'asyncio_server'])
+def test_binary_bodies(server_fixture: str, request):
+	"""
+
+	Given:
+		- A stub endpoint whose response body is declared with `body_base64`
+	When:
+		- A body which is not UTF-8 is uploaded
+	Then:
+		- The binary response is served and the uploaded body is recorded byte for byte
+
+	"""
+	mock_http_server = request.getfixturevalue(server_fixture)
+	upload = b'\x89PNG\r\n\x1a\n\x00\xff\xfe'
+	config_patch = {
+		"endpoints": [
+			{
+				"request": {"method": "PUT", "path": "/images/logo"},
+				"response": {
+					"status_code": 201,
+					"headers": {"Content-Type": "application/octet-stream"},
+					"body_base64": "AAH/"
+				}
+			}
+		]
+	}
+	status, _ = _request(mock_http_server.server_address, 'PATCH', '/config', json.dumps(config_patch))
+	assert status == 204
+
+	status, body = _request(mock_http_server.server_address, 'PUT', '/images/logo', upload)
+	assert status == 201
+	assert body == b'\x00\x01\xff'
+
+	status, body = _request(mock_http_server.server_address, 'GET', '/request-body')
+	assert body == upload
+
+	status, _ = _request(
+		mock_http_server.server_address,
+		'POST',
+		'/assert-called-with?method=PUT&path=/images/logo',
+		upload
+	)
+	assert status == 200
+
+	status, body = _request(mock_http_server.server_address, 'GET', '/request-body-list')
+	assert json.loads(body)['items'][-1]['request'] == f'PUT /images/logo <{len(upload)} bytes>'
+
+
+@fixture
+def server_workers():
+
+	mock_http_server_workers = MockHTTPServerWorkers(('127.0.0.1', 0), 'stub_config.json', workers=3)
+	mock_http_server_workers.start()
+
+	yield mock_http_server_workers
+
+	mock_http_server_workers.close()
+
+
+def test_workers_share_history(server_workers: MockHTTPServerWorkers):
+	"""
+
+	Given:
+		- 3 workers
+	When:
+		- 30 requests are performed, each on a new connection
+	Then:
+		- GET /request-count reports the 30 requests whatever the worker serving it
+
+	"""
+	for _ in range(30):
+		status, _ = _request(server_workers.server_address, 'GET', '/path/1')
+		assert status == 200
+
+	for _ in range(6):
+		status, body = _request(server_workers.server_address, 'GET', '/request-count?method=GET&path=/path/1')
+		assert status == 200
+		assert json.loads(body)['request_count'] == 30
+
+
+def test_workers_share_config(server_workers: MockHTTPServerWorkers):
+	"""
+
+	When:
+		- PUT /config is served by one of the workers
+	Then:
+		- Every worker replies with the new default response
+
+	"""
+	config = {
+		"defaults": {
+			"response": {
+				"status_code": 418,
+				"headers": {},
+				"body": ""
+			}
+		}
+	}
+	status, _ = _request(server_workers.server_address, 'PUT', '/config', json.dumps(config))
+	assert status == 204
+
+	for _ in range(12):
+		status, _ = _request(server_workers.server_address, 'GET', '/path/1')
+		assert status == 418
+
+
+def test_workers_share_sequence_cursor(server_workers: MockHTTPServerWorkers):
+	"""
+
+	Given:
+		- An endpoint with a response sequence
+	When:
+		- The endpoint is called on new connections, served by any of the workers
+	Then:
+		- The responses are served in sequence
+
+	"""
+	config = {
+		"defaults": {
+			"response": {
+				"status_code": 404
+			}
+		},
+		"endpoints": [
+			{
+				"request": {
+					"method": "GET",
+					"path": "/orders"
+				},
+				"response": [
+					{"status_code": 500},
+					{"status_code": 200}
+				],
+				"sequence": "cycle"
+			}
+		]
+	}
+	status, _ = _request(server_workers.server_address, 'PUT', '/config', json.dumps(config))
+	assert status == 204
+
+	status_codes = [_request(server_workers.server_address, 'GET', '/orders')[0] for _ in range(6)]
+
+	assert status_codes == [500, 200] * 3
+
+
+def test_workers_share_config_patch(server_workers: MockHTTPServerWorkers):
+	"""
+
+	When:
+		- PATCH /config and DELETE /config/endpoints/... are served by the workers
+	Then:
+		- Every worker replies according to both changes
+
+	"""
+	patch = {
+		"endpoints": [
+			{"request": {"method": "GET", "path": "/path/1"}, "response": {"status_code": 202}},
+			{"request": {"method": "GET", "path": "/path/2"}, "response": {"status_code": 203}}
+		]
+	}
+	status, _ = _request(server_workers.server_address, 'PATCH', '/config', json.dumps(patch))
+	assert status == 204
+	status, _ = _request(server_workers.server_address, 'DELETE', '/config/endpoints/GET/path/2')
+	assert status == 204
+
+	for _ in range(12):
+		assert _request(server_workers.server_address, 'GET', '/path/1')[0] == 202
+		assert _request(server_workers.server_address, 'GET', '/path/2')[0] != 203
+
+
+def test_workers_asyncio_engine():
+	"""
+
+	Given:
+		- 2 workers running the asyncio engine
+	When:
+		- Many clients perform requests at a time
+	Then:
+		- GET /request-count reports every request
+		- An assertion waiting for a request succeeds once it is performed
+
+	"""
+	mock_http_server_workers = MockHTTPServerWorkers(('127.0.0.1', 0), 'stub_config.json', workers=2, engine='asyncio')
+	mock_http_server_workers.start()
+	try:
+		server_address = mock_http_server_workers.server_address
+		results = []
+		waiting = threading.Thread(
+			target=lambda: results.append(_request(server_address, 'GET', '/assert-called?method=GET&path=/path/2&timeout=5'))
+		)
+		waiting.start()
+
+		clients = [
+			threading.Thread(target=lambda: [_request(server_address, 'GET', '/path/1') for _ in range(10)])
+			for _ in range(4)
+		]
+		for client in clients:
+			client.start()
+		for client in clients:
+			client.join()
+		_request(server_address, 'GET', '/path/2')
+		waiting.join()
+
+		status, body = _request(server_address, 'GET', '/request-count?method=GET&path=/path/1')
+		assert status == 200
+		assert json.loads(body)['request_count'] == 40
+		assert results[0][0] == 200
+	finally:
+		mock_http_server_workers.close()
+
+
+def test_workers_invalid_history_options():
+
+	with pytest.raises(ValueError):
+		MockHTTPServerWorkers(('127.0.0.1', 0), 'stub_config.json', workers=2, history_options={'max_records': 0})
+
+
+def test_shared_stub_config_concurrent_updates():
+	"""
+
+	Given:
+		- 2 worker configurations sharing a ConfigStore
+	When:
+		- Both add endpoints at a time
+	Then:
+		- No endpoint is lost
+
+	"""
+	generation = multiprocessing.RawValue('Q', 0)
+	config_store = ConfigStore(StubConfig().dump_json(), generation)
+	stub_configs = [SharedStubConfig(config_store, generation) for _ in range(2)]
+
+	def add_endpoints(index: int):
+		for i in range(50):
+			stub_configs[index].upsert_endpoint('GET', f'/path/{index}/{i}', {"response": {"status_code": 200}})
+
+	threads = [threading.Thread(target=add_endpoints, args=(index,)) for index in range(2)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	_, config_json = config_store.get()
+	assert len(config_json['endpoints']) == 100
@@ -0,0 +1,64 @@
+from mockallan.request import HTTPRequest
+from mockallan.predicates import RequestPredicate, DecisionTree
+
+
+def _tenant_tree(tenant_count: int) -> DecisionTree:
+
+	entries = [
+		(f'tenant {i}', RequestPredicate(headers={'X-Tenant-Id': f'tenant_{i}'}), (0, i))
+		for i in range(tenant_count)
+	]
+	entries.append(('fallback', RequestPredicate(), (0, tenant_count)))
+	entries.append(('vip', RequestPredicate(query={'vip': 'true'}), (-1, tenant_count + 1)))
+
+	return DecisionTree(entries)
+
+
+def test_match_header():
+
+	decision_tree = _tenant_tree(1000)
+
+	request = HTTPRequest('GET', '/orders', headers={'x-tenant-id': 'tenant_823'})
+	assert decision_tree.match(request) == 'tenant 823'
+
+
+def test_match_fallback():
+
+	decision_tree = _tenant_tree(1000)
+
+	assert decision_tree.match(HTTPRequest('GET', '/orders', headers={'X-Tenant-Id': 'unknown'})) == 'fallback'
+	assert decision_tree.match(HTTPRequest('GET', '/orders')) == 'fallback'
+
+
+def test_match_priority():
+
+	decision_tree = _tenant_tree(1000)
+
+	request = HTTPRequest('GET', '/orders', {'vip': ['true']}, {'X-Tenant-Id': 'tenant_823'})
+	assert decision_tree.match(request) == 'vip'
+
+
+def test_match_body_fields():
+
+	decision_tree = DecisionTree([
+		('small', RequestPredicate(body={'order': {'size': 1}, 'type': 'retail'}), (0, 0)),
+		('large', RequestPredicate(body={'order': {'size': 100}, 'type': 'retail'}), (0, 1)),
+		('wholesale', RequestPredicate(body={'type': 'wholesale'}), (0, 2))
+	])
+
+	assert decision_tree.match(HTTPRequest('POST', '/orders', body='{"type": "retail", "order": {"size": 100}}')) == 'large'
+	assert decision_tree.match(HTTPRequest('POST', '/orders', body={'type': 'wholesale', 'order': {}})) == 'wholesale'
+	assert decision_tree.match(HTTPRequest('POST', '/orders', body='{"type": "retail", "order": {"size": "1"}}')) is None
+	assert decision_tree.match(HTTPRequest('POST', '/orders', body='not json')) is None
+
+
+def test_match_bytes_body():
+
+	decision_tree = DecisionTree([
+		('ping', RequestPredicate(body='ping'), (0, 0)),
+		('retail', RequestPredicate(body={'type': 'retail'}), (0, 1))
+	])
+
+	assert decision_tree.match(HTTPRequest('POST', '/orders', body=b'ping')) == 'ping'
+	assert decision_tree.match(HTTPRequest('POST', '/orders', body=b'{"type": "retail"}')) == 'retail'
+	assert decision_tree.match(HTTPRequest('POST', '/orders', body=b'\xffping')) is None
@@ -0,0 +1,103 @@
+import pytest
+from mockallan.router import Router, TemplateError
+
+
+@pytest.fixture
+def router():
+
+	router_instance = Router()
+	router_instance.add('GET', '/orders', 'orders')
+	router_instance.add('GET', '/orders/{order_id}', 'order')
+	router_instance.add('GET', '/orders/{order_id}/products', 'order products')
+	router_instance.add('GET', '/orders/latest/products', 'latest order products')
+	router_instance.add('GET', '/users/{user_id:[0-9]+}', 'user by id')
+	router_instance.add('GET', '/users/{user_name}', 'user by name')
+	router_instance.add('GET', '/files/*/meta', 'file meta')
+	router_instance.add('GET', '/static/**', 'static')
+	router_instance.add('GET', '/blobs/{blob_path*}', 'blob')
+
+	yield router_instance
+
+
+def test_lookup_static(router: Router):
+
+	assert router.lookup('GET', '/orders') == ('orders', {})
+
+
+def test_lookup_unknown(router: Router):
+
+	assert router.lookup('GET', '/unknown') is None
+	assert router.lookup('POST', '/orders') is None
+	assert router.lookup('GET', '/orders/order_e2b9/unknown') is None
+
+
+def test_lookup_param(router: Router):
+
+	assert router.lookup('GET', '/orders/order_e2b9') == ('order', {'order_id': 'order_e2b9'})
+	assert router.lookup('GET', '/orders/order_e2b9/products') == ('order products', {'order_id': 'order_e2b9'})
+
+
+def test_lookup_static_segment_precedence(router: Router):
+
+	assert router.lookup('GET', '/orders/latest/products') == ('latest order products', {})
+
+
+def test_lookup_regex_precedence(router: Router):
+
+	assert router.lookup('GET', '/users/1823') == ('user by id', {'user_id': '1823'})
+	assert router.lookup('GET', '/users/liam') == ('user by name', {'user_name': 'liam'})
+
+
+def test_lookup_wildcards(router: Router):
+
+	assert router.lookup('GET', '/files/report.pdf/meta') == ('file meta', {})
+	assert router.lookup('GET', '/static/css/site.css') == ('static', {})
+	assert router.lookup('GET', '/blobs/a/b%20c') == ('blob', {'blob_path': 'a/b c'})
+
+
+def test_add_replaces_route(router: Router):
+
+	router.add('GET', '/orders/{order_id}', 'new order')
+
+	assert router.lookup('GET', '/orders/order_e2b9') == ('new order', {'order_id': 'order_e2b9'})
+	assert len(router) == 9
+
+
+@pytest.mark.parametrize('template', ['orders', '/static/**/meta', '/users/{id:[}', '/users/{id'])
+def test_add_template_error(router: Router, template: str):
+
+	with pytest.raises(TemplateError):
+		router.add('GET', template, 'invalid')
+
+
+def test_remove():
+
+	router = Router()
+	router.add('GET', '/orders/{order_id}', 'order')
+	router.add('GET', '/orders/**', 'orders')
+	router.add('GET', '/health', 'health')
+
+	assert router.remove('GET', '/orders/{order_id}')
+	assert router.remove('GET', '/health')
+	assert not router.remove('GET', '/health')
+	assert router.lookup('GET', '/health') is None
+	assert router.lookup('GET', '/orders/1823') == ('orders', {})
+	assert len(router) == 1
+
+
+def test_copy_on_write():
+
+	router = Router()
+	router.add('GET', '/orders/{order_id}', 'order')
+	router.add('GET', '/orders/{order_id}/items', 'items')
+
+	router_copy = router.copy()
+	router_copy.add('GET', '/orders/{order_id}', 'order v2')
+	router_copy.remove('GET', '/orders/{order_id}/items')
+	router.add('GET', '/orders/{order_id}/lines', 'lines')
+
+	assert router.lookup('GET', '/orders/1823') == ('order', {'order_id': '1823'})
+	assert router.lookup('GET', '/orders/1823/items') == ('items', {'order_id': '1823'})
+	assert router_copy.lookup('GET', '/orders/1823') == ('order v2', {'order_id': '1823'})
+	assert router_copy.lookup('GET', '/orders/1823/items') is None
+	assert router_copy.lookup('GET', '/orders/1823/lines') is None
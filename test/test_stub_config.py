@@ -1,3 +1,4 @@
+import threading
 import pytest
 import json
 from mockallan.stub_config import StubConfig, MissingProperty, HTTPRequest, HTTPResponse
@@ -124,3 +125,360 @@ def test_lookup_response(stub_config: StubConfig):
 	assert response.status_code == 200
 	assert response.headers['Content-Type'] == 'application/xml'
 	assert response.body == "<SOAP:Envelope xmlns:SOAP=\"http://schemas.xmlsoap.org/soap/envelope/\" xmlns:xsd=\"http://www.w3.org/2001/XMLSchema\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\"><SOAP:Body><m:CreateUser><Integer xsi:type=\"xsd:integer\">0</Integer></m:CreateUser></SOAP:Body></SOAP:Envelope>"
+
+
+def test_load_json_compiles_responses(stub_config: StubConfig):
+	"""Tests that configured responses are compiled at load time and keep their body. """
+
+	response = stub_config.lookup(HTTPRequest('POST', '/orders/order_e2b9/products'))
+	compiled_response = response.compile()
+
+	assert compiled_response.status_line == b'HTTP/1.1 200 OK\r\n'
+	body = json.dumps(response.body).encode('utf-8')
+	assert compiled_response.payload == (
+		b'Content-Type: application/json\r\n'
+		b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body
+	)
+	assert isinstance(response.body, dict)
+	assert response.compile() is compiled_response
+
+
+def test_compiled_response_to_bytes():
+
+	compiled_response = HTTPResponse(404, {'Content-Type': 'text/plain'}, 'not found').compile()
+
+	assert compiled_response.to_bytes(b'Server: test\r\n') == (
+		b'HTTP/1.1 404 Not Found\r\n'
+		b'Server: test\r\n'
+		b'Content-Type: text/plain\r\n'
+		b'Content-Length: 9\r\n\r\n'
+		b'not found'
+	)
+
+
+def test_lookup_path_template(factory_stub_config: StubConfig):
+	"""Tests that path parameters are captured and rendered into the response. """
+
+	factory_stub_config.load_json(
+		{
+			"defaults": {
+				"response": {
+					"status_code": 404
+				}
+			},
+			"endpoints": [
+				{
+					"request": {
+						"method": "GET",
+						"path": "/orders/{order_id}/products"
+					},
+					"response": {
+						"status_code": 200,
+						"headers": {
+							"Location": "/orders/{{order_id}}"
+						},
+						"body": {
+							"order_id": "{{order_id}}"
+						}
+					}
+				}
+			]
+		}
+	)
+	request = HTTPRequest('GET', '/orders/order_e2b9/products')
+
+	response = factory_stub_config.lookup(request)
+
+	assert request.path_params == {'order_id': 'order_e2b9'}
+	assert response.headers == {'Location': '/orders/order_e2b9'}
+	assert response.body == {'order_id': 'order_e2b9'}
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders')).status_code == 404
+	assert factory_stub_config.dump_json()['endpoints'][0]['request']['path'] == '/orders/{order_id}/products'
+
+
+def test_lookup_request_predicates(factory_stub_config: StubConfig):
+	"""Tests that endpoints sharing a path are selected by their query, header and body predicates. """
+
+	config_json = {
+		"defaults": {
+			"response": {
+				"status_code": 404
+			}
+		},
+		"endpoints": [
+			{
+				"request": {
+					"method": "POST",
+					"path": "/orders"
+				},
+				"response": {
+					"status_code": 201
+				}
+			},
+			{
+				"request": {
+					"method": "POST",
+					"path": "/orders",
+					"headers": {
+						"X-Tenant-Id": "acme"
+					}
+				},
+				"response": {
+					"status_code": 202
+				}
+			},
+			{
+				"request": {
+					"method": "POST",
+					"path": "/orders",
+					"query": {
+						"dry_run": "true"
+					},
+					"body": {
+						"type": "retail"
+					}
+				},
+				"response": {
+					"status_code": 204
+				},
+				"priority": 1
+			}
+		]
+	}
+	factory_stub_config.load_json(config_json)
+
+	def lookup_status_code(query: dict, headers: dict, body: str) -> int:
+		return factory_stub_config.lookup(HTTPRequest('POST', '/orders', query, headers, body)).status_code
+
+	assert lookup_status_code({}, {}, '{}') == 201
+	assert lookup_status_code({}, {'X-Tenant-Id': 'acme'}, '{}') == 202
+	assert lookup_status_code({'dry_run': ['true']}, {'X-Tenant-Id': 'acme'}, '{"type": "retail"}') == 204
+	assert lookup_status_code({'dry_run': ['true']}, {}, '{"type": "wholesale"}') == 201
+
+	dumped_config_json = factory_stub_config.dump_json()
+	for endpoint_json in dumped_config_json['endpoints']:
+		del endpoint_json['response']['headers']
+		del endpoint_json['response']['body']
+	assert dumped_config_json['endpoints'] == config_json['endpoints']
+
+
+def _load_sequence_config(stub_config: StubConfig, sequence):
+
+	stub_config.load_json(
+		{
+			"defaults": {
+				"response": {
+					"status_code": 404
+				}
+			},
+			"endpoints": [
+				{
+					"request": {
+						"method": "GET",
+						"path": "/orders"
+					},
+					"response": [
+						{"status_code": 500},
+						{"status_code": 503},
+						{"status_code": 200}
+					],
+					"sequence": sequence
+				}
+			]
+		}
+	)
+
+
+def _lookup_status_codes(stub_config: StubConfig, count: int) -> list:
+
+	return [stub_config.lookup(HTTPRequest('GET', '/orders')).status_code for _ in range(count)]
+
+
+def test_lookup_sequence_stick(factory_stub_config: StubConfig):
+
+	_load_sequence_config(factory_stub_config, 'stick')
+
+	assert _lookup_status_codes(factory_stub_config, 5) == [500, 503, 200, 200, 200]
+	assert factory_stub_config.dump_json()['endpoints'][0]['sequence'] == {'policy': 'stick', 'position': 5}
+
+
+def test_lookup_sequence_cycle(factory_stub_config: StubConfig):
+
+	_load_sequence_config(factory_stub_config, 'cycle')
+
+	assert _lookup_status_codes(factory_stub_config, 5) == [500, 503, 200, 500, 503]
+
+
+def test_lookup_sequence_random_seed(factory_stub_config: StubConfig):
+
+	_load_sequence_config(factory_stub_config, {'policy': 'random', 'seed': 1823})
+	status_codes = _lookup_status_codes(factory_stub_config, 20)
+
+	_load_sequence_config(factory_stub_config, {'policy': 'random', 'seed': 1823})
+
+	assert _lookup_status_codes(factory_stub_config, 20) == status_codes
+	assert set(status_codes) == {500, 503, 200}
+
+
+def test_lookup_sequence_concurrent(factory_stub_config: StubConfig):
+	"""Tests that each position of the sequence is served once by concurrent lookups. """
+
+	_load_sequence_config(factory_stub_config, 'stick')
+	status_codes = []
+
+	def lookup():
+		status_codes.extend(_lookup_status_codes(factory_stub_config, 100))
+
+	threads = [threading.Thread(target=lookup) for _ in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert sorted(status_codes) == [200] * 798 + [500, 503]
+
+
+def test_load_json_sequence_policy_error(factory_stub_config: StubConfig):
+
+	with pytest.raises(ValueError):
+		_load_sequence_config(factory_stub_config, 'shuffle')
+
+
+def _load_orders_config(stub_config: StubConfig):
+
+	stub_config.load_json({
+		"defaults": {"response": {"status_code": 404, "headers": {}, "body": ""}},
+		"endpoints": [
+			{"request": {"method": "GET", "path": "/orders"}, "response": {"status_code": 200}},
+			{"request": {"method": "GET", "path": "/orders/{order_id}"}, "response": {"status_code": 200}}
+		]
+	})
+
+
+def test_patch_json(factory_stub_config: StubConfig):
+
+	_load_orders_config(factory_stub_config)
+
+	factory_stub_config.patch_json({
+		"defaults": {"response": {"status_code": 418, "headers": {"X-Teapot": "1"}}},
+		"endpoints": [
+			{"request": {"method": "GET", "path": "/orders"}, "response": {"status_code": 503}},
+			{"request": {"method": "GET", "path": "/orders/{order_id}"}, "response": None},
+			{"request": {"method": "POST", "path": "/orders"}, "response": {"status_code": 201}}
+		]
+	})
+
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders')).status_code == 503
+	assert factory_stub_config.lookup(HTTPRequest('POST', '/orders', body='{}')).status_code == 201
+	default_response = factory_stub_config.lookup(HTTPRequest('GET', '/orders/1823'))
+	assert default_response.status_code == 418
+	assert default_response.headers == {"X-Teapot": "1"}
+	assert len(factory_stub_config.dump_json()['endpoints']) == 2
+
+
+def test_patch_json_invalid_leaves_config_unchanged(factory_stub_config: StubConfig):
+
+	_load_orders_config(factory_stub_config)
+	config_json = factory_stub_config.dump_json()
+
+	with pytest.raises(ValueError):
+		factory_stub_config.patch_json({
+			"endpoints": [
+				{"request": {"method": "GET", "path": "/orders"}, "response": {"status_code": 503}},
+				{"request": {"method": "GET", "path": "/orders/{id:(}"}, "response": {"status_code": 200}}
+			]
+		})
+
+	assert factory_stub_config.dump_json() == config_json
+
+
+def test_upsert_endpoint_predicates(factory_stub_config: StubConfig):
+
+	_load_orders_config(factory_stub_config)
+
+	factory_stub_config.upsert_endpoint(
+		'GET',
+		'/orders',
+		{"request": {"query": {"status": "open"}}, "response": {"status_code": 206}}
+	)
+
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders', query={'status': ['open']})).status_code == 206
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders')).status_code == 200
+
+
+def test_delete_endpoint(factory_stub_config: StubConfig):
+
+	_load_orders_config(factory_stub_config)
+
+	assert factory_stub_config.delete_endpoint('GET', '/orders/{order_id}')
+	assert not factory_stub_config.delete_endpoint('GET', '/orders/{order_id}')
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders/1823')).status_code == 404
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders')).status_code == 200
+
+
+def test_snapshot_generation(factory_stub_config: StubConfig):
+
+	generation = factory_stub_config.snapshot.generation
+	_load_orders_config(factory_stub_config)
+	snapshot = factory_stub_config.snapshot
+
+	factory_stub_config.upsert_endpoint('GET', '/orders/{order_id}', {"response": {"status_code": 410}})
+
+	assert snapshot.generation == generation + 1
+	assert factory_stub_config.snapshot.generation == generation + 2
+	# Snapshots are immutable
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders/1823'), snapshot).status_code == 200
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/orders/1823')).status_code == 410
+
+
+def test_snapshot_version_sequence(factory_stub_config: StubConfig):
+
+	_load_sequence_config(factory_stub_config, 'stick')
+	version = factory_stub_config.snapshot.version
+
+	factory_stub_config.lookup(HTTPRequest('GET', '/orders'))
+
+	assert factory_stub_config.snapshot.version != version
+
+
+def test_load_json_index(factory_stub_config: StubConfig):
+	"""Tests that endpoint indexes are canonicalized, dumped and returned by lookup_indexed() """
+
+	endpoint_json = {
+		"request": {"method": "POST", "path": "/orders/{id}"},
+		"response": {"status_code": 201},
+		"index": ["$['orderId']", "$.items.*.sku", "$.orderId"]
+	}
+	factory_stub_config.load_json({"defaults": {"response": {"status_code": 200}}, "endpoints": [endpoint_json]})
+
+	snapshot = factory_stub_config.snapshot
+	response, index = factory_stub_config.lookup_indexed(HTTPRequest('POST', '/orders/1'), snapshot)
+	assert (response.status_code, index) == (201, ('$.orderId', '$.items[*].sku'))
+	assert factory_stub_config.lookup_indexed(HTTPRequest('GET', '/orders/1'), snapshot)[1] == ()
+	assert factory_stub_config.dump_json()['endpoints'][0]['index'] == ['$.orderId', '$.items[*].sku']
+
+	for index_json, error in ((['$..orderId'], ValueError), ('$.orderId', TypeError)):
+		with pytest.raises(error):
+			factory_stub_config.upsert_endpoint('POST', '/orders', dict(endpoint_json, index=index_json))
+
+
+def test_load_json_body_base64(factory_stub_config: StubConfig):
+	"""Tests that `body_base64` is decoded at load time, dumped back and replaced by a patched `body` """
+
+	response_json = {"status_code": 200, "headers": {}, "body_base64": "iVBORw0KGgo="}
+	factory_stub_config.load_json({"defaults": {"response": response_json}})
+
+	response = factory_stub_config.lookup(HTTPRequest('GET', '/logo.png'))
+	assert response.body == b'\x89PNG\r\n\x1a\n'
+	assert response.compile().payload.endswith(b'\r\n\r\n\x89PNG\r\n\x1a\n')
+	assert factory_stub_config.dump_json()['defaults']['response'] == response_json
+
+	factory_stub_config.patch_json({"defaults": {"response": {"body": "text"}}})
+	assert factory_stub_config.lookup(HTTPRequest('GET', '/logo.png')).body == 'text'
+
+	for invalid_response_json, error in (
+			({"status_code": 200, "body_base64": "iVBOR!"}, ValueError),
+			({"status_code": 200, "body_base64": "AA==", "body": ""}, ValueError),
+			({"status_code": 200, "body_base64": 1}, TypeError)):
+		with pytest.raises(error):
+			factory_stub_config.load_json({"defaults": {"response": invalid_response_json}})
@@ -0,0 +1,185 @@
+import jsonschema
+import pytest
+from mockallan.jsonpath import JSONPathError
+from mockallan.request import HTTPRequest
+from mockallan.validators import (
+	BODY_JSON,
+	BODY_XML,
+	JSONSchemaValidator,
+	JSONPathValidator,
+	XMLSchemaValidator,
+	RegexValidator,
+	RegexError,
+	RegexMatcher,
+	RegexTimeoutError,
+	ValidatorCache,
+	ParsedBodyCache,
+	body_digest,
+	count_regex_matches,
+	parse_body,
+	regex_search
+)
+
+
+_SCHEMA = '{"type": "object", "properties": {"foo": {"type": "string"}}, "required": ["foo"]}'
+
+
+def _schema_request(body) -> HTTPRequest:
+
+	return HTTPRequest('POST', '/assert-called-with', headers={'Content-Type': 'application/schema+json'}, body=body)
+
+
+def test_json_schema_validator_decodes_bodies():
+
+	validator = JSONSchemaValidator(_schema_request(_SCHEMA))
+
+	assert validator.validate(HTTPRequest('PUT', '/path/4', body='{"foo": "bar"}'))
+	assert validator.validate(HTTPRequest('PUT', '/path/4', body={'foo': 'bar'}))
+	assert not validator.validate(HTTPRequest('PUT', '/path/4', body='{"foo": 1}'))
+	assert not validator.validate(HTTPRequest('PUT', '/path/4', body='foo=bar'))
+
+	with pytest.raises(jsonschema.SchemaError):
+		JSONSchemaValidator(_schema_request('{"type": '))
+	with pytest.raises(jsonschema.SchemaError):
+		JSONSchemaValidator(_schema_request('{"type": 7}'))
+
+
+def test_validator_cache():
+
+	cache = ValidatorCache(max_entries=2)
+
+	validator = cache.get(JSONSchemaValidator, _schema_request(_SCHEMA))
+	assert cache.get(JSONSchemaValidator, _schema_request(_SCHEMA)) is validator
+	cache.get(JSONSchemaValidator, _schema_request('{"type": "array"}'))
+	cache.get(JSONSchemaValidator, _schema_request({'type': 'string'}))
+	with pytest.raises(jsonschema.SchemaError):
+		cache.get(JSONSchemaValidator, _schema_request('{"type": 7}'))
+
+	stats = cache.stats()
+	assert (stats['entries'], stats['hits'], stats['misses'], stats['evictions']) == (2, 1, 4, 1)
+	assert stats['bytes'] == len('{"type": "array"}') + len('{"type":"string"}')
+
+	# The least recently used validator was evicted
+	assert cache.get(JSONSchemaValidator, _schema_request(_SCHEMA)) is not validator
+
+
+def test_validator_cache_max_bytes():
+
+	cache = ValidatorCache(max_bytes=64)
+	xml_schema = '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"><xs:element name="a"/></xs:schema>'
+
+	cache.get(XMLSchemaValidator, HTTPRequest('POST', '/assert-called-with', body=xml_schema))
+	cache.get(JSONSchemaValidator, _schema_request('{"type": "array"}'))
+
+	assert cache.stats()['entries'] == 1
+	assert cache.stats()['bytes'] == len('{"type": "array"}')
+
+
+def test_parse_body():
+
+	assert parse_body(BODY_JSON, '{"foo": "bar"}') == {'foo': 'bar'}
+	assert parse_body(BODY_JSON, {'foo': 'bar'}) == {'foo': 'bar'}
+	assert parse_body(BODY_XML, '<?xml version="1.0" encoding="UTF-8"?><order id="1"/>').get('id') == '1'
+	for body_format, body in ((BODY_JSON, '{"foo": '), (BODY_JSON, b'\xff'), (BODY_XML, '<order>'), (BODY_XML, {'foo': 'bar'})):
+		with pytest.raises(ValueError):
+			parse_body(body_format, body)
+
+
+def test_parsed_body_cache():
+
+	cache = ParsedBodyCache(max_bytes=100)
+
+	document = cache.document(0, BODY_JSON, '{"foo": "bar"}')
+	assert document == {'foo': 'bar'}
+	assert cache.document(0, BODY_JSON, '{"foo": "bar"}') is document
+	for _ in range(2):
+		with pytest.raises(ValueError):
+			cache.document(1, BODY_XML, '<order>')
+	# Too large to be cached
+	cache.document(2, BODY_JSON, '"' + 'a' * 100 + '"')
+
+	stats = cache.stats()
+	assert (stats['entries'], stats['hits'], stats['misses']) == (2, 2, 3)
+	assert stats['bytes'] == (len('{"foo": "bar"}') + len('<order>')) * 4
+
+	# Evicts the least recently used parsed body
+	cache.document(3, BODY_JSON, '[1, 2, 3]')
+	assert cache.stats()['entries'] == 2
+	assert cache.stats()['bytes'] == (len('<order>') + len('[1, 2, 3]')) * 4
+
+
+def test_body_digest():
+
+	assert body_digest({'b': [1, 2], 'a': 'é'}) == body_digest(' {"a": "é",\n "b": [1,2]}') == body_digest(b'{"a":"\\u00e9","b":[1,2]}')
+	assert body_digest('{"a": 1}') != body_digest('{"a": 2}')
+	assert body_digest('foo') == body_digest('foo')
+	# Request bodies are kept as bytes, so text equals its UTF-8 encoding
+	assert body_digest('café') == body_digest('café'.encode('utf-8'))
+	assert body_digest(b'\xff\xfe') != body_digest(b'\xff\xfd')
+	assert body_digest('{"a": ') != body_digest('{"a":')
+
+
+def test_regex_search():
+	"""Tests that bytes bodies are searched without decoding them and decoded JSON bodies as text. """
+
+	assert regex_search(r'caf\xe9', 'café')
+	assert regex_search('café', 'café'.encode('utf-8'))
+	assert regex_search(r'^\x89PNG', b'\x89PNG\r\n')
+	assert not regex_search(r'^caf.$', 'café'.encode('utf-8'))
+	assert regex_search('"id": 7', {'id': 7})
+
+
+def test_count_regex_matches():
+	"""Tests counting regexes, combined or not, up to a limit. """
+
+	bodies = ['a1', 'b2', 'a3', 'c4']
+
+	assert count_regex_matches(['a', 'b', 'z'], bodies) == [2, 1, 0]
+	assert count_regex_matches(['a', '(b)'], bodies) == [2, 1]
+	assert count_regex_matches(['(?i)A', 'b'], bodies, 1) == [1, 1]
+
+
+def test_regex_validator_errors():
+
+	with pytest.raises(RegexError):
+		RegexValidator(HTTPRequest('POST', '/', body='('))
+	with pytest.raises(RegexError):
+		RegexValidator(HTTPRequest('POST', '/', headers={'X-Mockallan-Regex-Time-Limit': '0'}, body='a'))
+
+	validator = RegexValidator(HTTPRequest('POST', '/', headers={'X-Mockallan-Regex-Time-Limit': '2.5'}, body=b'a+'))
+	assert (validator.pattern, validator.time_limit) == ('a+', 2.5)
+	assert validator.validate(HTTPRequest('POST', '/', body='baa'))
+
+
+def test_regex_matcher_time_limit():
+	"""Tests that a runaway regex is stopped at the time limit and the matcher keeps working. """
+
+	matcher = RegexMatcher()
+	try:
+		with pytest.raises(RegexTimeoutError):
+			matcher.count_matches([r'^(a+)+$'], ['a' * 64 + 'b'], None, 0.5)
+		assert matcher.count_matches(['a', 'b'], ['a', b'ab'], None, 5.0) == [2, 1]
+	finally:
+		matcher.close()
+
+
+def test_jsonpath_validator():
+	"""Tests JSONPath expressions and partial objects. """
+
+	body = '{"orderId": "o-1", "customer": {"id": 7, "name": "Ann"}, "items": [{"sku": "A"}, {"sku": "B"}]}'
+	request = HTTPRequest('POST', '/orders', body=body)
+
+	for validation_body, valid in (
+			({"$.orderId": "o-1"}, True),
+			({"$.items[*].sku": "B", "$.customer.id": 7}, True),
+			({"$.items[*].sku": "C"}, False),
+			('{"customer": {"id": 7}}', True),
+			({"customer": {"id": 7.5}}, False),
+			({"items": [{"sku": "A"}]}, False)):
+		validator = JSONPathValidator(HTTPRequest('POST', '/', body=validation_body))
+		assert validator.validate(request) is valid
+
+	assert not JSONPathValidator(HTTPRequest('POST', '/', body={"$.orderId": "o-1"})).validate(HTTPRequest('POST', '/', body='<a/>'))
+	for validation_body in ('[1]', '{}', 'nope', {"$..orderId": 1}):
+		with pytest.raises(JSONPathError):
+			JSONPathValidator(HTTPRequest('POST', '/', body=validation_body))